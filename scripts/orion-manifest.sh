@@ -0,0 +1,41 @@
+#!/usr/bin/env bash
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Publish a multi-architecture image built by Orion build tasks.
+#
+# ARCH_IMAGES lists the image archive for each architecture, as
+# "arch=taskId:artifact" separated by spaces. Each image is pushed as
+# "$arch-latest", then the manifest is created by MANIFEST_COMMAND
+# (default: docker-manifest.sh).
+
+set -e
+set -x
+set -u
+set -o pipefail
+
+# don't log credentials
+set +x
+secret="$(curl -sSf --retry 5 "http://taskcluster/api/secrets/v1/secret/$TASKCLUSTER_SECRET")"
+jq -r .secret.docker.password <<<"$secret" | \
+  docker login -u "$(jq -r .secret.docker.username <<<"$secret")" --password-stdin
+unset secret
+set -x
+
+for entry in $ARCH_IMAGES; do
+  arch="${entry%%=*}"
+  task="${entry#*=}"
+  artifact="${task#*:}"
+  task="${task%%:*}"
+  curl -sSfL --retry 5 "http://taskcluster/api/queue/v1/task/$task/artifacts/$artifact" \
+    | zstd -d | docker load
+  docker tag "mozillasecurity/$IMAGE_NAME:latest" "mozillasecurity/$IMAGE_NAME:$arch-latest"
+  docker push "mozillasecurity/$IMAGE_NAME:$arch-latest"
+done
+
+if [ -n "$MANIFEST_COMMAND" ]; then
+  eval "$MANIFEST_COMMAND"
+else
+  ./scripts/docker-manifest.sh mozillasecurity "$IMAGE_NAME"
+fi
@@ -6,8 +6,14 @@
 
 import logging
 import os
+import pathlib
 
+from orion_decision.index import IndexResolver
+from orion_decision.profiling import PROFILER
+
+from ..common import taskcluster
 from ..common.cli import build_cli_parser
+from .pool import MountArtifactResolver
 from .workflow import Workflow
 
 
@@ -27,6 +33,24 @@ def main():
         action="store_true",
         help="Build the task group, but exit before creating tasks in Taskcluster.",
     )
+    parser.add_argument(
+        "--profile-output",
+        type=pathlib.Path,
+        help="Write phase timings and counters for this run to a JSON file",
+        default=os.environ.get("PROFILE_OUTPUT"),
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="Include a cProfile summary in --profile-output",
+        default=bool(os.environ.get("CPROFILE")),
+    )
+    parser.add_argument(
+        "--index-cache",
+        type=pathlib.Path,
+        help="File to cache Taskcluster index lookups in between runs",
+        default=os.environ.get("INDEX_CACHE"),
+    )
     args = parser.parse_args()
 
     # We need both task & task group information
@@ -36,17 +60,31 @@ def main():
     # Setup logger
     logging.basicConfig(level=args.log_level)
 
-    # Configure workflow using the secret or local configuration
-    workflow = Workflow()
-    config = workflow.configure(
-        local_path=args.configuration,
-        secret=args.taskcluster_secret,
-        fuzzing_git_repository=args.git_repository,
-        fuzzing_git_revision=args.git_revision,
-    )
+    if args.index_cache is not None:
+        MountArtifactResolver.RESOLVER = IndexResolver(
+            args.index_cache, index_factory=lambda: taskcluster.get_service("index")
+        )
+
+    PROFILER.start(cprofile=args.cprofile)
+    try:
+        # Configure workflow using the secret or local configuration
+        workflow = Workflow()
+        with PROFILER.phase("configure"):
+            config = workflow.configure(
+                local_path=args.configuration,
+                secret=args.taskcluster_secret,
+                fuzzing_git_repository=args.git_repository,
+                fuzzing_git_revision=args.git_revision,
+            )
 
-    # Retrieve remote repositories
-    workflow.clone(config)
+        # Retrieve remote repositories
+        with PROFILER.phase("clone"):
+            workflow.clone(config)
 
-    # Build all task definitions for that pool
-    workflow.build_tasks(args.pool_name, args.task_id, config, dry_run=args.dry_run)
+        # Build all task definitions for that pool
+        workflow.build_tasks(args.pool_name, args.task_id, config, dry_run=args.dry_run)
+        MountArtifactResolver.RESOLVER.save()
+    finally:
+        PROFILER.stop()
+        if args.profile_output is not None:
+            PROFILER.write(args.profile_output)
@@ -10,9 +10,10 @@ import os
 from datetime import datetime, timedelta
 from itertools import chain
 from pathlib import Path
-from string import Template
 
 import yaml
+from orion_decision.index import IndexResolver
+from orion_decision.template import TaskTemplate
 from taskcluster.exceptions import TaskclusterFailure, TaskclusterRestFailure
 from taskcluster.utils import fromNow, slugId, stringDate
 from tcadmin.resources import Hook, Role, WorkerPool
@@ -46,24 +47,28 @@ DOCKER_WORKER_DEVICES = (
 )
 
 TEMPLATES = (Path(__file__).parent / "task_templates").resolve()
-DECISION_TASK = Template((TEMPLATES / "decision.yaml").read_text())
-FUZZING_TASK = Template((TEMPLATES / "fuzzing.yaml").read_text())
+DECISION_TASK = TaskTemplate.from_file(TEMPLATES / "decision.yaml")
+FUZZING_TASK = TaskTemplate.from_file(TEMPLATES / "fuzzing.yaml")
 
 
 class MountArtifactResolver:
-    CACHE = {}  # cache of orion service -> taskId
+    # memoized orion service namespace -> taskId, shared by all pools in this run
+    RESOLVER = IndexResolver(index_factory=lambda: taskcluster.get_service("index"))
 
     @classmethod
     def lookup_taskid(cls, namespace):
-        assert isinstance(namespace, str)
-        if namespace not in cls.CACHE:
-            # need to resolve "image" to a task ID where the mount
-            # artifact is
-            idx = taskcluster.get_service("index")
-            result = idx.findTask(namespace)
-            cls.CACHE[namespace] = result["taskId"]
+        return cls.RESOLVER.lookup(namespace)
 
-        return cls.CACHE[namespace]
+    @classmethod
+    def prefetch(cls, configs):
+        """Resolve the mount artifacts for many pools concurrently."""
+        cls.RESOLVER.prefetch(
+            config.container["namespace"]
+            for config in configs
+            if config.platform == "windows"
+            and isinstance(config.container, dict)
+            and config.container.get("type") == "indexed-image"
+        )
 
 
 def add_task_image(task, config):
@@ -273,17 +278,15 @@ class PoolConfiguration(CommonPoolConfiguration):
             }
 
         # Build the decision task payload that will trigger the new fuzzing tasks
-        decision_task = yaml.safe_load(
-            DECISION_TASK.substitute(
-                description=DESCRIPTION.replace("\n", "\\n"),
-                max_run_time=parse_time("1h"),
-                owner_email=OWNER_EMAIL,
-                pool_id=self.pool_id,
-                provisioner=PROVISIONER_ID,
-                scheduler=SCHEDULER_ID,
-                secret=DECISION_TASK_SECRET,
-                task_id=self.task_id,
-            )
+        decision_task = DECISION_TASK.fill(
+            description=DESCRIPTION.replace("\n", "\\n"),
+            max_run_time=parse_time("1h"),
+            owner_email=OWNER_EMAIL,
+            pool_id=self.pool_id,
+            provisioner=PROVISIONER_ID,
+            scheduler=SCHEDULER_ID,
+            secret=DECISION_TASK_SECRET,
+            task_id=self.task_id,
         )
         decision_task["scopes"] = sorted(
             chain(decision_task["scopes"], self.get_scopes())
@@ -348,25 +351,24 @@ class PoolConfiguration(CommonPoolConfiguration):
         preprocess_task_id = None
 
         preprocess = self.create_preprocess()
+        MountArtifactResolver.prefetch(
+            [self] if preprocess is None else [self, preprocess]
+        )
         if preprocess is not None:
-            task = yaml.safe_load(
-                FUZZING_TASK.substitute(
-                    created=stringDate(now),
-                    deadline=stringDate(
-                        now + timedelta(seconds=preprocess.max_run_time)
-                    ),
-                    description=DESCRIPTION.replace("\n", "\\n"),
-                    expires=stringDate(fromNow("1 week", now)),
-                    max_run_time=preprocess.max_run_time,
-                    name=f"Fuzzing task {self.task_id} - preprocess",
-                    owner_email=OWNER_EMAIL,
-                    pool_id=self.pool_id,
-                    provisioner=PROVISIONER_ID,
-                    scheduler=SCHEDULER_ID,
-                    secret=DECISION_TASK_SECRET,
-                    task_group=parent_task_id,
-                    task_id=self.task_id,
-                )
+            task = FUZZING_TASK.fill(
+                created=stringDate(now),
+                deadline=stringDate(now + timedelta(seconds=preprocess.max_run_time)),
+                description=DESCRIPTION.replace("\n", "\\n"),
+                expires=stringDate(fromNow("1 week", now)),
+                max_run_time=preprocess.max_run_time,
+                name=f"Fuzzing task {self.task_id} - preprocess",
+                owner_email=OWNER_EMAIL,
+                pool_id=self.pool_id,
+                provisioner=PROVISIONER_ID,
+                scheduler=SCHEDULER_ID,
+                secret=DECISION_TASK_SECRET,
+                task_group=parent_task_id,
+                task_id=self.task_id,
             )
             task["payload"]["env"]["TASKCLUSTER_FUZZING_PREPROCESS"] = "1"
             configure_task(task, preprocess, now, env)
@@ -374,22 +376,20 @@ class PoolConfiguration(CommonPoolConfiguration):
             yield preprocess_task_id, task
 
         for i in range(1, self.tasks + 1):
-            task = yaml.safe_load(
-                FUZZING_TASK.substitute(
-                    created=stringDate(now),
-                    deadline=stringDate(now + timedelta(seconds=self.max_run_time)),
-                    description=DESCRIPTION.replace("\n", "\\n"),
-                    expires=stringDate(fromNow("1 week", now)),
-                    max_run_time=self.max_run_time,
-                    name=f"Fuzzing task {self.task_id} - {i}/{self.tasks}",
-                    owner_email=OWNER_EMAIL,
-                    pool_id=self.pool_id,
-                    provisioner=PROVISIONER_ID,
-                    scheduler=SCHEDULER_ID,
-                    secret=DECISION_TASK_SECRET,
-                    task_group=parent_task_id,
-                    task_id=self.task_id,
-                )
+            task = FUZZING_TASK.fill(
+                created=stringDate(now),
+                deadline=stringDate(now + timedelta(seconds=self.max_run_time)),
+                description=DESCRIPTION.replace("\n", "\\n"),
+                expires=stringDate(fromNow("1 week", now)),
+                max_run_time=self.max_run_time,
+                name=f"Fuzzing task {self.task_id} - {i}/{self.tasks}",
+                owner_email=OWNER_EMAIL,
+                pool_id=self.pool_id,
+                provisioner=PROVISIONER_ID,
+                scheduler=SCHEDULER_ID,
+                secret=DECISION_TASK_SECRET,
+                task_group=parent_task_id,
+                task_id=self.task_id,
             )
             if preprocess_task_id is not None:
                 task["dependencies"].append(preprocess_task_id)
@@ -433,17 +433,15 @@ class PoolConfigMap(CommonPoolConfigMap):
             }
 
         # Build the decision task payload that will trigger the new fuzzing tasks
-        decision_task = yaml.safe_load(
-            DECISION_TASK.substitute(
-                description=DESCRIPTION.replace("\n", "\\n"),
-                max_run_time=parse_time("1h"),
-                owner_email=OWNER_EMAIL,
-                pool_id=self.pool_id,
-                provisioner=PROVISIONER_ID,
-                scheduler=SCHEDULER_ID,
-                secret=DECISION_TASK_SECRET,
-                task_id=self.task_id,
-            )
+        decision_task = DECISION_TASK.fill(
+            description=DESCRIPTION.replace("\n", "\\n"),
+            max_run_time=parse_time("1h"),
+            owner_email=OWNER_EMAIL,
+            pool_id=self.pool_id,
+            provisioner=PROVISIONER_ID,
+            scheduler=SCHEDULER_ID,
+            secret=DECISION_TASK_SECRET,
+            task_id=self.task_id,
         )
         decision_task["scopes"] = sorted(chain(decision_task["scopes"], all_scopes))
         add_capabilities_for_scopes(decision_task)
@@ -486,27 +484,27 @@ class PoolConfigMap(CommonPoolConfigMap):
         """Create fuzzing tasks and attach them to a decision task"""
         now = datetime.utcnow()
 
-        for pool in self.iterpools():
+        pools = list(self.iterpools())
+        MountArtifactResolver.prefetch(pools)
+        for pool in pools:
             for i in range(1, pool.tasks + 1):
-                task = yaml.safe_load(
-                    FUZZING_TASK.substitute(
-                        created=stringDate(now),
-                        deadline=stringDate(now + timedelta(seconds=pool.max_run_time)),
-                        description=DESCRIPTION.replace("\n", "\\n"),
-                        expires=stringDate(fromNow("1 week", now)),
-                        max_run_time=pool.max_run_time,
-                        name=(
-                            f"Fuzzing task {pool.platform}-{pool.pool_id} - "
-                            f"{i}/{pool.tasks}"
-                        ),
-                        owner_email=OWNER_EMAIL,
-                        pool_id=pool.pool_id,
-                        provisioner=PROVISIONER_ID,
-                        scheduler=SCHEDULER_ID,
-                        secret=DECISION_TASK_SECRET,
-                        task_group=parent_task_id,
-                        task_id=self.task_id,
-                    )
+                task = FUZZING_TASK.fill(
+                    created=stringDate(now),
+                    deadline=stringDate(now + timedelta(seconds=pool.max_run_time)),
+                    description=DESCRIPTION.replace("\n", "\\n"),
+                    expires=stringDate(fromNow("1 week", now)),
+                    max_run_time=pool.max_run_time,
+                    name=(
+                        f"Fuzzing task {pool.platform}-{pool.pool_id} - "
+                        f"{i}/{pool.tasks}"
+                    ),
+                    owner_email=OWNER_EMAIL,
+                    pool_id=pool.pool_id,
+                    provisioner=PROVISIONER_ID,
+                    scheduler=SCHEDULER_ID,
+                    secret=DECISION_TASK_SECRET,
+                    task_group=parent_task_id,
+                    task_id=self.task_id,
                 )
                 configure_task(task, pool, now, env)
                 yield slugId(), task
@@ -12,6 +12,7 @@ import shutil
 import tempfile
 
 import yaml
+from orion_decision.profiling import PROFILER
 from tcadmin.appconfig import AppConfig
 
 from ..common import taskcluster
@@ -156,16 +157,20 @@ class Workflow(CommonWorkflow):
 
         # cancel any previously running tasks
         if not dry_run:
-            cancel_tasks(pool_config.task_id)
+            with PROFILER.phase("cancel"):
+                cancel_tasks(pool_config.task_id)
 
-        tasks = pool_config.build_tasks(task_id, env)
+        with PROFILER.phase("render"):
+            tasks = list(pool_config.build_tasks(task_id, env))
 
         if not dry_run:
             # Create all the tasks on taskcluster
             queue = taskcluster.get_service("queue")
             for task_id, task in tasks:
                 LOG.info(f"Creating task {task['metadata']['name']} as {task_id}")
-                queue.createTask(task_id, task)
+                with PROFILER.phase("submit"):
+                    queue.createTask(task_id, task)
+                PROFILER.count("tasks_created")
 
     def cleanup(self):
         """Cleanup temporary folders at end of execution"""
@@ -5,6 +5,7 @@ from pathlib import Path
 
 import pytest
 import slugid
+from orion_decision.index import IndexResolver
 
 from fuzzing_decision.common.pool import PoolConfigLoader as CommonPoolConfigLoader
 from fuzzing_decision.common.pool import PoolConfigMap as CommonPoolConfigMap
@@ -12,6 +13,7 @@ from fuzzing_decision.common.pool import PoolConfiguration as CommonPoolConfigur
 from fuzzing_decision.common.pool import parse_size
 from fuzzing_decision.decision.pool import (
     DOCKER_WORKER_DEVICES,
+    MountArtifactResolver,
     PoolConfigLoader,
     PoolConfigMap,
     PoolConfiguration,
@@ -96,9 +98,17 @@ def _get_expected_hook(platform="linux"):
                 "source": "https://github.com/MozillaSecurity/orion",
             },
             "payload": {
-                "artifacts": {},
+                "artifacts": {
+                    "public/decision-profile.json": {
+                        "path": "/tmp/decision-profile.json",
+                        "type": "file",
+                    },
+                },
                 "command": ["fuzzing-decision", "test"],
-                "env": {"TASKCLUSTER_SECRET": "project/fuzzing/decision"},
+                "env": {
+                    "PROFILE_OUTPUT": "/tmp/decision-profile.json",
+                    "TASKCLUSTER_SECRET": "project/fuzzing/decision",
+                },
                 "features": {"taskclusterProxy": True},
                 "image": {
                     "namespace": "project.fuzzing.orion.fuzzing-decision.master",
@@ -421,9 +431,10 @@ def test_gcp_resources(env, mock_clouds, mock_machines):
     ],
 )
 def test_tasks(env, scope_caps, platform, run_as_admin, mocker):
-    mocker.patch.dict(
-        "fuzzing_decision.decision.pool.MountArtifactResolver.CACHE",
-        {"orion.fuzzer.main": "task-mount-abc"},
+    index = mocker.Mock()
+    index.findTask.return_value = {"taskId": "task-mount-abc"}
+    mocker.patch.object(
+        MountArtifactResolver, "RESOLVER", IndexResolver(index_factory=lambda: index)
     )
     scopes, expected_capabilities = scope_caps
     if run_as_admin:
@@ -483,6 +494,8 @@ def test_tasks(env, scope_caps, platform, run_as_admin, mocker):
 
     # Check we have 2 valid task definitions
     assert len(tasks) == 2
+    # the mount artifact is looked up once for all tasks
+    assert index.findTask.call_count == (1 if platform == "windows" else 0)
 
     def _get_date(value):
         assert isinstance(value, str)
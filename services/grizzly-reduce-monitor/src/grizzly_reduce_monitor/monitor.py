@@ -12,12 +12,11 @@ from datetime import datetime, timedelta
 from logging import getLogger
 from pathlib import Path
 from random import choice, random
-from string import Template
 
 from grizzly.common.reporter import FuzzManagerReporter
+from orion_decision.template import TaskTemplate
 from taskcluster.exceptions import TaskclusterFailure
 from taskcluster.utils import slugId, stringDate
-from yaml import safe_load as yaml_load
 
 from .common import CommonArgParser, CrashManager, ReductionWorkflow, Taskcluster
 
@@ -45,7 +44,7 @@ DESCRIPTION = """*DO NOT EDIT* - This resource is configured automatically.
 Fuzzing workers generated by decision task"""
 RANDOMIZE_CRASH_SELECT = 0.25  # randomly ignore testcase size & ID when selecting
 TEMPLATES = (Path(__file__).parent / "task_templates").resolve()
-REDUCE_TASK = Template((TEMPLATES / "reduce.yaml").read_text())
+REDUCE_TASK = TaskTemplate.from_file(TEMPLATES / "reduce.yaml")
 
 
 ReducibleCrash = namedtuple(
@@ -205,21 +204,19 @@ class ReductionMonitor(ReductionWorkflow):
         my_task_id = os.environ.get("TASK_ID")
         task_id = slugId()
         now = datetime.utcnow()
-        task = yaml_load(
-            REDUCE_TASK.substitute(
-                task_group=my_task_id,
-                now=stringDate(now),
-                deadline=stringDate(now + REDUCTION_DEADLINE),
-                expires=stringDate(now + REDUCTION_EXPIRES),
-                provisioner=PROVISIONER_ID,
-                scheduler=SCHEDULER_ID,
-                worker=dest_queue,
-                max_run_time=int(REDUCTION_MAX_RUN_TIME.total_seconds()),
-                description=DESCRIPTION,
-                owner_email=OWNER_EMAIL,
-                crash_id=crash_id,
-                os_name=os_name,
-            )
+        task = REDUCE_TASK.fill(
+            task_group=my_task_id,
+            now=stringDate(now),
+            deadline=stringDate(now + REDUCTION_DEADLINE),
+            expires=stringDate(now + REDUCTION_EXPIRES),
+            provisioner=PROVISIONER_ID,
+            scheduler=SCHEDULER_ID,
+            worker=dest_queue,
+            max_run_time=int(REDUCTION_MAX_RUN_TIME.total_seconds()),
+            description=DESCRIPTION,
+            owner_email=OWNER_EMAIL,
+            crash_id=crash_id,
+            os_name=os_name,
         )
         queue = Taskcluster.get_service("queue")
         LOG.info("Creating task %s: %s", task_id, task["metadata"]["name"])
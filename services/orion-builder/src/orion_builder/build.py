@@ -4,11 +4,13 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """CLI for Orion builder/build script"""
 import sys
+from json import loads as json_loads
 from os import getenv
 from pathlib import Path
 from shutil import rmtree
 
 from taskboot.build import build_image
+from taskboot.docker import Img, patch_dockerfile
 from taskboot.target import Target
 
 from .cli import CommonArgs, configure_logging
@@ -60,6 +62,14 @@ class BuildArgs(CommonArgs):
             default=getenv("REGISTRY", "docker.io"),
             help="Docker registry to use in images tags (default: docker.io)",
         )
+        self.parser.add_argument(
+            "--batch",
+            default=getenv("BATCH"),
+            type=json_loads,
+            help="JSON list of images to build in order, each with 'dockerfile', "
+            "'image' and 'output' keys. Overrides --dockerfile, --image and "
+            "--output. (default: BATCH)",
+        )
         self.parser.set_defaults(
             build_arg=[],
             cache=str(Path.home() / ".local" / "share"),
@@ -77,6 +87,17 @@ class BuildArgs(CommonArgs):
             if load_deps_env == "1":
                 args.load_deps = True
 
+        if args.batch:
+            for entry in args.batch:
+                if set(entry) != {"dockerfile", "image", "output"}:
+                    self.parser.error(
+                        "--batch entries need 'dockerfile', 'image' and 'output'"
+                    )
+            # the first image is built as usual (and dependencies staged for it)
+            args.dockerfile = args.batch[0]["dockerfile"]
+            args.image = args.batch[0]["image"]
+            args.write = args.batch[0]["output"]
+
         if args.write is None:
             self.parser.error("--output (or ARCHIVE_PATH) is required!")
 
@@ -95,6 +116,31 @@ class BuildArgs(CommonArgs):
             )
 
 
+def build_batch(target, args):
+    """Build each image in `args.batch` in turn, sharing one image store.
+
+    Each image may be built `FROM` any image before it in the batch.
+
+    Arguments:
+        target (taskboot.target.Target): Target
+        args (argparse.Namespace): CLI arguments
+
+    Returns:
+        None
+    """
+    img_tool = Img(cache=args.cache)
+    for idx, entry in enumerate(args.batch):
+        args.dockerfile = entry["dockerfile"]
+        args.image = entry["image"]
+        args.write = entry["output"]
+        if idx:
+            # use images built earlier in the batch from the local store
+            # workaround https://github.com/genuinetools/img/issues/206
+            patch_dockerfile(target.check_path(args.dockerfile), img_tool.list_images())
+        Path(args.write).parent.mkdir(parents=True, exist_ok=True)
+        build_image(target, args)
+
+
 def main(argv=None):
     """Build entrypoint. Does not return."""
     args = BuildArgs.parse_args(argv)
@@ -103,7 +149,10 @@ def main(argv=None):
     if args.load_deps:
         stage_deps(target, args)
     try:
-        build_image(target, args)
+        if args.batch:
+            build_batch(target, args)
+        else:
+            build_image(target, args)
     finally:
         rmtree(target.dir)
     sys.exit(0)
@@ -4,6 +4,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """CLI for Orion builder/push script"""
 import sys
+from os import getenv
 
 from taskboot.push import push_artifacts
 
@@ -16,7 +17,7 @@ class PushArgs(CommonArgs):
     def __init__(self):
         super().__init__()
         self.parser.set_defaults(
-            artifact_filter="public/**.tar.zst",
+            artifact_filter=getenv("ARTIFACT_FILTER", "public/**.tar.zst"),
             exclude_filter=None,
             push_tool="skopeo",
         )
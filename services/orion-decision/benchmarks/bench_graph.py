@@ -0,0 +1,257 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Benchmark service graph building and scheduling on a synthetic Orion repo"""
+import json
+import logging
+import platform
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from random import Random
+from shutil import rmtree
+from subprocess import PIPE, run
+from tempfile import mkdtemp
+from time import perf_counter
+
+from orion_decision.git import GithubEvent, GitRepo
+from orion_decision.orion import Services
+from orion_decision.scheduler import Scheduler
+
+
+def _tree_parents(count, depth, fanout):
+    """Calculate the base service of each service.
+
+    Services are arranged in a forest of complete trees, each with `fanout` children
+    per service and `depth` levels.
+
+    Arguments:
+        count (int): Number of services.
+        depth (int): Number of levels in each tree.
+        fanout (int): Number of children of each service.
+
+    Returns:
+        list(int or None): Index of the base service for each service, or None.
+    """
+    tree_size = sum(fanout**level for level in range(depth))
+    result = []
+    for idx in range(count):
+        tree, node = divmod(idx, tree_size)
+        if node == 0:
+            result.append(None)
+        else:
+            result.append(tree * tree_size + (node - 1) // fanout)
+    return result
+
+
+def generate_repo(root, rng, services, recipes, files, depth, fanout):
+    """Write a synthetic Orion repo and commit it.
+
+    Arguments:
+        root (Path): Directory to create the repo in (must not exist).
+        rng (Random): Random number generator.
+        services (int): Number of services.
+        recipes (int): Number of recipe scripts.
+        files (int): Number of extra files in each service.
+        depth (int): Length of the longest chain of base images.
+        fanout (int): Number of services built from each service.
+
+    Returns:
+        None
+    """
+    recipe_names = [f"recipe{idx}.sh" for idx in range(recipes)]
+    recipe_dir = root / "recipes" / "linux"
+    recipe_dir.mkdir(parents=True)
+    for idx, name in enumerate(recipe_names):
+        lines = ["#!/bin/sh", "set -e"]
+        # recipes can only use recipes before them, to avoid cycles
+        for dep in rng.sample(recipe_names[:idx], min(idx, 2)):
+            lines.append(f"./{dep}")
+        lines.append(f"echo recipe {idx} done")
+        (recipe_dir / name).write_text("\n".join(lines) + "\n")
+
+    for idx, parent in enumerate(_tree_parents(services, depth, fanout)):
+        svc_dir = root / "services" / f"svc{idx}"
+        (svc_dir / "data").mkdir(parents=True)
+        (svc_dir / "service.yaml").write_text(f"name: svc{idx}\n")
+        base = "ubuntu:20.04" if parent is None else f"mozillasecurity/svc{parent}"
+        lines = [f"FROM {base}", "COPY recipes/linux /src/recipes"]
+        for recipe in rng.sample(recipe_names, min(recipes, 3)):
+            lines.append(f"RUN /src/recipes/{recipe}")
+        lines.append(f"COPY services/svc{idx}/data /data")
+        lines.append(f"COPY services/svc{idx}/launch.sh /home/worker/")
+        (svc_dir / "Dockerfile").write_text("\n".join(lines) + "\n")
+        (svc_dir / "launch.sh").write_text(
+            "#!/bin/sh\n"
+            + "".join(f"cat /data/f{num}.txt\n" for num in range(min(files, 5)))
+        )
+        for num in range(files):
+            (svc_dir / "data" / f"f{num}.txt").write_text(f"{idx} {num}\n")
+
+    def _git(*args):
+        return run(
+            ("git", "-c", "user.name=bench", "-c", "user.email=bench@localhost") + args,
+            cwd=root,
+            check=True,
+            stdout=PIPE,
+            universal_newlines=True,
+        ).stdout
+
+    _git("init", "-q")
+    _git("add", ".")
+    _git("commit", "-qm", "synthetic repo")
+
+
+def _time(func, repeat, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        result = func()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def _event(repo):
+    evt = GithubEvent()
+    evt.repo = repo
+    evt.event_type = "push"
+    evt.branch = "main"
+    evt.commit = repo.git("rev-parse", "HEAD").strip()
+    evt.commit_message = "synthetic push"
+    evt.fetch_ref = evt.commit
+    evt.repo_slug = "bench/orion"
+    return evt
+
+
+def benchmark(root, args):
+    """Time each phase of the decision on a synthetic repo.
+
+    Arguments:
+        root (Path): Synthetic repo created by `generate_repo()`.
+        args (argparse.Namespace): Benchmark arguments.
+
+    Returns:
+        dict: Best time (in seconds) for each phase, and sizes of the graph.
+    """
+    repo = GitRepo.from_existing(root)
+    graph_time, svcs = _time(lambda: Services(repo, workers=args.workers), args.repeat)
+
+    # change the last recipe (which no other recipe uses) and the Dockerfile at the
+    # root of the first tree
+    changed = [
+        root / "recipes" / "linux" / f"recipe{args.recipes - 1}.sh",
+        root / "services" / "svc0" / "Dockerfile",
+    ]
+
+    def _reset():
+        for obj in svcs.dependency_order:
+            obj.dirty = False
+
+    dirty_time, _ = _time(lambda: svcs.mark_changed_dirty(changed), args.repeat, _reset)
+    n_dirty = sum(svc.dirty for svc in svcs.values())
+
+    sched = Scheduler(
+        _event(repo),
+        datetime.utcnow(),
+        "group",
+        "secret",
+        "main",
+        dry_run=True,
+        scan_workers=args.workers,
+    )
+
+    def _dirty_all():
+        for obj in sched.services.dependency_order:
+            obj.dirty = True
+
+    schedule_time, _ = _time(sched.create_tasks, args.repeat, _dirty_all)
+    return {
+        "timings": {
+            "graph": graph_time,
+            "dirty": dirty_time,
+            "schedule": schedule_time,
+        },
+        "counts": {
+            "services": len(svcs),
+            "recipes": len(svcs.recipes),
+            "files": len(svcs.files),
+            "dirty": n_dirty,
+        },
+    }
+
+
+def _compare(result, baseline_path):
+    baseline = json.loads(baseline_path.read_text())
+    if baseline["params"] != result["params"]:
+        print("warning: baseline was run with different parameters", file=sys.stderr)
+    for phase, elapsed in sorted(result["timings"].items()):
+        before = baseline["timings"].get(phase)
+        if before:
+            ratio = elapsed / before
+            print(f"{phase:>10}: {before:.4f}s -> {elapsed:.4f}s ({ratio:.2f}x)")
+
+
+def main(argv=None):
+    """Benchmark entrypoint."""
+    parser = ArgumentParser(prog="bench_graph")
+    parser.add_argument("--services", type=int, default=100, help="Number of services")
+    parser.add_argument("--recipes", type=int, default=50, help="Number of recipes")
+    parser.add_argument("--files", type=int, default=20, help="Files per service")
+    parser.add_argument("--depth", type=int, default=4, help="Base image chain length")
+    parser.add_argument("--fanout", type=int, default=3, help="Children per service")
+    parser.add_argument("--workers", type=int, default=1, help="Scan processes")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output", type=Path, help="Write JSON results to file")
+    parser.add_argument(
+        "--compare", type=Path, help="Compare against JSON results of a previous run"
+    )
+    args = parser.parse_args(argv)
+    assert args.depth >= 1 and args.fanout >= 1
+
+    # the decision logs every dirty service and created task as it goes
+    logging.basicConfig(level=logging.ERROR)
+    tmp = Path(mkdtemp(prefix="bench-graph-"))
+    try:
+        root = tmp / "repo"
+        generate_repo(
+            root,
+            Random(args.seed),
+            args.services,
+            args.recipes,
+            args.files,
+            args.depth,
+            args.fanout,
+        )
+        result = benchmark(root, args)
+    finally:
+        rmtree(tmp)
+
+    revision = run(
+        ("git", "rev-parse", "HEAD"),
+        cwd=Path(__file__).parent,
+        stdout=PIPE,
+        universal_newlines=True,
+    ).stdout.strip()
+    params = ("services", "recipes", "files", "depth", "fanout", "workers", "seed")
+    result["params"] = {key: getattr(args, key) for key in params}
+    result["revision"] = revision or None
+    result["python"] = platform.python_version()
+
+    for phase, elapsed in sorted(result["timings"].items()):
+        print(f"{phase:>10}: {elapsed:.4f}s")
+    if args.compare is not None:
+        _compare(result, args.compare)
+    if args.output is not None:
+        args.output.write_text(json.dumps(result, indent=2, sort_keys=True) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Benchmark path reference scanning (regex alternation vs. MultiStringMatcher)"""
+import re
+import sys
+from argparse import ArgumentParser
+from random import Random
+from time import perf_counter
+
+from orion_decision.matcher import MultiStringMatcher
+
+
+def synthetic_paths(rng, count):
+    """Generate paths resembling an Orion repo.
+
+    Arguments:
+        rng (Random): Random number generator.
+        count (int): Number of paths to generate.
+
+    Returns:
+        list(str): Paths, with recipe basenames following recipe paths like
+                   `Services._scan_files()` does.
+    """
+    result = []
+    for idx in range(count):
+        if idx % 10 == 0:
+            name = f"recipe{idx}.sh"
+            result.append(f"recipes/linux/{name}")
+            result.append(name)
+        else:
+            depth = rng.randint(0, 3)
+            dirs = [f"dir{rng.randrange(count // 10 + 1)}" for _ in range(depth)]
+            result.append("/".join([f"services/svc{idx % 97}"] + dirs + [f"f{idx}"]))
+    return result
+
+
+def synthetic_text(rng, paths, size):
+    """Generate a script referencing some of the given paths.
+
+    Arguments:
+        rng (Random): Random number generator.
+        paths (list(str)): Paths which may be referenced.
+        size (int): Approximate length of text to generate.
+
+    Returns:
+        str: Text to scan.
+    """
+    words = ["apt-get", "install", "-y", "retry", "curl", "&&", "\\\n", "echo"]
+    result = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.05:
+            word = rng.choice(paths)
+        else:
+            word = rng.choice(words)
+        result.append(word)
+        length += len(word) + 1
+    return " ".join(result)
+
+
+def _time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main(argv=None):
+    """Benchmark entrypoint."""
+    parser = ArgumentParser(prog="bench_matcher")
+    parser.add_argument("--paths", type=int, default=5000, help="Number of paths")
+    parser.add_argument("--files", type=int, default=50, help="Number of files")
+    parser.add_argument("--size", type=int, default=4096, help="Size of each file")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args(argv)
+
+    rng = Random(args.seed)
+    paths = synthetic_paths(rng, args.paths)
+    texts = [synthetic_text(rng, paths, args.size) for _ in range(args.files)]
+
+    build_re, regex = _time(
+        lambda: re.compile("|".join(re.escape(path) for path in paths)), args.repeat
+    )
+    build_ac, matcher = _time(lambda: MultiStringMatcher(paths), args.repeat)
+    scan_re, found_re = _time(
+        lambda: [[m.group(0) for m in regex.finditer(text)] for text in texts],
+        args.repeat,
+    )
+    scan_ac, found_ac = _time(
+        lambda: [list(matcher.matches(text)) for text in texts], args.repeat
+    )
+    assert found_re == found_ac, "matcher results differ from regex"
+
+    print(f"{len(paths)} paths, {len(texts)} files of ~{args.size} chars")
+    print(f"regex:   build {build_re:.3f}s, scan {scan_re:.3f}s")
+    print(f"matcher: build {build_ac:.3f}s, scan {scan_ac:.3f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,5 +23,6 @@ PROVISIONER_ID = "proj-fuzzing"
 SCHEDULER_ID = "taskcluster-github"
 SOURCE_URL = "https://github.com/MozillaSecurity/orion"
 WORKER_TYPE = "ci"
+WORKER_TYPE_ARM64 = "ci-arm64"
 WORKER_TYPE_MSYS = "ci-windows"
 del os, relativedelta, timedelta, TaskclusterConfig
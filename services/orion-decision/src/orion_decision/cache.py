@@ -0,0 +1,156 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Persistent cache for Orion service graph calculations"""
+from hashlib import sha256
+from json import JSONDecodeError
+from json import dump as json_dump
+from json import load as json_load
+from logging import getLogger
+
+LOG = getLogger(__name__)
+CACHE_VERSION = 3
+# sections in the cache, each is a mapping of git blob SHA -> result
+SECTIONS = frozenset(("images", "metadata", "scan", "sources"))
+
+
+class GraphCache:
+    """Content-addressed cache for the results of reading files in an Orion repo.
+
+    Results are keyed by git blob SHA, so they remain valid for any file with the
+    same content, regardless of path or commit. Only results used in the current run
+    are saved, so the cache doesn't grow with history.
+
+    The `scan` section holds path references found in each file. Those depend on the
+    set of paths being searched for as well as the file content, so that section is
+    discarded whenever the set of paths changes (see `set_paths()`).
+
+    Attributes:
+        path (Path): Location of the cache file.
+        hits (int): Number of results loaded from the cache.
+        misses (int): Number of results calculated.
+    """
+
+    __slots__ = ("path", "hits", "misses", "_old", "_new")
+
+    def __init__(self, path):
+        """Initialize a GraphCache instance.
+
+        If the cache file doesn't exist, or is invalid, the cache starts empty.
+
+        Arguments:
+            path (Path): Location of the cache file.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._new = {section: {} for section in SECTIONS}
+        self._new["paths"] = None
+        self._old = self._load()
+
+    def _load(self):
+        empty = {section: {} for section in SECTIONS}
+        empty["paths"] = None
+        if not self.path.is_file():
+            LOG.info("Graph cache %s does not exist, starting cold", self.path)
+            return empty
+        try:
+            with self.path.open() as cache_fp:
+                data = json_load(cache_fp)
+        except (JSONDecodeError, OSError, UnicodeError) as exc:
+            LOG.warning("Graph cache %s is unreadable (%s), ignoring", self.path, exc)
+            return empty
+        if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+            LOG.warning("Graph cache %s has unknown version, ignoring", self.path)
+            return empty
+        if not all(isinstance(data.get(section), dict) for section in SECTIONS):
+            LOG.warning("Graph cache %s is malformed, ignoring", self.path)
+            return empty
+        LOG.info(
+            "Loaded graph cache %s (%s)",
+            self.path,
+            ", ".join(
+                f"{len(data[section])} {section}" for section in sorted(SECTIONS)
+            ),
+        )
+        return data
+
+    def set_paths(self, paths):
+        """Set the list of paths that `scan` results were calculated against.
+
+        Any cached `scan` results calculated against a different list are discarded.
+
+        Arguments:
+            paths (list(str)): Path strings searched for in each file.
+
+        Returns:
+            None
+        """
+        digest = sha256("\0".join(paths).encode("utf-8")).hexdigest()
+        self._new["paths"] = digest
+        if self._old["paths"] != digest:
+            if self._old["scan"]:
+                LOG.info("Set of paths changed, discarding cached file scans")
+            self._old["scan"] = {}
+
+    def has(self, section, blob):
+        """Check whether a result is available in the cache.
+
+        Arguments:
+            section (str): Cache section (one of `SECTIONS`).
+            blob (str): Git blob SHA of the file the result is calculated from.
+
+        Returns:
+            bool: True if `get()` would not need to calculate the result.
+        """
+        return blob in self._new[section] or blob in self._old[section]
+
+    def get(self, section, blob, compute):
+        """Get a result from the cache, or calculate and store it.
+
+        Arguments:
+            section (str): Cache section (one of `SECTIONS`).
+            blob (str): Git blob SHA of the file the result is calculated from.
+            compute (callable): Function called with no arguments to calculate the
+                                result if it isn't cached. Must return a JSON
+                                serializable object.
+
+        Returns:
+            object: The cached or calculated result.
+        """
+        assert section in SECTIONS, f"unknown cache section: {section}"
+        assert section != "scan" or self._new["paths"] is not None
+        new = self._new[section]
+        if blob in new:
+            self.hits += 1
+            return new[blob]
+        old = self._old[section]
+        if blob in old:
+            self.hits += 1
+            result = old[blob]
+        else:
+            self.misses += 1
+            result = compute()
+        new[blob] = result
+        return result
+
+    def save(self):
+        """Write the results used by this run to the cache file.
+
+        Returns:
+            None
+        """
+        data = dict(self._new)
+        data["version"] = CACHE_VERSION
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("w") as cache_fp:
+            json_dump(data, cache_fp, sort_keys=True)
+        tmp.replace(self.path)
+        LOG.info(
+            "Saved graph cache %s (%d hits, %d misses)",
+            self.path,
+            self.hits,
+            self.misses,
+        )
@@ -86,6 +86,9 @@ def check_matrix(args):
 
                 # create CIMatrix for each branch and is_release=True
                 event_type = GIT_EVENT_TYPES[event_data["action"]]
+                # (jobs are only checked when the matrix is expanded)
                 for branch in branches:
-                    CIMatrix(matrix, branch, event_type)
-                CIMatrix(matrix, None, event_type)
+                    for _ in CIMatrix(matrix, branch, event_type).iter_jobs():
+                        pass
+                for _ in CIMatrix(matrix, None, event_type).iter_jobs():
+                    pass
@@ -3,14 +3,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Build matrix for CI tasks"""
+
 from abc import ABC, abstractmethod
-from itertools import product
+from itertools import chain, product
 from json import dumps as json_dumps
 from json import loads as json_loads
 from logging import getLogger
 from pathlib import Path
 
-from jsonschema import RefResolver, validate
+from jsonschema import RefResolver
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 from yaml import safe_load as yaml_load
 
 from . import Taskcluster
@@ -30,21 +33,54 @@ IMAGES = {
     ("python", "linux", "3.9"): "ci-py-39",
     ("python", "windows", "3.8"): "ci-py-38-win",
 }
-SCHEMA_CACHE = {}
+# attributes compared by `MatrixJob.matches()`, other than `env`
+MATCH_ATTRS = ("language", "version", "platform", "script", "name")
+SCHEMA_CACHE = {}  # schema $id -> schema
+SCHEMAS = {}  # schema title -> schema
+VALIDATORS = {}  # schema title -> validator class, checked on first use
 LOG = getLogger(__name__)
 
 
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
 def _schema_by_name(name):
-    for schema in SCHEMA_CACHE.values():
-        if schema["title"] == name:
-            return schema
-    raise RuntimeError(f"Unknown schema name: {name}")  # pragma: no cover
+    try:
+        return SCHEMAS[name]
+    except KeyError:  # pragma: no cover
+        raise RuntimeError(f"Unknown schema name: {name}") from None
 
 
-def _validate_schema_by_name(instance, name):
+def _validator_by_name(name):
+    """Get a validator for a schema.
+
+    The schema itself is checked and its validator class selected the first time it
+    is used. `RefResolver` keeps state between references, so each validator gets a
+    new resolver, but shares the pre-loaded schema store.
+
+    Arguments:
+        name (str): Schema title.
+
+    Returns:
+        jsonschema.protocols.Validator: Validator for the schema.
+    """
+    cls = VALIDATORS.get(name)
     schema = _schema_by_name(name)
-    resolver = RefResolver(None, referrer=None, store=SCHEMA_CACHE)
-    return validate(instance=instance, schema=schema, resolver=resolver)
+    if cls is None:
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        VALIDATORS[name] = cls
+    return cls(schema, resolver=RefResolver.from_schema(schema, store=SCHEMA_CACHE))
+
+
+def _validate_schema_by_name(instance, name):
+    # same error as `jsonschema.validate()`, without re-checking the schema
+    error = best_match(_validator_by_name(name).iter_errors(instance))
+    if error is not None:
+        raise error
 
 
 class MatrixJob:
@@ -54,13 +90,23 @@ class MatrixJob:
         env (dict(str -> str)): Environment variables to set for `script`.
         language (str): The programming language under test (must be in `LANGUAGES`)
         name (str): The name for this job
+        needs (list(dict)): Arguments for `matches()` selecting the jobs this job
+                            depends on. If empty, this job depends on all jobs
+                            in the previous `stage` instead. Jobs with `needs`
+                            are not part of any `stage`.
         platform (str): The operating system to run test (must be in `PLATFORMS`)
         require_previous_stage_pass (bool): This job should only run after all jobs
-                                            with a lower `stage` have succeeded.
+                                            with a lower `stage` (or in `needs`)
+                                            have succeeded.
         script (list(str)): The command to run (single command).
         secrets (list(CISecret)): Secrets to be fetched when the job is run.
+        shard (int): Which of `shards` this task runs (starting at 1).
+        shard_history (list(str)): Task IDs of previous runs of this shard, with test
+                                   timings used to balance the shards.
+        shards (int): Number of tasks to split this job into.
         stage (int): The CI stage. Stages are scheduled sequentially in ascending order,
-                     with all jobs in the same stage running in parallel.
+                     with all jobs in the same stage running in parallel. Must be 1
+                     for jobs with `needs`.
         version (str): Version number of `language` to run (must be in
                        `VERSIONS[(language, platform)]`)
     """
@@ -69,10 +115,14 @@ class MatrixJob:
         "env",
         "language",
         "name",
+        "needs",
         "platform",
         "require_previous_stage_pass",
         "script",
         "secrets",
+        "shard",
+        "shard_history",
+        "shards",
         "stage",
         "version",
     )
@@ -87,6 +137,8 @@ class MatrixJob:
         script,
         stage=1,
         previous_pass=False,
+        needs=None,
+        shards=1,
     ):
         """Initialize a MatrixJob.
 
@@ -102,7 +154,11 @@ class MatrixJob:
             stage (int): The CI stage. Stages are scheduled sequentially in ascending
                          order, with all jobs in the same stage running in parallel.
             previous_pass (bool): This job should only run after all jobs
-                                  with a lower `stage` have succeeded.
+                                  with a lower `stage` (or in `needs`) have
+                                  succeeded.
+            needs (list(dict)/None): Arguments for `matches()` selecting the jobs
+                                     this job depends on, instead of `stage`.
+            shards (int): Number of tasks to split this job into.
         """
         self.language = language
         self.version = version
@@ -116,6 +172,10 @@ class MatrixJob:
         self.stage = stage
         self.require_previous_stage_pass = previous_pass
         self.secrets = []
+        self.needs = needs or []
+        self.shards = shards
+        self.shard = 1
+        self.shard_history = []
 
     @property
     def image(self):
@@ -167,6 +227,19 @@ class MatrixJob:
         assert isinstance(
             self.require_previous_stage_pass, bool
         ), "`require_previous_stage_pass` must be a boolean"
+        assert isinstance(self.needs, list) and all(
+            isinstance(need, dict) and need for need in self.needs
+        ), "`needs` must be a list of non-empty dicts"
+        assert not self.needs or self.stage == 1, "jobs with `needs` have no `stage`"
+        assert (
+            isinstance(self.shards, int) and self.shards > 0
+        ), "`shards` must be a positive integer"
+        assert (
+            isinstance(self.shard, int) and 0 < self.shard <= self.shards
+        ), "`shard` must be between 1 and `shards`"
+        assert isinstance(self.shard_history, list) and all(
+            isinstance(task_id, str) for task_id in self.shard_history
+        ), "`shard_history` must be a list of strings"
         assert (self.language, self.platform, self.version,) in IMAGES, (
             f"no image available for language '{self.language}', "
             f"platform '{self.platform}', version '{self.version}'"
@@ -198,6 +271,10 @@ class MatrixJob:
         )
         result.stage = obj["stage"]
         result.require_previous_stage_pass = obj["require_previous_stage_pass"]
+        result.needs = obj.get("needs", [])
+        result.shards = obj.get("shards", 1)
+        result.shard = obj.get("shard", 1)
+        result.shard_history = obj.get("shard_history", [])
         result.secrets.extend(CISecret.from_json(secret) for secret in obj["secrets"])
         result.check()
         return result
@@ -220,11 +297,21 @@ class MatrixJob:
             dict: JSON serializeable copy of this `MatrixJob`.
         """
         obj = {attr: getattr(self, attr) for attr in self.__slots__}
+        # callers add to these, which must not change the job
+        obj["env"] = dict(self.env)
+        obj["script"] = list(self.script)
+        obj["shard_history"] = list(self.shard_history)
         obj["secrets"] = [secret.serialize() for secret in self.secrets]
         return obj
 
     def matches(
-        self, language=None, version=None, platform=None, env=None, script=None
+        self,
+        language=None,
+        version=None,
+        platform=None,
+        env=None,
+        script=None,
+        name=None,
     ):
         """Check if this object matches all given arguments.
 
@@ -236,11 +323,15 @@ class MatrixJob:
                              `self.env` may have other keys, only the keys passed in
                              `env` are checked.
             script (list/None): If not None, check for match on `script` attribute.
+            name (str/None): If not None, check for match on `name` attribute.
 
         Returns:
             bool: True if self matches the given arguments.
         """
 
+        if name is not None and self.name != name:
+            return False
+
         if language is not None and self.language != language:
             return False
 
@@ -264,6 +355,95 @@ class MatrixJob:
         return True
 
 
+class JobMatcher:
+    """Match jobs against many sets of `MatrixJob.matches()` arguments at once.
+
+    Argument sets are grouped by which attributes and `env` keys they give. Each
+    group is a set of the given values, so checking a job costs one lookup per group
+    instead of one `matches()` call per argument set.
+    """
+
+    __slots__ = ("_groups",)
+
+    def __init__(self, criteria):
+        """Initialize a JobMatcher.
+
+        Arguments:
+            criteria (iterable(dict)): Keyword arguments for `MatrixJob.matches()`.
+        """
+        self._groups = {}
+        for crit in criteria:
+            attrs = tuple(name for name in MATCH_ATTRS if crit.get(name) is not None)
+            env = crit.get("env") or {}
+            env_keys = tuple(sorted(env))
+            self._groups.setdefault((attrs, env_keys), set()).add(
+                tuple(_freeze(crit[name]) for name in attrs)
+                + tuple(env[key] for key in env_keys)
+            )
+
+    def matches(self, job):
+        """Check if a job matches any of the argument sets.
+
+        Arguments:
+            job (MatrixJob): Job to check.
+
+        Returns:
+            bool: True if `job.matches(**criteria)` is True for any criteria.
+        """
+        for (attrs, env_keys), values in self._groups.items():
+            if not all(key in job.env for key in env_keys):
+                continue
+            value = tuple(_freeze(getattr(job, name)) for name in attrs) + tuple(
+                job.env[key] for key in env_keys
+            )
+            if value in values:
+                return True
+        return False
+
+
+class JobIndex:
+    """Index of jobs by language, version, platform and script.
+
+    Used to find whether a job is already covered by an existing job, as checked by
+    `MatrixJob.matches()` for all of the job's attributes. Only jobs with the same
+    key are compared, so each check is independent of the total number of jobs.
+    """
+
+    __slots__ = ("_envs",)
+
+    def __init__(self, jobs=()):
+        """Initialize a JobIndex.
+
+        Arguments:
+            jobs (iterable(MatrixJob)): Jobs to add to the index.
+        """
+        # key -> list of env for each job with that key
+        self._envs = {}
+        for job in jobs:
+            self.add(job)
+
+    @staticmethod
+    def _key(job):
+        return (job.language, job.version, job.platform, _freeze(job.script))
+
+    def add(self, job):
+        """Add a job to the index.
+
+        Arguments:
+            job (MatrixJob): Job to add.
+
+        Returns:
+            None
+        """
+        self._envs.setdefault(self._key(job), []).append(job.env)
+
+    def __contains__(self, job):
+        # an existing job matches if it has all of job.env (and maybe more)
+        return any(
+            job.env.items() <= env.items() for env in self._envs.get(self._key(job), ())
+        )
+
+
 class CISecret(ABC):
     """Representation of a Taskcluster secret used by CI jobs.
 
@@ -527,12 +707,16 @@ class CIMatrix:
      - exclude jobs using jobs.exclude
      - include jobs using jobs.include
 
+    The matrix is parsed when created, but jobs are only expanded by `iter_jobs()`
+    (or `jobs`), so large products don't need to be held in memory.
+
      Attributes:
-        jobs (list(MatrixJob)): CI jobs to run.
+        needed (JobMatcher/None): Matches any job selected by the `needs` of another
+                                  job, or None if no job has `needs`.
         secrets (list(CISecret)): Secrets to be fetched when each job is run.
     """
 
-    __slots__ = ("jobs", "secrets")
+    __slots__ = ("needed", "secrets", "_exclude", "_includes", "_jobs", "_product")
 
     def __init__(self, matrix, branch, event_type):
         """Initialize a CIMatrix object.
@@ -543,10 +727,27 @@ class CIMatrix:
             event_type (str): Git event type (for `when` expressions)
         """
         # matrix is language/platform/version
-        self.jobs = []
+        self.needed = None
         self.secrets = []
+        self._exclude = None
+        # list of (index, job attributes) for each include that applies
+        self._includes = []
+        self._jobs = None
+        # (language, platforms, versions, envs, scripts, global env, shards) or None
+        self._product = None
         self._parse_matrix(matrix, branch, event_type)
 
+    @property
+    def jobs(self):
+        """All CI jobs to run (expanded on first use).
+
+        Returns:
+            list(MatrixJob): CI jobs to run.
+        """
+        if self._jobs is None:
+            self._jobs = list(self.iter_jobs())
+        return self._jobs
+
     def _parse_matrix(self, matrix, branch, event_type):
         _validate_schema_by_name(instance=matrix, name="CIMatrix")
 
@@ -596,23 +797,21 @@ class CIMatrix:
                     specified_scripts.append(script.copy())
             given.add("script")
 
+        if "shard" in matrix:
+            given.add("shard")
+
         # cartesian product of everything specified so far
         if default_language is not None and specified_versions and specified_scripts:
-            for platform, version, env, script in product(
-                specified_platforms,
+            self._product = (
+                default_language,
+                list(specified_platforms),
                 specified_versions,
                 specified_envs or [{}],
                 specified_scripts,
-            ):
-                local_env = global_env.copy()
-                local_env.update(env)
-                self.jobs.append(
-                    MatrixJob(
-                        None, default_language, version, platform, local_env, script
-                    )
-                )
-            LOG.debug("product created %d jobs", len(self.jobs))
-            used |= {"language", "version", "platform", "script", env_name}
+                global_env,
+                matrix.get("shard", 1),
+            )
+            used |= {"language", "version", "platform", "script", "shard", env_name}
 
         if "secrets" in matrix:
             self.secrets.extend(self._parse_secrets(matrix["secrets"]))
@@ -620,9 +819,7 @@ class CIMatrix:
         if "jobs" in matrix:
             # exclude jobs
             if "exclude" in matrix["jobs"]:
-                for exclude in matrix["jobs"]["exclude"]:
-                    self.jobs = [job for job in self.jobs if not job.matches(**exclude)]
-                    LOG.debug("%d jobs after exclude", len(self.jobs))
+                self._exclude = JobMatcher(matrix["jobs"]["exclude"])
 
             # include jobs
             if "include" in matrix["jobs"]:
@@ -672,33 +869,39 @@ class CIMatrix:
                     if "env" in include:
                         env.update(include["env"])
 
-                    job = MatrixJob(
-                        name,
-                        language,
-                        version,
-                        platform,
-                        env,
-                        script,
-                    )
-                    assert not any(
-                        exist.matches(
-                            language=job.language,
-                            version=job.version,
-                            platform=job.platform,
-                            env=job.env,
-                            script=job.script,
-                        )
-                        for exist in self.jobs
-                    ), f"included job #{idx} already exists"
-
+                    attrs = {
+                        "name": name,
+                        "language": language,
+                        "version": version,
+                        "platform": platform,
+                        "env": env,
+                        "script": script,
+                        "secrets": [],
+                        "shards": include.get("shard", 1),
+                    }
                     if "secrets" in include:
-                        job.secrets.extend(self._parse_secrets(include["secrets"]))
+                        attrs["secrets"].extend(self._parse_secrets(include["secrets"]))
+
+                    all_passed = include.get("when", {}).get("all_passed")
+                    if "needs" in include:
+                        attrs["needs"] = [
+                            {"name": need} if isinstance(need, str) else need
+                            for need in include["needs"]
+                        ]
+                        # jobs with `needs` aren't in a stage, so `all_passed` only
+                        # says whether the needed jobs must pass (the default)
+                        attrs["previous_pass"] = all_passed is not False
+                    elif all_passed is not None:
+                        attrs["stage"] = 2
+                        attrs["previous_pass"] = all_passed
 
-                    if include.get("when", {}).get("all_passed") is not None:
-                        job.stage = 2
-                        job.require_previous_stage_pass = include["when"]["all_passed"]
+                    self._includes.append((idx, attrs))
 
-                    self.jobs.append(job)
+        needs = [need for _, attrs in self._includes for need in attrs.get("needs", ())]
+        if needs:
+            self.needed = JobMatcher(needs)
+
+        self._validate()
 
         # check for any unused matrix values and print a warning
         unused = given - used
@@ -714,8 +917,165 @@ class CIMatrix:
                 "', '".join(sorted(missing)),
             )
 
-        for job in self.jobs:
+    def _product_jobs(self, platform, version):
+        """Jobs from the product with a given platform and version (not excluded).
+
+        Arguments:
+            platform (str): Platform of jobs to yield.
+            version (str): Version of jobs to yield.
+
+        Yields:
+            MatrixJob: Jobs in the product.
+        """
+        language, _, _, envs, scripts, global_env, shards = self._product
+        for env, script in product(envs, scripts):
+            local_env = global_env.copy()
+            local_env.update(env)
+            job = MatrixJob(
+                None, language, version, platform, local_env, script, shards=shards
+            )
+            if self._exclude is None or not self._exclude.matches(job):
+                yield job
+
+    def _iter_product(self):
+        """Jobs from the product (not excluded), in order.
+
+        Yields:
+            MatrixJob: Jobs in the product.
+        """
+        if self._product is not None:
+            platforms, versions = self._product[1:3]
+            for platform, version in product(platforms, versions):
+                yield from self._product_jobs(platform, version)
+
+    def _include_job(self, attrs):
+        """Create the job for an include.
+
+        Arguments:
+            attrs (dict): Parsed attributes of the include.
+
+        Returns:
+            MatrixJob: Included job.
+        """
+        job = MatrixJob(
+            attrs["name"],
+            attrs["language"],
+            attrs["version"],
+            attrs["platform"],
+            attrs["env"].copy(),
+            attrs["script"].copy(),
+            stage=attrs.get("stage", 1),
+            previous_pass=attrs.get("previous_pass", False),
+            needs=attrs.get("needs"),
+            shards=attrs["shards"],
+        )
+        job.secrets.extend(attrs["secrets"])
+        return job
+
+    def _validate(self):
+        """Check every job the matrix expands to, without expanding it.
+
+        Jobs from the product are already valid according to the schema, except for
+        the language/platform/version, which is looked up in `IMAGES`. Only
+        combinations not in `IMAGES` are expanded, to check that every such job is
+        excluded. Included jobs are checked, and must not repeat a job from the
+        product or an earlier include. The `needs` of each job must match some other
+        job.
+
+        Returns:
+            None
+        """
+        if self._product is not None:
+            language, platforms, versions = self._product[:3]
+            for platform, version in product(platforms, versions):
+                if (language, platform, version) not in IMAGES:
+                    for job in self._product_jobs(platform, version):
+                        # raises a specific error
+                        job.check()
+        existing = JobIndex()
+        included = []
+        for idx, attrs in self._includes:
+            job = self._include_job(attrs)
             job.check()
+            duplicate = job in existing or self._in_product(job)
+            assert not duplicate, f"included job #{idx} already exists"
+            existing.add(job)
+            included.append(job)
+        for job in included:
+            if job.needs:
+                matcher = JobMatcher(job.needs)
+                assert any(
+                    other is not job and matcher.matches(other)
+                    for other in chain(self._iter_product(), included)
+                ), f"`needs` for job {job.name} does not match any jobs"
+
+    def _in_product(self, job):
+        """Check whether a job is already covered by a job from the product.
+
+        Arguments:
+            job (MatrixJob): Job to look for.
+
+        Returns:
+            bool: True if a job in the product (not excluded) matches `job`.
+        """
+        if self._product is None:
+            return False
+        language, platforms, versions, _, scripts = self._product[:5]
+        if (
+            job.language != language
+            or job.platform not in platforms
+            or job.version not in versions
+            or job.script not in scripts
+        ):
+            return False
+        return any(
+            job.script == other.script and job.env.items() <= other.env.items()
+            for other in self._product_jobs(job.platform, job.version)
+        )
+
+    def iter_jobs(self):
+        """Expand the matrix, one job at a time.
+
+        Excludes are applied as the product is enumerated, so excluded jobs are never
+        kept. Every job was already checked when the matrix was parsed, so a job is
+        never yielded unless the whole matrix is valid.
+
+        Yields:
+            MatrixJob: CI jobs to run, in the same order as `jobs`.
+        """
+        if self._product is not None:
+            count = 0
+            for job in self._iter_product():
+                count += 1
+                yield job
+            LOG.debug("product created %d jobs after exclude", count)
+
+        for _, attrs in self._includes:
+            yield self._include_job(attrs)
+
+    def images(self):
+        """Get the Orion images that jobs in this matrix may use, without expanding
+        the matrix.
+
+        Excludes are not considered, so this may include images that no job uses.
+        Language/platform/version combinations not in `IMAGES` are skipped (only
+        excluded jobs can use them).
+
+        Returns:
+            set(tuple(str, str)): Platform and image name.
+        """
+        combos = set()
+        if self._product is not None:
+            language, platforms, versions = self._product[:3]
+            combos.update(
+                (language, platform, version)
+                for platform, version in product(platforms, versions)
+            )
+        combos.update(
+            (attrs["language"], attrs["platform"], attrs["version"])
+            for _, attrs in self._includes
+        )
+        return {(combo[1], IMAGES[combo]) for combo in combos if combo in IMAGES}
 
     def _parse_secrets(self, secrets):
         for secret in secrets:
@@ -728,6 +1088,7 @@ def _load_schema_cache():
     for path in (Path(__file__).parent / "schemas").glob("*.yaml"):
         schema = yaml_load(path.read_text())
         SCHEMA_CACHE[schema["$id"]] = schema
+        SCHEMAS[schema["title"]] = schema
 
 
 def _validate_globals():
@@ -3,17 +3,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Scheduler for CI tasks"""
+
 from itertools import chain
 from json import dumps as json_dump
 from logging import getLogger
 from pathlib import Path
-from string import Template
 
 from taskcluster.exceptions import TaskclusterFailure
 from taskcluster.utils import slugId, stringDate
-from yaml import safe_load as yaml_load
 
 from . import (
+    ARTIFACTS_EXPIRE,
     DEADLINE,
     MAX_RUN_TIME,
     PROVISIONER_ID,
@@ -23,17 +23,26 @@ from . import (
     WORKER_TYPE_MSYS,
     Taskcluster,
 )
-from .ci_matrix import CIMatrix, CISecretKey
+from .ci_matrix import CIMatrix, CISecretKey, JobMatcher
+from .ci_shard import TIMINGS_ARTIFACT, history_namespace
 from .git import GithubEvent
+from .index import IndexResolver
+from .profiling import PROFILER
+from .submit import TaskSubmitter
+from .template import TaskTemplate
 
 LOG = getLogger(__name__)
 TEMPLATE_PATH = (Path(__file__).parent / "task_templates").resolve()
 TEMPLATES = {}
-TEMPLATES["linux"] = Template((TEMPLATE_PATH / "ci-linux.yaml").read_text())
-TEMPLATES["windows"] = Template((TEMPLATE_PATH / "ci-windows.yaml").read_text())
+TEMPLATES["linux"] = TaskTemplate.from_file(TEMPLATE_PATH / "ci-linux.yaml")
+TEMPLATES["windows"] = TaskTemplate.from_file(TEMPLATE_PATH / "ci-windows.yaml")
 WORKER_TYPES = {}
 WORKER_TYPES["linux"] = WORKER_TYPE
 WORKER_TYPES["windows"] = WORKER_TYPE_MSYS
+# where sharded jobs write test timings, to be uploaded as `TIMINGS_ARTIFACT`
+TIMINGS_PATHS = {}
+TIMINGS_PATHS["linux"] = "/tmp/test-timings.json"
+TIMINGS_PATHS["windows"] = "test-timings.json"
 
 
 class CIScheduler:
@@ -50,7 +59,15 @@ class CIScheduler:
     """
 
     def __init__(
-        self, project_name, github_event, now, task_group, matrix, dry_run=False
+        self,
+        project_name,
+        github_event,
+        now,
+        task_group,
+        matrix,
+        dry_run=False,
+        submit_concurrency=1,
+        index_cache=None,
     ):
         """Initialize a CIScheduler object.
 
@@ -62,110 +79,287 @@ class CIScheduler:
             matrix (CIMatrix): CI job matrix
             dry_run (bool): Calculate what should be created, but don't actually
                             create tasks in Taskcluster.
+            submit_concurrency (int): Maximum number of tasks to submit at once.
+            index_cache (Path or None): File to cache index lookups in between runs.
         """
         self.project_name = project_name
         self.github_event = github_event
         self.now = now
         self.task_group = task_group
         self.dry_run = dry_run
-        self.matrix = CIMatrix(
-            matrix,
-            github_event.branch,
-            github_event.event_type,
+        self._submitter = TaskSubmitter(
+            submit_concurrency, lambda: Taskcluster.get_service("queue")
+        )
+        self._resolver = IndexResolver(
+            index_cache,
+            max_workers=submit_concurrency,
+            index_factory=lambda: Taskcluster.get_service("index"),
         )
+        with PROFILER.phase("matrix"):
+            self.matrix = CIMatrix(
+                matrix,
+                github_event.branch,
+                github_event.event_type,
+            )
 
     def create_tasks(self):
         """Create CI tasks in Taskcluster.
 
+        Jobs in the first stage don't depend on any others, so they are created as the
+        matrix is expanded. Jobs in later stages depend on every job in the stage
+        before. Jobs with `needs` are not in any stage: they depend only on the jobs
+        they select, and no stage depends on them. These are held until the matrix is
+        complete. Jobs with `shards` are created as one task
+        per shard, and anything depending on the job depends on all of them.
+
         Returns:
             None
         """
-        job_tasks = {id(job): slugId() for job in self.matrix.jobs}
+        # resolve the MSYS images for all windows jobs up front
+        with PROFILER.phase("artifact_lookup"):
+            self._resolver.prefetch(
+                self._msys_namespace(image)
+                for platform, image in self.matrix.images()
+                if platform == "windows"
+            )
+        needed = self.matrix.needed
+        # (job, task_ids) for each job selected by the `needs` of another job
+        selected = []
         prev_stage = []
-        for stage in sorted(set(job.stage for job in self.matrix.jobs)):
-            this_stage = []
-            for job in self.matrix.jobs:
-                if job.stage != stage:
-                    continue
-                task_id = job_tasks[id(job)]
-                this_stage.append(task_id)
-                has_deploy_key = any(
-                    isinstance(sec, CISecretKey) and sec.hostname is None
-                    for sec in chain(self.matrix.secrets, job.secrets)
-                )
-                if has_deploy_key:
-                    clone_repo = self.github_event.ssh_url
-                else:
-                    clone_repo = self.github_event.http_url
-                job_ser = job.serialize()
-                job_ser["secrets"].extend(
-                    secret.serialize() for secret in self.matrix.secrets
-                )
-                # set CI environment vars for compatibility with eg. codecov
-                job_ser["env"].update(
-                    {
-                        "CI": "true",
-                        "CI_BUILD_ID": self.task_group,
-                        "CI_BUILD_URL": f"{TASKCLUSTER_ROOT_URL}/tasks/{task_id}",
-                        "CI_JOB_ID": task_id,
-                        "VCS_BRANCH_NAME": self.github_event.branch,
-                        "VCS_COMMIT_ID": self.github_event.commit,
-                        "VCS_PULL_REQUEST": str(
-                            self.github_event.pull_request or "false"
-                        ),
-                        "VCS_SLUG": self.github_event.repo_slug,
-                        "VCS_TAG": self.github_event.tag or "",
-                    }
+        later_stages = {}
+        needs_jobs = []
+        for job in self.matrix.iter_jobs():
+            if job.needs:
+                needs_jobs.append(job)
+            elif job.stage == 1:
+                task_ids = self._create_job_tasks(job, [])
+                prev_stage.extend(task_ids)
+                if needed is not None and needed.matches(job):
+                    selected.append((job, task_ids))
+            else:
+                later_stages.setdefault(job.stage, []).append(job)
+        for stage in sorted(later_stages):
+            prev_stage_ids, prev_stage = prev_stage, []
+            for job in later_stages[stage]:
+                task_ids = self._create_job_tasks(job, prev_stage_ids)
+                prev_stage.extend(task_ids)
+                if needed is not None and needed.matches(job):
+                    selected.append((job, task_ids))
+        if needs_jobs:
+            self._create_needs_tasks(needs_jobs, selected)
+        self._submitter.wait()
+        self._resolver.save()
+
+    def _create_needs_tasks(self, jobs, selected):
+        """Create tasks for jobs with `needs`, after the jobs they depend on.
+
+        Arguments:
+            jobs (list(MatrixJob)): Jobs with `needs`.
+            selected (list(tuple(MatrixJob, list(str)))): Jobs already created which
+                                                          match any `needs`, and
+                                                          their task IDs.
+
+        Returns:
+            None
+        """
+        # jobs with needs can depend on each other, so assign all task IDs first
+        task_ids = [[slugId() for _ in range(job.shards)] for job in jobs]
+        # task ID -> index in `jobs`
+        owners = {task_id: idx for idx, ids in enumerate(task_ids) for task_id in ids}
+        needed = self.matrix.needed
+        selected = selected + [
+            (job, ids) for job, ids in zip(jobs, task_ids) if needed.matches(job)
+        ]
+        dependencies = []
+        for job, ids in zip(jobs, task_ids):
+            matcher = JobMatcher(job.needs)
+            dependencies.append(
+                [
+                    other_id
+                    for other, other_ids in selected
+                    if other_ids is not ids and matcher.matches(other)
+                    for other_id in other_ids
+                ]
+            )
+        pending = dict(enumerate(jobs))
+        while pending:
+            ready = [
+                idx
+                for idx in pending
+                if all(owners.get(dep) not in pending for dep in dependencies[idx])
+            ]
+            assert ready, "cycle in `needs` for jobs: " + ", ".join(
+                sorted(job.name for job in pending.values())
+            )
+            for idx in ready:
+                self._create_job_tasks(
+                    pending.pop(idx), dependencies[idx], task_ids=task_ids[idx]
                 )
-                kwds = {
-                    # need to json.dump twice so we get a string literal in the yaml
-                    # template. otherwise (since it's yaml) it would be interpreted
-                    # as an object.
-                    "ci_job": json_dump(json_dump(job_ser)),
-                    "clone_repo": clone_repo,
-                    "deadline": stringDate(self.now + DEADLINE),
-                    "fetch_ref": self.github_event.fetch_ref,
-                    "fetch_rev": self.github_event.commit,
-                    "http_repo": self.github_event.http_url,
-                    "max_run_time": int(MAX_RUN_TIME.total_seconds()),
-                    "name": job.name,
-                    "now": stringDate(self.now),
-                    "project": self.project_name,
-                    "provisioner": PROVISIONER_ID,
-                    "scheduler": SCHEDULER_ID,
-                    "task_group": self.task_group,
-                    "user": self.github_event.user,
-                    "worker": WORKER_TYPES[job.platform],
-                }
-                if job.platform == "windows":
-                    # need to resolve "image" to a task ID where the MSYS
-                    # artifact is
-                    idx = Taskcluster.get_service("index")
-                    result = idx.findTask(f"project.fuzzing.orion.{job.image}.master")
-                    kwds["msys_task"] = result["taskId"]
-                else:
-                    kwds["image"] = job.image
-                task = yaml_load(TEMPLATES[job.platform].substitute(**kwds))
-                # if any secrets exist, use the proxy and request scopes
-                if job.secrets or self.matrix.secrets:
-                    task["payload"].setdefault("features", {})
-                    task["payload"]["features"]["taskclusterProxy"] = True
-                    for sec in chain(job.secrets, self.matrix.secrets):
-                        task["scopes"].append(f"secrets:get:{sec.secret}")
-                    # ensure scopes are unique
-                    task["scopes"] = list(set(task["scopes"]))
-                if not job.require_previous_stage_pass:
-                    task["requires"] = "all-resolved"
-                task["dependencies"].extend(prev_stage)
-                LOG.info("task %s: %s", task_id, task["metadata"]["name"])
-                if not self.dry_run:
+
+    def _create_job_tasks(self, job, dependencies, task_ids=None):
+        """Create the tasks for a CI job (one per shard).
+
+        Sharded jobs are given the tasks which ran each shard last, so the tests can
+        be balanced using the timings they recorded.
+
+        Arguments:
+            job (MatrixJob): Job to create tasks for.
+            dependencies (list(str)): Task IDs the job depends on.
+            task_ids (list(str)/None): Task IDs to use (one per shard), or None to
+                                       generate them.
+
+        Returns:
+            list(str): Task IDs of the created tasks.
+        """
+        if task_ids is None:
+            task_ids = [slugId() for _ in range(job.shards)]
+        assert len(task_ids) == job.shards
+        history = []
+        namespaces = [None] * job.shards
+        if job.shards > 1:
+            namespaces = [
+                history_namespace(self.github_event.repo_slug, job, shard)
+                for shard in range(1, job.shards + 1)
+            ]
+            with PROFILER.phase("artifact_lookup"):
+                self._resolver.prefetch(namespaces)
+                for namespace in namespaces:
                     try:
-                        Taskcluster.get_service("queue").createTask(task_id, task)
-                    except TaskclusterFailure as exc:  # pragma: no cover
-                        LOG.error("Error creating CI task: %s", exc)
-                        raise
+                        history.append(self._resolver.lookup(namespace))
+                    except TaskclusterFailure:
+                        LOG.debug("No test timings indexed at %s", namespace)
+            LOG.info(
+                "job %s: found test timings for %d of %d shards",
+                job.name,
+                len(history),
+                job.shards,
+            )
+        for shard, (task_id, namespace) in enumerate(zip(task_ids, namespaces), 1):
+            self._create_job_task(job, dependencies, task_id, shard, history, namespace)
+        return task_ids
 
-            prev_stage = this_stage
+    def _create_job_task(
+        self, job, dependencies, task_id, shard=1, history=(), namespace=None
+    ):
+        """Create the task for a CI job (or one shard of it).
+
+        Arguments:
+            job (MatrixJob): Job to create a task for.
+            dependencies (list(str)): Task IDs the job depends on.
+            task_id (str): Task ID to use.
+            shard (int): Shard of `job` to run in this task (starting at 1).
+            history (list(str)): Task IDs with test timings from previous runs.
+            namespace (str/None): Index namespace for the timings of this shard
+                                  (required if `job` is sharded).
+
+        Returns:
+            None
+        """
+        has_deploy_key = any(
+            isinstance(sec, CISecretKey) and sec.hostname is None
+            for sec in chain(self.matrix.secrets, job.secrets)
+        )
+        if has_deploy_key:
+            clone_repo = self.github_event.ssh_url
+        else:
+            clone_repo = self.github_event.http_url
+        job_ser = job.serialize()
+        job_ser["secrets"].extend(secret.serialize() for secret in self.matrix.secrets)
+        name = job.name
+        if job.shards > 1:
+            job_ser["shard"] = shard
+            job_ser["shard_history"] = list(history)
+            job_ser["env"]["CI_SHARD_TIMINGS"] = TIMINGS_PATHS[job.platform]
+            name = f"{job.name} ({shard}/{job.shards})"
+        # set CI environment vars for compatibility with eg. codecov
+        job_ser["env"].update(
+            {
+                "CI": "true",
+                "CI_BUILD_ID": self.task_group,
+                "CI_BUILD_URL": f"{TASKCLUSTER_ROOT_URL}/tasks/{task_id}",
+                "CI_JOB_ID": task_id,
+                "VCS_BRANCH_NAME": self.github_event.branch,
+                "VCS_COMMIT_ID": self.github_event.commit,
+                "VCS_PULL_REQUEST": str(self.github_event.pull_request or "false"),
+                "VCS_SLUG": self.github_event.repo_slug,
+                "VCS_TAG": self.github_event.tag or "",
+            }
+        )
+        kwds = {
+            # need to json.dump twice so we get a string literal in the yaml
+            # template. otherwise (since it's yaml) it would be interpreted
+            # as an object.
+            "ci_job": json_dump(json_dump(job_ser)),
+            "clone_repo": clone_repo,
+            "deadline": stringDate(self.now + DEADLINE),
+            "fetch_ref": self.github_event.fetch_ref,
+            "fetch_rev": self.github_event.commit,
+            "http_repo": self.github_event.http_url,
+            "max_run_time": int(MAX_RUN_TIME.total_seconds()),
+            "name": name,
+            "now": stringDate(self.now),
+            "project": self.project_name,
+            "provisioner": PROVISIONER_ID,
+            "scheduler": SCHEDULER_ID,
+            "task_group": self.task_group,
+            "user": self.github_event.user,
+            "worker": WORKER_TYPES[job.platform],
+        }
+        if job.platform == "windows":
+            # need to resolve "image" to a task ID where the MSYS
+            # artifact is
+            kwds["msys_task"] = self._resolver.lookup(self._msys_namespace(job.image))
+        else:
+            kwds["image"] = job.image
+        with PROFILER.phase("render"):
+            task = TEMPLATES[job.platform].fill(**kwds)
+        # if any secrets exist, use the proxy and request scopes
+        if job.secrets or self.matrix.secrets:
+            task["payload"].setdefault("features", {})
+            task["payload"]["features"]["taskclusterProxy"] = True
+            for sec in chain(job.secrets, self.matrix.secrets):
+                task["scopes"].append(f"secrets:get:{sec.secret}")
+            # ensure scopes are unique
+            task["scopes"] = list(set(task["scopes"]))
+        if not job.require_previous_stage_pass:
+            task["requires"] = "all-resolved"
+        task["dependencies"].extend(dependencies)
+        if job.shards > 1:
+            self._add_timings(task, job, namespace)
+        LOG.info("task %s: %s", task_id, task["metadata"]["name"])
+        if not self.dry_run:
+            self._submitter.submit(task_id, task)
+
+    def _add_timings(self, task, job, namespace):
+        """Upload the test timings written by a shard, and index them for the
+        next run (on push only, so pull requests don't replace the history).
+
+        Arguments:
+            task (dict): Task definition for the shard.
+            job (MatrixJob): Job the shard belongs to.
+            namespace (str): Index namespace the next run looks up (see
+                             `history_namespace()`).
+
+        Returns:
+            None
+        """
+        artifact = {
+            "expires": stringDate(self.now + ARTIFACTS_EXPIRE),
+            "path": TIMINGS_PATHS[job.platform],
+            "type": "file",
+        }
+        if job.platform == "windows":
+            # generic-worker takes a list of artifacts
+            artifact["name"] = TIMINGS_ARTIFACT
+            task["payload"].setdefault("artifacts", []).append(artifact)
+        else:
+            task["payload"].setdefault("artifacts", {})[TIMINGS_ARTIFACT] = artifact
+        if self.github_event.event_type == "push":
+            task["routes"].append(f"index.{namespace}")
+
+    @staticmethod
+    def _msys_namespace(image):
+        return f"project.fuzzing.orion.{image}.master"
 
     @classmethod
     def main(cls, args):
@@ -177,8 +371,27 @@ class CIScheduler:
         Returns:
             int: Shell return code.
         """
+        PROFILER.start(cprofile=args.cprofile)
+        try:
+            cls._main(args)
+        finally:
+            PROFILER.stop()
+            if args.profile_output is not None:
+                PROFILER.write(args.profile_output)
+        return 0
+
+    @classmethod
+    def _main(cls, args):
         # get the github event & repo
-        evt = GithubEvent.from_taskcluster(args.github_action, args.github_event)
+        # (the working tree isn't used, only the commit message)
+        with PROFILER.phase("clone"):
+            evt = GithubEvent.from_taskcluster(
+                args.github_action,
+                args.github_event,
+                checkout=False,
+                depth=args.clone_depth,
+                blob_filter=args.clone_filter,
+            )
         try:
             if "[skip ci]" in evt.commit_message or "[skip tc]" in evt.commit_message:
                 LOG.warning(
@@ -195,11 +408,11 @@ class CIScheduler:
                 args.task_group,
                 args.matrix,
                 args.dry_run,
+                args.submit_concurrency,
+                args.index_cache,
             )
 
             # schedule tasks
             sched.create_tasks()
         finally:
             evt.cleanup()
-
-        return 0
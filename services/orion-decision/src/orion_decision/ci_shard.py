@@ -0,0 +1,180 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Test sharding for CI jobs, balanced by timings from previous runs.
+
+A job with `shard: N` is split into N tasks. Each task runs the same script, with
+`CI_SHARD` (1-based) and `CI_SHARD_COUNT` set in the environment. The script is
+expected to collect all tests, then run only those returned by
+`select_tests_from_env()`.
+
+If the script writes the time taken by each test (`{"test id": seconds}`) to the
+file given in `CI_SHARD_TIMINGS`, it is uploaded as an artifact and indexed. The
+next run of the job merges these into a file given in `CI_SHARD_HISTORY`, so tests
+can be balanced by duration. Without history, tests are split evenly.
+
+For pytest, the `orion_decision.pytest_shard` plugin does both.
+"""
+
+from hashlib import sha1
+from heapq import heapify, heapreplace
+from json import dumps as json_dumps
+from json import loads as json_loads
+from logging import getLogger
+from os import getenv
+from pathlib import Path
+
+from taskcluster.exceptions import TaskclusterFailure
+
+from . import Taskcluster
+
+LOG = getLogger(__name__)
+TIMINGS_ARTIFACT = "public/test-timings.json"
+
+
+def job_key(job):
+    """Get a stable key for a job, used to find timings from previous runs.
+
+    Arguments:
+        job (MatrixJob): Job to get a key for.
+
+    Returns:
+        str: Key (usable as an index namespace component).
+    """
+    attrs = {
+        "env": job.env,
+        "language": job.language,
+        "name": job.name,
+        "platform": job.platform,
+        "script": job.script,
+        "version": job.version,
+    }
+    return sha1(json_dumps(attrs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def history_namespace(repo_slug, job, shard):
+    """Get the index namespace where timings for one shard of a job are kept.
+
+    Arguments:
+        repo_slug (str): Github repository (`owner/repo`).
+        job (MatrixJob): Job the shard belongs to.
+        shard (int): Shard number (starting at 1).
+
+    Returns:
+        str: Index namespace.
+    """
+    return (
+        f"project.fuzzing.orion.ci.{repo_slug.replace('/', '.')}"
+        f".{job_key(job)}.shard{shard}"
+    )
+
+
+def balance(durations, shards):
+    """Split tests into shards of roughly equal total duration.
+
+    Tests are assigned longest first, each to the shard with the least total so far.
+    The result is deterministic, so every shard computes the same split.
+
+    Arguments:
+        durations (dict(str -> float)): Expected duration of each test.
+        shards (int): Number of shards.
+
+    Returns:
+        list(list(str)): Tests in each shard.
+    """
+    assert shards >= 1
+    result = [[] for _ in range(shards)]
+    # (total duration, number of tests, shard index)
+    heap = [(0.0, 0, idx) for idx in range(shards)]
+    heapify(heap)
+    for test in sorted(durations, key=lambda test: (-durations[test], test)):
+        total, count, idx = heap[0]
+        result[idx].append(test)
+        heapreplace(heap, (total + durations[test], count + 1, idx))
+    return result
+
+
+def select_tests(tests, shard, shards, history=None):
+    """Select the tests to run in one shard.
+
+    Tests without history are assumed to take the average time of those with
+    history. If there is no history at all, tests are split evenly.
+
+    Arguments:
+        tests (iterable(str)): All tests in the job.
+        shard (int): Shard number (starting at 1).
+        shards (int): Number of shards.
+        history (dict(str -> float)/None): Duration of tests from previous runs.
+
+    Returns:
+        list(str): Tests to run in this shard, in the order given.
+    """
+    assert 1 <= shard <= shards
+    tests = list(tests)
+    history = {test: history[test] for test in tests if test in (history or {})}
+    if history:
+        default = sum(history.values()) / len(history)
+    else:
+        default = 1.0
+    durations = {test: history.get(test, default) for test in tests}
+    selected = set(balance(durations, shards)[shard - 1])
+    return [test for test in tests if test in selected]
+
+
+def select_tests_from_env(tests):
+    """Select the tests to run in this task, using the environment set by
+    `ci-launch`. If the job is not sharded, all tests are selected.
+
+    Arguments:
+        tests (iterable(str)): All tests in the job.
+
+    Returns:
+        list(str): Tests to run in this task, in the order given.
+    """
+    shard = int(getenv("CI_SHARD", "1"))
+    shards = int(getenv("CI_SHARD_COUNT", "1"))
+    history = None
+    if getenv("CI_SHARD_HISTORY"):
+        history = json_loads(Path(getenv("CI_SHARD_HISTORY")).read_text())
+    return select_tests(tests, shard, shards, history)
+
+
+def _valid_timings(data):
+    return isinstance(data, dict) and all(
+        isinstance(test, str)
+        and isinstance(duration, (int, float))
+        and not isinstance(duration, bool)
+        and duration >= 0
+        for test, duration in data.items()
+    )
+
+
+def load_history(task_ids, queue=None):
+    """Fetch and merge the test timings uploaded by previous runs.
+
+    Missing or invalid timings are skipped, since the tests can still be split
+    without them.
+
+    Arguments:
+        task_ids (list(str)): Tasks with a `TIMINGS_ARTIFACT`.
+        queue (taskcluster.Queue/None): Queue client (default: create one).
+
+    Returns:
+        dict(str -> float): Duration of each test. Later tasks take precedence.
+    """
+    if queue is None:
+        queue = Taskcluster.get_service("queue")
+    result = {}
+    for task_id in task_ids:
+        try:
+            data = queue.getLatestArtifact(task_id, TIMINGS_ARTIFACT)
+        except TaskclusterFailure as exc:
+            LOG.warning("Couldn't fetch test timings from %s: %s", task_id, exc)
+            continue
+        if not _valid_timings(data):
+            LOG.warning("Ignoring invalid test timings from %s", task_id)
+            continue
+        result.update(data)
+    LOG.info("Loaded timings for %d tests from %d tasks", len(result), len(task_ids))
+    return result
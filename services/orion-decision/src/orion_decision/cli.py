@@ -6,21 +6,25 @@
 import sys
 from argparse import ArgumentParser
 from datetime import datetime
+from json import dumps as json_dumps
 from locale import LC_ALL, setlocale
 from logging import DEBUG, INFO, WARN, basicConfig, getLogger
-from os import chdir
+from os import chdir, cpu_count
 from os import environ as os_environ
 from os import getenv
 from pathlib import Path
 from shutil import which
 from subprocess import run
+from tempfile import gettempdir
 
 from dateutil.parser import isoparse
 from yaml import safe_load as yaml_load
 
+from .cache import GraphCache
 from .ci_check import check_matrix
 from .ci_matrix import CISecretEnv, MatrixJob
 from .ci_scheduler import CIScheduler
+from .ci_shard import load_history
 from .git import GitRepo
 from .orion import Services
 from .scheduler import Scheduler
@@ -81,6 +85,19 @@ def _define_github_args(parser):
         choices={"github-push", "github-pull-request", "github-release"},
         help="The event action that triggered this decision.",
     )
+    parser.add_argument(
+        "--clone-depth",
+        default=getenv("CLONE_DEPTH"),
+        type=int,
+        help="Make a shallow clone of this depth, deepened as needed to find the "
+        "start of the commit range (default: CLONE_DEPTH, or full history).",
+    )
+    parser.add_argument(
+        "--clone-filter",
+        default=getenv("CLONE_FILTER"),
+        help="Make a partial clone using this object filter, eg. `blob:none` "
+        "(default: CLONE_FILTER, or fetch all objects).",
+    )
 
 
 def _sanity_check_github_args(parser, result):
@@ -110,6 +127,43 @@ def _define_decision_args(parser):
         action="store_true",
         help="Do not queue tasks in Taskcluster, only calculate what would be done.",
     )
+    parser.add_argument(
+        "--submit-concurrency",
+        default=getenv("SUBMIT_CONCURRENCY", "8"),
+        type=int,
+        help="Maximum number of tasks to submit to Taskcluster at once "
+        "(default: SUBMIT_CONCURRENCY, or 8).",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default=getenv("PROFILE_OUTPUT"),
+        type=Path,
+        help="Write phase timings and counters for this run to a JSON file "
+        "(default: PROFILE_OUTPUT, or not written).",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=bool(getenv("CPROFILE")),
+        help="Include a cProfile summary in --profile-output (default: CPROFILE).",
+    )
+
+
+def _define_services_args(parser):
+    parser.add_argument(
+        "--graph-cache",
+        default=getenv("GRAPH_CACHE"),
+        type=Path,
+        help="File to cache service graph calculations in between runs "
+        "(default: GRAPH_CACHE, or no cache).",
+    )
+    parser.add_argument(
+        "--scan-workers",
+        default=getenv("SCAN_WORKERS", str(cpu_count() or 1)),
+        type=int,
+        help="Number of processes used to scan files for service dependencies "
+        "(default: SCAN_WORKERS, or number of CPUs).",
+    )
 
 
 def parse_args(argv=None):
@@ -125,7 +179,42 @@ def parse_args(argv=None):
     _define_logging_args(parser)
     _define_github_args(parser)
     _define_decision_args(parser)
+    _define_services_args(parser)
 
+    parser.add_argument(
+        "--no-checkout",
+        dest="checkout",
+        action="store_false",
+        help="Don't check out the repository, read service files from the git "
+        "object database instead.",
+    )
+    parser.add_argument(
+        "--no-build-reuse",
+        dest="reuse_builds",
+        action="store_false",
+        help="Always build dirty services, even if an image with the same inputs "
+        "was already built.",
+    )
+    parser.add_argument(
+        "--no-build-history",
+        dest="build_history",
+        action="store_false",
+        help="Don't look up previous build times to prioritize the critical path.",
+    )
+    parser.add_argument(
+        "--batch-builds",
+        action="store_true",
+        default=bool(getenv("BATCH_BUILDS")),
+        help="Build chains of quick dependent services in a single task "
+        "(default: BATCH_BUILDS).",
+    )
+    parser.add_argument(
+        "--no-cancel-superseded",
+        dest="cancel_superseded",
+        action="store_false",
+        help="Don't cancel unfinished tasks from the previous decision for the same "
+        "pull request or branch.",
+    )
     parser.add_argument(
         "--push-branch",
         default=getenv("PUSH_BRANCH", "master"),
@@ -153,6 +242,7 @@ def parse_check_args(argv=None):
     """
     parser = ArgumentParser(prog="orion-check")
     _define_logging_args(parser)
+    _define_services_args(parser)
     parser.add_argument(
         "repo",
         type=Path,
@@ -164,6 +254,10 @@ def parse_check_args(argv=None):
         nargs="*",
         help="Changed path(s)",
     )
+    parser.add_argument(
+        "--revision",
+        help="Read service files from this git revision instead of the working tree.",
+    )
     return parser.parse_args(argv)
 
 
@@ -257,6 +351,13 @@ def parse_ci_args(argv=None):
         default=getenv("PROJECT_NAME"),
         help="The human readable project name for CI",
     )
+    parser.add_argument(
+        "--index-cache",
+        default=getenv("INDEX_CACHE"),
+        type=Path,
+        help="File to cache Taskcluster index lookups in between runs "
+        "(default: INDEX_CACHE, or no cache).",
+    )
 
     result = parser.parse_args(argv)
     _sanity_check_github_args(parser, result)
@@ -293,6 +394,21 @@ def ci_launch():
             )
         else:
             secret.write()
+    timings = None
+    if args.job.shards > 1:
+        LOG.info("Running shard %d of %d", args.job.shard, args.job.shards)
+        history = Path(gettempdir()) / "test-history.json"
+        history.write_text(json_dumps(load_history(args.job.shard_history)))
+        # relative to the task directory, not the repo
+        timings = Path(args.job.env["CI_SHARD_TIMINGS"]).resolve()
+        args.job.env.update(
+            {
+                "CI_SHARD": str(args.job.shard),
+                "CI_SHARD_COUNT": str(args.job.shards),
+                "CI_SHARD_HISTORY": str(history),
+                "CI_SHARD_TIMINGS": str(timings),
+            }
+        )
     # clone repo
     LOG.info("Cloning repo: %s @ %s", args.clone_repo, args.fetch_rev)
     repo = GitRepo(args.clone_repo, args.fetch_ref, args.fetch_rev)
@@ -307,7 +423,14 @@ def ci_launch():
             binary is not None
         ), f"Couldn't resolve script executable: {args.job.script[0]}"
         args.job.script[0] = binary
-    sys.exit(run(args.job.script, env=env, check=True).returncode)
+    try:
+        result = run(args.job.script, env=env, check=True)
+    finally:
+        # the artifact must exist, or the task fails even if the tests passed
+        if timings is not None and not timings.is_file():
+            LOG.warning("No test timings written to %s", timings)
+            timings.write_text("{}")
+    sys.exit(result.returncode)
 
 
 def ci_check():
@@ -322,7 +445,15 @@ def check():
     """Service definition check entrypoint."""
     args = parse_check_args()
     configure_logging(level=args.log_level)
-    svcs = Services(GitRepo.from_existing(args.repo))
+    cache = None
+    if args.graph_cache is not None:
+        cache = GraphCache(args.graph_cache)
+    svcs = Services(
+        GitRepo.from_existing(args.repo),
+        cache=cache,
+        workers=args.scan_workers,
+        revision=args.revision,
+    )
     svcs.mark_changed_dirty([args.repo / file for file in args.changed])
     sys.exit(0)
 
@@ -0,0 +1,161 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Minimal Dockerfile parsing for Orion service dependencies"""
+import re
+from json import loads as json_loads
+
+# parser directives must come before any other line, including comments
+DIRECTIVE = re.compile(r"#\s*(\w+)\s*=\s*(\S+)\s*$")
+# $NAME, ${NAME}, ${NAME:-default}, ${NAME:+alternate}
+VARIABLE = re.compile(r"\$(?:(\w+)|\{(\w+)(?::([-+])([^}]*))?\})")
+
+
+def _substitute(value, args):
+    """Expand ARG references in a value, as Docker does for `FROM`.
+
+    Arguments:
+        value (str): Value to expand.
+        args (dict(str -> str or None)): Known ARG values.
+
+    Returns:
+        str: The value with references replaced.
+    """
+
+    def _replace(match):
+        current = args.get(match.group(1) or match.group(2))
+        if match.group(3) == "-":
+            return current or match.group(4)
+        if match.group(3) == "+":
+            return match.group(4) if current else ""
+        return current or ""
+
+    return VARIABLE.sub(_replace, value)
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        return value[1:-1]
+    return value
+
+
+def instructions(text):
+    """Split a Dockerfile into instructions.
+
+    Comments and blank lines are skipped, and continuation lines are joined.
+
+    Arguments:
+        text (str): Dockerfile contents.
+
+    Yields:
+        tuple(str, str): Instruction (uppercase) and its arguments.
+    """
+    escape = "\\"
+    lines = text.splitlines()
+    for line in lines:
+        match = DIRECTIVE.match(line.strip())
+        if match is None:
+            break
+        if match.group(1).lower() == "escape":
+            escape = match.group(2)
+    current = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.endswith(escape):
+            current.append(line[: -len(escape)])
+            continue
+        current.append(line)
+        parts = " ".join(current).split(None, 1)
+        current = []
+        yield parts[0].upper(), parts[1] if len(parts) > 1 else ""
+    if current:
+        parts = " ".join(current).split(None, 1)
+        yield parts[0].upper(), parts[1] if len(parts) > 1 else ""
+
+
+def dockerfile_images(data):
+    """Find all images a Dockerfile is built from.
+
+    This includes the `FROM` image of every stage and any image used in
+    `COPY --from`, but not references to earlier stages. ARGs declared before the
+    first `FROM` are expanded using their default values.
+
+    Arguments:
+        data (bytes or str): Dockerfile contents.
+
+    Returns:
+        list(str): Image references, in order of first use.
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    args = {}
+    # names and indices of stages defined so far
+    stages = set()
+    n_stages = 0
+    result = []
+
+    def _add(image):
+        if image.lower() in stages or image == "scratch" or image in result:
+            return
+        result.append(image)
+
+    for inst, value in instructions(data):
+        if inst == "ARG" and not n_stages:
+            for arg in value.split():
+                name, sep, default = arg.partition("=")
+                args[name] = _unquote(default) if sep else args.get(name)
+        elif inst == "FROM":
+            tokens = [token for token in value.split() if not token.startswith("--")]
+            if not tokens:
+                continue
+            _add(_substitute(tokens[0], args))
+            stages.add(str(n_stages))
+            n_stages += 1
+            if len(tokens) >= 3 and tokens[1].lower() == "as":
+                stages.add(tokens[2].lower())
+        elif inst == "COPY":
+            for token in value.split():
+                if not token.startswith("--"):
+                    break
+                if token.startswith("--from="):
+                    _add(_unquote(token[len("--from=") :]))
+    return result
+
+
+def dockerfile_sources(data):
+    """Find the build context paths a Dockerfile copies into the image.
+
+    These are the sources of every `COPY` and `ADD` instruction, except those
+    copying from another image or stage (`--from`).
+
+    Arguments:
+        data (bytes or str): Dockerfile contents.
+
+    Returns:
+        list(str): Sources (paths or patterns relative to the build context, or URLs
+                   for `ADD`), in order of first use.
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    result = []
+    for inst, value in instructions(data):
+        if inst not in {"ADD", "COPY"}:
+            continue
+        flags = []
+        while value.startswith("--"):
+            flag, _, value = value.partition(" ")
+            flags.append(flag)
+            value = value.lstrip()
+        if any(flag.startswith("--from=") for flag in flags):
+            continue
+        if value.startswith("["):
+            args = json_loads(value)
+        else:
+            args = value.split()
+        for source in args[:-1]:
+            if source not in result:
+                result.append(source)
+    return result
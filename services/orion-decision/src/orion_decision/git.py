@@ -3,10 +3,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Git/Github utilities for Orion tasks"""
+from fnmatch import fnmatchcase
+from itertools import repeat
 from logging import getLogger
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from shutil import rmtree
-from subprocess import PIPE, CalledProcessError, run
+from subprocess import PIPE, CalledProcessError, Popen, run
 from tempfile import mkdtemp
 from time import sleep
 
@@ -28,21 +30,45 @@ class GitRepo:
         path (Path): The location where the repository is cloned.
     """
 
-    __slots__ = ("path", "_cloned")
-
-    def __init__(self, clone_url, clone_ref, commit, _clone=True):
+    __slots__ = ("path", "_batch", "_blob_filter", "_cloned", "_depth", "_refs")
+
+    def __init__(
+        self,
+        clone_url,
+        clone_ref,
+        commit,
+        _clone=True,
+        checkout=True,
+        depth=None,
+        blob_filter=None,
+    ):
         """Initialize a GitRepo instance.
 
         Arguments:
             clone_url (str): The location to clone the repository from.
-            clone_ref (str): The reference to fetch. (eg. branch).
+            clone_ref (str or list(str)): The reference(s) to fetch. (eg. branch).
+                                          All references are fetched in one request.
             commit (str): Commit to checkout (must be `FETCH_HEAD` or an ancestor).
+            checkout (bool): Check out the working tree. If False, `HEAD` is set to
+                             `commit`, but files must be read using `ls_tree()` and
+                             `read_blob()`.
+            depth (int or None): Create a shallow clone with history truncated to
+                                 this many commits. (see `deepen_to_merge_base()`)
+            blob_filter (str or None): Create a partial clone using this object
+                                       filter (eg. `blob:none`). Missing blobs are
+                                       fetched from the remote when needed.
         """
+        self._batch = None
+        self._blob_filter = blob_filter
         self._cloned = _clone
+        self._depth = depth
+        if isinstance(clone_ref, str):
+            clone_ref = [clone_ref]
+        self._refs = clone_ref
         if _clone:
             self.path = Path(mkdtemp(prefix="decision-repo-"))
             LOG.debug("created git repo tmp folder: %s", self.path)
-            self._clone(clone_url, clone_ref, commit)
+            self._clone(clone_url, commit, checkout)
         else:
             self.path = Path(clone_url)
             LOG.debug("using existing git repo: %s", self.path)
@@ -107,11 +133,155 @@ class GitRepo:
             LOG.error("git command returned error:\n%s", exc.stderr)
             raise
 
-    def _clone(self, clone_url, clone_ref, commit):
+    def _fetch_args(self, depth_arg):
+        args = ["fetch", "-q"]
+        if self._blob_filter is not None:
+            args.append(f"--filter={self._blob_filter}")
+        if depth_arg is not None:
+            args.append(depth_arg)
+        return args + ["origin"] + self._refs
+
+    def _clone(self, clone_url, commit, checkout):
         self.git("init")
         self.git("remote", "add", "origin", clone_url)
-        self.git("fetch", "-q", "origin", clone_ref, tries=RETRIES)
-        self.git("-c", "advice.detachedHead=false", "checkout", commit)
+        if self._blob_filter is not None:
+            self.git("config", "remote.origin.promisor", "true")
+            self.git("config", "remote.origin.partialclonefilter", self._blob_filter)
+        depth_arg = None
+        if self._depth is not None:
+            depth_arg = f"--depth={self._depth}"
+        self.git(*self._fetch_args(depth_arg), tries=RETRIES)
+        if checkout:
+            self.git("-c", "advice.detachedHead=false", "checkout", commit)
+        else:
+            rev = self.git("rev-parse", "--verify", f"{commit}^{{commit}}").strip()
+            self.git("update-ref", "--no-deref", "HEAD", rev)
+            if self._blob_filter is not None:
+                self._fetch_missing(rev)
+
+    def _fetch_missing(self, rev):
+        # A checkout fetches all missing blobs for the tree in one request, but
+        # `read_blob()` would fetch them one at a time, so do it up front.
+        # `--no-walk` lists only the tree of `rev`, not every commit in history.
+        missing = [
+            line[1:]
+            for line in self.git(
+                "rev-list", "--objects", "--missing=print", "--no-walk", rev
+            ).splitlines()
+            if line.startswith("?")
+        ]
+        if not missing:
+            return
+        LOG.debug("fetching %d missing objects for %s", len(missing), rev)
+        run(
+            (
+                "git",
+                "-c",
+                "fetch.negotiationAlgorithm=noop",
+                "fetch",
+                "-q",
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--recurse-submodules=no",
+                f"--filter={self._blob_filter}",
+                "--stdin",
+                "origin",
+            ),
+            check=True,
+            cwd=self.path,
+            input="\n".join(missing) + "\n",
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+        )
+
+    def is_shallow(self):
+        """Check whether this is a shallow clone.
+
+        Returns:
+            bool: True if history is truncated.
+        """
+        return self.git("rev-parse", "--is-shallow-repository").strip() == "true"
+
+    def deepen_to_merge_base(self, base, head):
+        """Deepen a shallow clone until the merge base of two commits is found.
+
+        The history of all fetched references is deepened by the initial clone depth,
+        doubling each time, until `git merge-base` succeeds or the full history has
+        been fetched.
+
+        Arguments:
+            base (str): First commit (eg. the start of a commit range).
+            head (str): Second commit (eg. the end of a commit range).
+
+        Returns:
+            str or None: The merge base, or None if the commits are unrelated.
+        """
+        depth = self._depth or 1
+        while True:
+            result = run(
+                ("git", "merge-base", base, head),
+                cwd=self.path,
+                stdout=PIPE,
+                stderr=PIPE,
+                universal_newlines=True,
+            )
+            if result.returncode == 0:
+                return result.stdout.strip()
+            if not self.is_shallow():
+                LOG.warning("no merge base found for %s and %s", base, head)
+                return None
+            LOG.info("no merge base of %s and %s, deepening by %d", base, head, depth)
+            self.git(*self._fetch_args(f"--deepen={depth}"), tries=RETRIES)
+            depth *= 2
+
+    def ls_tree(self, rev="HEAD"):
+        """List the files in a git revision, without using the working tree.
+
+        Arguments:
+            rev (str): The revision to list.
+
+        Yields:
+            tuple(str, str): Path (relative to the repository root) and blob SHA for
+                             each file in the revision.
+        """
+        for entry in self.git("ls-tree", "-r", "-z", "--full-tree", rev).split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            _, obj_type, sha = info.split()
+            if obj_type == "blob":
+                yield path, sha
+
+    def read_blob(self, sha):
+        """Read the contents of a blob from the git object database.
+
+        A single long-lived `git cat-file --batch` process is used for all reads.
+        In a partial clone, missing blobs are fetched from the remote as needed.
+
+        Arguments:
+            sha (str): Blob SHA to read.
+
+        Raises:
+            KeyError: The object doesn't exist.
+
+        Returns:
+            bytes: Contents of the blob.
+        """
+        if self._batch is None:
+            LOG.debug("calling: git cat-file --batch")
+            self._batch = Popen(
+                ("git", "cat-file", "--batch"), stdin=PIPE, stdout=PIPE, cwd=self.path
+            )
+        self._batch.stdin.write(f"{sha}\n".encode("ascii"))
+        self._batch.stdin.flush()
+        header = self._batch.stdout.readline().decode("ascii").split()
+        if len(header) != 3:
+            raise KeyError(f"git object {sha} is {header[-1]}")
+        size = int(header[2])
+        data = self._batch.stdout.read(size)
+        self._batch.stdout.read(1)  # trailing newline
+        return data
 
     def cleanup(self):
         """Clean up any resources held by this instance.
@@ -119,6 +289,11 @@ class GitRepo:
         Returns:
             None
         """
+        if self._batch is not None:
+            self._batch.stdin.close()
+            self._batch.wait()
+            self._batch.stdout.close()
+            self._batch = None
         if self._cloned and self.path is not None:
             rmtree(self.path)
         self.path = None
@@ -135,6 +310,200 @@ class GitRepo:
         return self.git("show", "--shortstat", commit)
 
 
+def _match_parts(parts, pattern):
+    """Match path components against glob pattern components.
+
+    `**` matches zero or more whole components, other components are matched using
+    `fnmatch` rules (which never cross a `/`).
+
+    Arguments:
+        parts (tuple(str)): Path components to match.
+        pattern (tuple(str)): Glob pattern components.
+
+    Returns:
+        bool: True if `parts` matches `pattern`.
+    """
+    if not pattern:
+        return not parts
+    if pattern[0] == "**":
+        return any(
+            _match_parts(parts[idx:], pattern[1:]) for idx in range(len(parts) + 1)
+        )
+    return (
+        bool(parts)
+        and fnmatchcase(parts[0], pattern[0])
+        and _match_parts(parts[1:], pattern[1:])
+    )
+
+
+class TrackedFiles:
+    """Index of the files tracked by git in a repository.
+
+    The index is built from a single `git ls-files` call, and stored as a prefix tree
+    of path components, so that membership tests and subtree queries don't require
+    calling git or walking the filesystem again.
+
+    Attributes:
+        root (Path): The repository root that all indexed paths are relative to.
+    """
+
+    __slots__ = ("root", "_blobs", "_files", "_tree")
+
+    def __init__(self, root, paths, blobs=None):
+        """Initialize a TrackedFiles instance.
+
+        Arguments:
+            root (Path): The repository root.
+            paths (iterable(str)): Tracked paths (relative to `root`).
+            blobs (iterable(str) or None): Git blob SHA for each path in `paths`.
+        """
+        self.root = root
+        self._blobs = {}
+        self._files = set()
+        self._tree = {}
+        if blobs is None:
+            blobs = repeat(None)
+        for path, blob in zip(paths, blobs):
+            path = root / path
+            self._files.add(path)
+            if blob is not None:
+                self._blobs[path] = blob
+            node = self._tree
+            parts = path.relative_to(root).parts
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = None
+
+    @classmethod
+    def from_repo(cls, repo, blobs=False):
+        """Build the index of files tracked in a git repository.
+
+        Blob SHAs describe the working tree: files with unstaged changes are hashed
+        again, since the SHA in the git index is for the old contents. Files deleted
+        from the working tree have no SHA.
+
+        Arguments:
+            repo (GitRepo): The repository to list files from.
+            blobs (bool): Also record the git blob SHA of each file.
+
+        Returns:
+            TrackedFiles: Index of all files tracked in `repo`.
+        """
+        if not blobs:
+            return cls(repo.path, filter(None, repo.git("ls-files", "-z").split("\0")))
+        modified = set(filter(None, repo.git("ls-files", "-m", "-z").split("\0")))
+        paths = []
+        shas = []
+        for entry in repo.git("ls-files", "-s", "-z").split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, sha, _ = info.split()
+            if mode == "160000":
+                # submodule, not a file
+                continue
+            if path in modified:
+                sha = None
+            paths.append(path)
+            shas.append(sha)
+        rehash = [
+            idx
+            for idx, path in enumerate(paths)
+            if path in modified and (repo.path / path).is_file()
+        ]
+        if rehash:
+            LOG.debug("hashing %d files modified in the working tree", len(rehash))
+            result = repo.git(
+                "hash-object", "--", *(paths[idx] for idx in rehash)
+            ).split()
+            assert len(result) == len(rehash)
+            for idx, sha in zip(rehash, result):
+                shas[idx] = sha
+        return cls(repo.path, paths, shas)
+
+    @classmethod
+    def from_tree(cls, repo, rev="HEAD"):
+        """Build the index of files in a git revision, without using the working tree.
+
+        Blob SHAs are always recorded.
+
+        Arguments:
+            repo (GitRepo): The repository to list files from.
+            rev (str): The revision to list.
+
+        Returns:
+            TrackedFiles: Index of all files in `rev`.
+        """
+        paths = []
+        shas = []
+        for path, sha in repo.ls_tree(rev):
+            paths.append(path)
+            shas.append(sha)
+        return cls(repo.path, paths, shas)
+
+    def blob(self, path):
+        """Get the git blob SHA for a tracked file.
+
+        Arguments:
+            path (Path): Tracked file.
+
+        Returns:
+            str or None: Blob SHA, or None if SHAs were not recorded.
+        """
+        return self._blobs.get(path)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def __iter__(self):
+        return self.walk(self.root)
+
+    def __len__(self):
+        return len(self._files)
+
+    def walk(self, path):
+        """Iterate over all tracked files below a given path.
+
+        Arguments:
+            path (Path): Root of the subtree to list.
+
+        Yields:
+            Path: Tracked files in the subtree, in sorted order.
+        """
+        node = self._tree
+        for part in path.relative_to(self.root).parts:
+            node = node.get(part)
+            if not node:
+                return
+        stk = [(path, node)]
+        while stk:
+            base, node = stk.pop()
+            for name in sorted(node, reverse=True):
+                if node[name] is None:
+                    stk.append((base / name, None))
+                else:
+                    stk.append((base / name, node[name]))
+            while stk and stk[-1][1] is None:
+                yield stk.pop()[0]
+
+    def glob(self, path, pattern="**/*"):
+        """Find tracked files below `path` matching a glob expression.
+
+        This follows `Path.glob` semantics, except only files are yielded.
+
+        Arguments:
+            path (Path): Root for the glob expression.
+            pattern (str): Glob expression.
+
+        Yields:
+            Path: Matching tracked files, in sorted order.
+        """
+        pattern = PurePosixPath(pattern).parts
+        for result in self.walk(path):
+            if _match_parts(result.relative_to(path).parts, pattern):
+                yield result
+
+
 class GithubEvent:
     """Something that happened on Github which caused this decision to be run.
 
@@ -198,7 +567,9 @@ class GithubEvent:
         return f"https://github.com/{self.repo_slug}"
 
     @classmethod
-    def from_taskcluster(cls, action, event):
+    def from_taskcluster(
+        cls, action, event, checkout=True, depth=None, blob_filter=None
+    ):
         """Initialize the GithubEvent from Taskcluster context variables.
 
         Arguments:
@@ -207,6 +578,11 @@ class GithubEvent:
             event (dict): The raw Github Webhook event object.
                 ref: https://docs.github.com/en/free-pro-team@latest/developers
                      /webhooks-and-events/webhook-events-and-payloads
+            checkout (bool): Check out the working tree of the cloned repo.
+            depth (int or None): Initial depth for a shallow clone. The clone is
+                                 deepened as needed to find the merge base of
+                                 `commit_range`.
+            blob_filter (str or None): Object filter for a partial clone.
 
         Returns:
             GithubEvent: Object describing the Github Event we're responding to.
@@ -239,13 +615,22 @@ class GithubEvent:
             if set(event["before"]) != {"0"}:
                 self.commit_range = f"{event['before']}..{event['after']}"
             self.fetch_ref = event["after"]
-        self.repo = GitRepo(self.http_url, self.fetch_ref, self.commit)
-
         # fetch both sides of the commit range
+        refs = [self.fetch_ref]
         if self.commit_range is not None:
-            before, _ = self.commit_range.split("..")
+            before, after = self.commit_range.split("..")
             if "^" not in before:
-                self.repo.git("fetch", "-q", "origin", before, tries=RETRIES)
+                refs.append(before)
+        self.repo = GitRepo(
+            self.http_url,
+            refs,
+            self.commit,
+            checkout=checkout,
+            depth=depth,
+            blob_filter=blob_filter,
+        )
+        if self.commit_range is not None and depth is not None:
+            self.repo.deepen_to_merge_base(before, after)
 
         self.commit_message = self.repo.message(self.commit_range or self.commit)
         return self
@@ -261,7 +646,8 @@ class GithubEvent:
         """
         if self.commit_range is None:
             # no way to know what has changed.. so list all files.
-            changed = self.repo.git("ls-files")
+            # (use the commit, the index is empty if the repo isn't checked out)
+            changed = "\n".join(path for path, _ in self.repo.ls_tree(self.commit))
         else:
             changed = self.repo.git("diff", "--name-only", self.commit_range)
         for line in set(changed.splitlines()):
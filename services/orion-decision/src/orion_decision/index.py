@@ -0,0 +1,233 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Memoizing resolver for Taskcluster index namespaces"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from json import JSONDecodeError
+from json import dump as json_dump
+from json import load as json_load
+from logging import getLogger
+from threading import Lock, local
+from time import time
+
+from . import Taskcluster
+from .profiling import PROFILER
+
+LOG = getLogger(__name__)
+INDEX_CACHE_VERSION = 1
+# how long a cached index lookup stays valid, in seconds
+INDEX_CACHE_TTL = 600
+
+
+class IndexResolver:
+    """Resolve Taskcluster index namespaces to task IDs, once per namespace.
+
+    Each namespace is looked up at most once, even when requested by several threads
+    at the same time. Failed lookups are remembered too, and raise the same error
+    each time they are requested. `prefetch()` looks up many namespaces
+    concurrently, each worker thread using its own index client.
+
+    If `path` is given, successful lookups are also kept on disk for `ttl` seconds,
+    so consecutive runs don't repeat them. Call `save()` to write the cache.
+
+    Attributes:
+        path (Path or None): Location of the cache file.
+        ttl (float): Seconds a cached lookup remains valid.
+        max_workers (int): Maximum number of concurrent lookups in `prefetch()`.
+        hits (int): Number of lookups answered from the cache file.
+        misses (int): Number of lookups sent to the index.
+    """
+
+    __slots__ = (
+        "path",
+        "ttl",
+        "max_workers",
+        "hits",
+        "misses",
+        "_index_factory",
+        "_local",
+        "_lock",
+        "_old",
+        "_new",
+        "_results",
+    )
+
+    def __init__(
+        self, path=None, ttl=INDEX_CACHE_TTL, max_workers=8, index_factory=None
+    ):
+        """Initialize an IndexResolver instance.
+
+        Arguments:
+            path (Path or None): Location of the cache file, or None to only
+                                 memoize lookups in memory.
+            ttl (float): Seconds a cached lookup remains valid.
+            max_workers (int): Maximum number of concurrent lookups in `prefetch()`.
+            index_factory (callable or None): Called with no arguments to create an
+                                              index client for each thread.
+                                              Defaults to the Taskcluster index.
+        """
+        assert max_workers >= 1
+        self.path = path
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.hits = 0
+        self.misses = 0
+        if index_factory is None:
+            index_factory = self._default_index
+        self._index_factory = index_factory
+        self._local = local()
+        self._lock = Lock()
+        # namespace -> (taskId, time looked up)
+        self._new = {}
+        self._old = self._load() if path is not None else {}
+        # namespace -> Future(taskId)
+        self._results = {}
+
+    @staticmethod
+    def _default_index():
+        return Taskcluster.get_service("index")
+
+    def _index(self):
+        index = getattr(self._local, "index", None)
+        if index is None:
+            index = self._local.index = self._index_factory()
+        return index
+
+    def _load(self):
+        if not self.path.is_file():
+            return {}
+        try:
+            with self.path.open() as cache_fp:
+                data = json_load(cache_fp)
+        except (JSONDecodeError, OSError, UnicodeError) as exc:
+            LOG.warning("Index cache %s is unreadable (%s), ignoring", self.path, exc)
+            return {}
+        if not isinstance(data, dict) or data.get("version") != INDEX_CACHE_VERSION:
+            LOG.warning("Index cache %s has unknown version, ignoring", self.path)
+            return {}
+        entries = data.get("entries")
+        if not isinstance(entries, dict):
+            LOG.warning("Index cache %s is malformed, ignoring", self.path)
+            return {}
+        oldest = time() - self.ttl
+        result = {}
+        for namespace, entry in entries.items():
+            if (
+                isinstance(entry, list)
+                and len(entry) == 2
+                and isinstance(entry[0], str)
+                and isinstance(entry[1], (int, float))
+                and oldest <= entry[1] <= time()
+            ):
+                result[namespace] = tuple(entry)
+        LOG.info(
+            "Loaded index cache %s (%d of %d entries still valid)",
+            self.path,
+            len(result),
+            len(entries),
+        )
+        return result
+
+    def _lookup(self, namespace):
+        cached = self._old.get(namespace)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+                self._new[namespace] = cached
+            return cached[0]
+        with self._lock:
+            self.misses += 1
+        with PROFILER.phase("index_lookup"):
+            task_id = self._index().findTask(namespace)["taskId"]
+        with self._lock:
+            self._new[namespace] = (task_id, time())
+        return task_id
+
+    def lookup(self, namespace):
+        """Find the task ID indexed at a namespace.
+
+        Arguments:
+            namespace (str): Index namespace.
+
+        Raises:
+            TaskclusterFailure: The index lookup failed.
+
+        Returns:
+            str: Task ID.
+        """
+        assert isinstance(namespace, str)
+        with self._lock:
+            result = self._results.get(namespace)
+            owner = result is None
+            if owner:
+                result = self._results[namespace] = Future()
+        if owner:
+            try:
+                result.set_result(self._lookup(namespace))
+            except Exception as exc:  # pylint: disable=broad-except
+                result.set_exception(exc)
+        return result.result()
+
+    def prefetch(self, namespaces):
+        """Look up namespaces concurrently, so later `lookup()` calls don't block.
+
+        Errors are not raised here, but by `lookup()` for the failed namespace.
+
+        Arguments:
+            namespaces (iterable(str)): Index namespaces (may contain duplicates).
+
+        Returns:
+            None
+        """
+        with self._lock:
+            todo = sorted(set(namespaces) - self._results.keys())
+        if len(todo) <= 1 or self.max_workers == 1:
+            for namespace in todo:
+                self._prefetch_one(namespace)
+            return
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(todo)), thread_name_prefix="index"
+        ) as executor:
+            for _ in executor.map(self._prefetch_one, todo):
+                pass
+
+    def _prefetch_one(self, namespace):
+        try:
+            self.lookup(namespace)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.debug("Index lookup for %s failed: %s", namespace, exc)
+
+    def save(self):
+        """Write the successful lookups from this run to the cache file.
+
+        Valid entries loaded from the cache which weren't used are kept, so
+        alternating runs don't evict each other's entries.
+
+        Returns:
+            None
+        """
+        if self.path is None:
+            return
+        oldest = time() - self.ttl
+        with self._lock:
+            entries = {
+                namespace: list(entry)
+                for namespace, entry in {**self._old, **self._new}.items()
+                if entry[1] >= oldest
+            }
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("w") as cache_fp:
+            json_dump(
+                {"version": INDEX_CACHE_VERSION, "entries": entries},
+                cache_fp,
+                sort_keys=True,
+            )
+        tmp.replace(self.path)
+        LOG.info(
+            "Saved index cache %s (%d hits, %d misses)",
+            self.path,
+            self.hits,
+            self.misses,
+        )
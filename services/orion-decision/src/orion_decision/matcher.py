@@ -0,0 +1,105 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Multi-string matching for Orion path references"""
+from collections import deque
+
+
+class MultiStringMatcher:
+    """Find occurrences of a fixed set of strings in text.
+
+    This is an Aho-Corasick automaton, so searching is linear in the length of the
+    text, regardless of how many strings are being searched for.
+
+    Matches are reported with the same semantics as `re.finditer()` on an alternation
+    of the (escaped) strings: the leftmost match wins, ties at the same position are
+    won by the string given first, and matches do not overlap.
+
+    Attributes:
+        strings (list(str)): The strings being searched for.
+    """
+
+    __slots__ = ("strings", "_goto", "_fail", "_lengths", "_out", "_link")
+
+    def __init__(self, strings):
+        """Initialize a MultiStringMatcher instance.
+
+        Arguments:
+            strings (iterable(str)): The strings to search for.
+        """
+        self.strings = list(strings)
+        self._lengths = [len(string) for string in self.strings]
+        # trie of all strings. state 0 is the root
+        self._goto = [{}]
+        # index of the (first given) string ending at each state
+        self._out = [None]
+        for idx, string in enumerate(self.strings):
+            if not string:
+                continue
+            state = 0
+            for char in string:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._out.append(None)
+                state = nxt
+            if self._out[state] is None:
+                self._out[state] = idx
+        # failure links (longest proper suffix which is also in the trie), and
+        # output links (nearest state on the failure chain which ends a string)
+        self._fail = [0] * len(self._goto)
+        self._link = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                if fail == nxt:
+                    fail = 0
+                self._fail[nxt] = fail
+                if self._out[fail] is not None:
+                    self._link[nxt] = fail
+                else:
+                    self._link[nxt] = self._link[fail]
+
+    def matches(self, text):
+        """Search text for occurrences of any of the strings.
+
+        Arguments:
+            text (str): Text to search.
+
+        Yields:
+            str: Each string found, in order of occurrence.
+        """
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        link = self._link
+        lengths = self._lengths
+        # best string index for each start position
+        best = {}
+        state = 0
+        for pos, char in enumerate(text, start=1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = state if out[state] is not None else link[state]
+            while found:
+                idx = out[found]
+                start = pos - lengths[idx]
+                if best.get(start, idx) >= idx:
+                    best[start] = idx
+                found = link[found]
+        end = 0
+        for start in sorted(best):
+            if start >= end:
+                idx = best[start]
+                end = start + lengths[idx]
+                yield self.strings[idx]
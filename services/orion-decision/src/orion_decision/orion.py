@@ -5,24 +5,36 @@
 """Orion service definitions"""
 import re
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
 from itertools import chain
 from logging import getLogger
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from platform import machine
 
-from dockerfile_parse import DockerfileParser
 from yaml import safe_load as yaml_load
 
+from .dockerfile import dockerfile_images, dockerfile_sources
+from .git import TrackedFiles
+from .matcher import MultiStringMatcher
+from .profiling import PROFILER
+
 LOG = getLogger(__name__)
+# bump this to invalidate all input hashes (eg. if the build process changes)
+INPUT_HASH_VERSION = 2
+# architecture services are built for if service.yaml doesn't list any
+DEFAULT_ARCH = "amd64"
+# characters which make a COPY/ADD source a pattern
+GLOB_CHARS = re.compile(r"[*?\[]")
 
 
-def file_glob(repo, path, pattern="**/*", relative=False):
+def file_glob(files, path, pattern="**/*", relative=False):
     """Run Path.glob for a given pattern, with filters applied.
-    Only files are yielded, not directories. Any file that looks like
+    Only files tracked by git are yielded, not directories. Any file that looks like
     it is in a test folder hierarchy (`tests`) will be skipped.
 
     Arguments:
-        repo (GitRepo): Git repository in which to search.
+        files (TrackedFiles): Index of files in the git repository to search.
         path (Path): Root for the glob expression.
         pattern (str): Glob expression.
         relative (bool): Result will be relative to `path`.
@@ -30,15 +42,7 @@ def file_glob(repo, path, pattern="**/*", relative=False):
     Yields:
         Path: Result paths.
     """
-    git_files = [
-        repo.path / p
-        for p in repo.git(
-            "ls-files", "--", str(path.relative_to(repo.path))
-        ).splitlines()
-    ]
-    for result in path.glob(pattern):
-        if not result.is_file() or result not in git_files:
-            continue
+    for result in files.glob(path, pattern):
         relative_result = result.relative_to(path)
         if "tests" not in relative_result.parts:
             if relative:
@@ -47,6 +51,64 @@ def file_glob(repo, path, pattern="**/*", relative=False):
                 yield result
 
 
+def scan_file(path, matcher, data=None):
+    """Search a file for path references and forced dependencies.
+
+    Arguments:
+        path (Path): File to search.
+        matcher (MultiStringMatcher): Matcher for known path strings.
+        data (bytes or None): Contents of the file (read from `path` if not given).
+
+    Returns:
+        dict or None: "refs" is a list of path strings found in the file,
+                      "force" is a list of (type, services) for `/force-deps=`
+                      and `/force-dirty=` found in the file.
+                      None if the file is not text.
+    """
+    try:
+        if data is None:
+            text = path.read_text()
+        else:
+            text = data.decode("utf-8")
+    except UnicodeError:
+        return None
+    return {
+        "refs": list(matcher.matches(text)),
+        "force": [
+            list(match.groups())
+            for match in re.finditer(r"/force-(deps|dirty)=([A-Za-z0-9_.,-]+)", text)
+        ],
+    }
+
+
+# matcher used by `scan_file()` in worker processes
+_WORKER_MATCHER = None
+
+
+def _init_scan_worker(file_strs):
+    global _WORKER_MATCHER  # pylint: disable=global-statement
+    _WORKER_MATCHER = MultiStringMatcher(file_strs)
+
+
+def _scan_file_worker(path, data):
+    return scan_file(path, _WORKER_MATCHER, data)
+
+
+def _iter_bits(mask):
+    """Iterate over the set bits in a bitset.
+
+    Arguments:
+        mask (int): Bitset.
+
+    Yields:
+        int: Index of each set bit, in ascending order.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
 class ServiceTest(ABC):
     """Orion service test
 
@@ -179,6 +241,12 @@ class Service:
         dirty (bool): Whether or not this image needs to be rebuilt
         tests (list[ServiceTest]): Tests to run against this service
         root (Path): Path where service is defined
+        input_hash (str or None): Hash of everything used to build this image, or
+                                  None if it could not be calculated.
+        archs (dict(str -> Path)): Dockerfile for each architecture the image is
+                                   built for.
+        manifest (list(str) or None): Command to publish the multi-architecture
+                                      manifest, if not the default.
     """
 
     def __init__(self, dockerfile, context, name, tests, root):
@@ -201,20 +269,39 @@ class Service:
         self.dirty = False
         self.tests = tests
         self.root = root
+        self.input_hash = None
+        self.archs = {DEFAULT_ARCH: dockerfile}
+        self.manifest = None
+
+    @property
+    def multiarch(self):
+        """Whether the image is built for more than one architecture."""
+        return len(self.archs) > 1
 
     @classmethod
-    def from_metadata_yaml(cls, metadata, context):
+    def from_metadata_yaml(cls, metadata, context, data=None, files=None):
         """Create a Service instance from a service.yaml metadata path.
 
         Arguments:
             metadata (Path): Path to a service.yaml file.
             context (Path): The context from which this service is built.
+            data (dict or None): Parsed contents of `metadata`, if already loaded.
+            files (TrackedFiles or None): Index used to check that files referenced
+                                          by `metadata` exist (instead of checking
+                                          the filesystem).
 
         Returns:
             Service: A service instance.
         """
         metadata_path = metadata
-        metadata = yaml_load(metadata_path.read_text())
+        if files is None:
+            exists = Path.is_file
+        else:
+            exists = files.__contains__
+        if data is None:
+            metadata = yaml_load(metadata_path.read_text())
+        else:
+            metadata = data
         name = metadata["name"]
         LOG.info("Loading %s from %s", name, metadata_path)
         if "tests" in metadata:
@@ -225,7 +312,7 @@ class Service:
             assert metadata["type"] in {"docker", "msys"}
         if metadata.get("type") == "msys":
             base = metadata["base"]
-            assert (metadata_path.parent / "setup.sh").is_file()
+            assert exists(metadata_path.parent / "setup.sh")
             result = ServiceMsys(base, context, name, tests, metadata_path.parent)
         else:
             cpu = {"x86_64": "amd64"}.get(machine(), machine())
@@ -237,8 +324,26 @@ class Service:
                 dockerfile = metadata_path.parent / metadata["arch"][cpu]["dockerfile"]
             else:
                 dockerfile = metadata_path.parent / "Dockerfile"
-            assert dockerfile.is_file()
+            assert exists(dockerfile)
             result = cls(dockerfile, context, name, tests, metadata_path.parent)
+            # every architecture listed in "arch" is built, using the Dockerfile
+            # given for that architecture, or the default one
+            default = metadata_path.parent / "Dockerfile"
+            archs = {}
+            if exists(default):
+                archs[DEFAULT_ARCH] = default
+            for arch, arch_defn in metadata.get("arch", {}).items():
+                if "dockerfile" in arch_defn:
+                    archs[arch] = metadata_path.parent / arch_defn["dockerfile"]
+                else:
+                    archs[arch] = default
+                assert exists(archs[arch]), f"Missing {arch} Dockerfile for {name}"
+            if archs:
+                result.archs = archs
+            assert (
+                len(archs) < 2 or DEFAULT_ARCH in archs
+            ), f"Service {name} is built for multiple architectures, not {DEFAULT_ARCH}"
+            result.manifest = metadata.get("manifest")
         result.service_deps |= set(metadata.get("force_deps", []))
         result.weak_deps |= set(metadata.get("force_dirty", []))
         return result
@@ -257,6 +362,8 @@ class ServiceMsys(Service):
         dirty (bool): Whether or not this image needs to be rebuilt
         tests (list[ServiceTest]): Tests to run against this service
         root (Path): Path where service is defined
+        input_hash (str or None): Hash of everything used to build this tar, or
+                                  None if it could not be calculated.
     """
 
     def __init__(self, base, context, name, tests, root):
@@ -271,6 +378,7 @@ class ServiceMsys(Service):
         """
         super().__init__(None, context, name, tests, root)
         self.base = base
+        self.archs = {}
 
 
 class Recipe:
@@ -284,6 +392,8 @@ class Recipe:
         weak_deps (set(str)): Names of images that should trigger a rebuild of this one
                               but are not build deps.
         dirty (bool): Whether or not this recipe needs tests run.
+        input_hash (str or None): Hash of the recipe and everything it uses, or None
+                                  if it could not be calculated.
     """
 
     def __init__(self, file):
@@ -298,6 +408,7 @@ class Recipe:
         self.recipe_deps = set()
         self.weak_deps = set()
         self.dirty = False
+        self.input_hash = None
 
     @property
     def name(self):
@@ -313,31 +424,154 @@ class Services(dict):
         recipes (dict(str -> Recipe)): Mapping of recipe name (`recipe.sh`) to the
                                        `Recipe` instance.
         root (Path): The root for loading services and watching recipe scripts.
+        files (TrackedFiles): Index of files tracked in the repository.
+        cache (GraphCache or None): Cache for results of reading files.
+        workers (int): Number of processes to use for scanning files.
+        revision (str or None): Git revision files are read from, or None if files
+                                are read from the working tree.
+        dependency_order (list(Service/Recipe)): All services and recipes, ordered
+                                                 so each comes after everything it
+                                                 depends on.
     """
 
-    def __init__(self, repo):
+    def __init__(self, repo, cache=None, workers=1, revision=None, hashes=False):
         """Initialize a `Services` instances.
 
         Arguments:
             repo (GitRepo): The git repo to load services and recipe scripts from.
+            cache (GraphCache or None): Cache for results of reading files, keyed by
+                                        git blob SHA.
+            workers (int): Number of processes to use for scanning files.
+            revision (str or None): Read files from this git revision in the object
+                                    database, instead of from the working tree.
+            hashes (bool): Record git blob SHAs even if `cache` is not used, so
+                           `input_hash` can be calculated for each service.
         """
         super().__init__()
         self.root = repo.path
-        # scan files & recipes
-        self.recipes = {}
-        self._file_re = self._scan_files(repo)
-        # scan the context recursively to find services
-        for service_yaml in file_glob(repo, self.root, "**/service.yaml"):
-            service = Service.from_metadata_yaml(service_yaml, self.root)
-            assert service.name not in self
-            service.path_deps |= {service_yaml, service.dockerfile}
-            self[service.name] = service
-        self._calculate_depends(repo)
-
-    def _scan_files(self, repo):
+        self.cache = cache
+        self.workers = workers
+        self.revision = revision
+        self._repo = repo
+        with PROFILER.phase("graph/index"):
+            if revision is None:
+                self.files = TrackedFiles.from_repo(
+                    repo, blobs=cache is not None or hashes
+                )
+            else:
+                self.files = TrackedFiles.from_tree(repo, revision)
+            # scan files & recipes
+            self.recipes = {}
+            self._file_matcher = self._scan_files()
+            # scan the context recursively to find services
+            for service_yaml in file_glob(self.files, self.root, "**/service.yaml"):
+                service = Service.from_metadata_yaml(
+                    service_yaml,
+                    self.root,
+                    self._cached(
+                        "metadata",
+                        service_yaml,
+                        lambda path: yaml_load(self.read(path)),
+                    ),
+                    self.files,
+                )
+                assert service.name not in self
+                service.path_deps.add(service_yaml)
+                # Dockerfiles for every architecture (MSYS services have none)
+                if service.dockerfile is not None:
+                    service.path_deps.add(service.dockerfile)
+                service.path_deps |= set(service.archs.values())
+                self[service.name] = service
+        with PROFILER.phase("graph/depends"):
+            self._calculate_depends()
+            self._index_depends()
+            self._order_depends()
+        with PROFILER.phase("graph/hashes"):
+            self._calculate_hashes()
+        if self.cache is not None:
+            self.cache.save()
+
+    def read(self, path):
+        """Read the contents of a tracked file.
+
+        Arguments:
+            path (Path): Tracked file to read.
+
+        Returns:
+            bytes: File contents, from the working tree or from `revision`.
+        """
+        if self.revision is None:
+            return path.read_bytes()
+        return self._repo.read_blob(self.files.blob(path))
+
+    def _cached(self, section, path, compute):
+        """Calculate a result from a file, using the cache if available.
+
+        Arguments:
+            section (str): Cache section (see `GraphCache`).
+            path (Path): Tracked file the result is calculated from.
+            compute (callable): Function to calculate the result, called with `path`.
+
+        Returns:
+            object: The result of `compute(path)`.
+        """
+        blob = self.files.blob(path)
+        if self.cache is None or blob is None:
+            return compute(path)
+        return self.cache.get(section, blob, lambda: compute(path))
+
+    def _scan_all(self, paths):
+        """Scan files for references, in parallel if `workers` > 1.
+
+        Files are only read if the result is not already cached. Results are
+        returned in the order given, so the outcome doesn't depend on `workers`.
+
+        Arguments:
+            paths (list(Path)): Files to scan.
+
+        Returns:
+            list(dict or None): Result of `scan_file()` for each path.
+        """
+        pending = {}
+        for path in paths:
+            blob = self.files.blob(path)
+            if self.cache is not None and blob is not None:
+                if self.cache.has("scan", blob):
+                    continue
+                key = blob
+            else:
+                key = path
+            pending.setdefault(key, path)
+        pending = list(pending.values())
+        LOG.debug("scanning %d files (%d workers)", len(pending), self.workers)
+        PROFILER.count("files_scanned", len(pending))
+        # blobs must be read here, workers only have access to the working tree
+        if self.revision is None:
+            data = [None] * len(pending)
+        else:
+            data = [self.read(path) for path in pending]
+        if self.workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_scan_worker,
+                initargs=(self._file_matcher.strings,),
+            ) as pool:
+                chunksize = max(1, len(pending) // (self.workers * 4))
+                results = pool.map(
+                    _scan_file_worker, pending, data, chunksize=chunksize
+                )
+                scanned = dict(zip(pending, results))
+        else:
+            scanned = {
+                path: scan_file(path, self._file_matcher, contents)
+                for path, contents in zip(pending, data)
+            }
+        return [self._cached("scan", path, scanned.get) for path in paths]
+
+    def _scan_files(self):
         # make a list of all file paths
         file_strs = []
-        for file in file_glob(repo, self.root, relative=True):
+        for file in file_glob(self.files, self.root, relative=True):
             file_strs.append(str(file))
             # recipes are usually called using only their basename
             if file.parts[0] == "recipes":
@@ -345,24 +579,25 @@ class Services(dict):
                 assert file.name not in self.recipes
                 self.recipes[file.name] = Recipe(self.root / file)
             LOG.debug("found path: %s", file_strs[-1])
-        return re.compile("|".join(re.escape(file) for file in file_strs))
+        if self.cache is not None:
+            self.cache.set_paths(file_strs)
+        return MultiStringMatcher(file_strs)
 
-    def _find_path_depends(self, obj, text):
-        """Search a file for path references.
+    def _find_path_depends(self, obj, matches):
+        """Add dependencies for path references found in a file.
 
         Arguments:
             obj (Recipe/Service): Object the file belongs to
-            text (str): File contents to search
+            matches (list(str)): Path references found in the file
 
         Returns:
             None
         """
-        # search file for references to other files
-        for match in self._file_re.finditer(text):
-            match = match.group(0)
+        PROFILER.count("path_matches", len(matches))
+        for match in matches:
             path = self.root / match
             part0 = Path(match).parts[0]
-            if (not path.is_file() and match in self.recipes) or part0 == "recipes":
+            if (path not in self.files and match in self.recipes) or part0 == "recipes":
                 assert (
                     path.name in self.recipes
                 ), f"{type(obj).__name__} {obj.name} depends on unknown recipe {match}"
@@ -383,11 +618,12 @@ class Services(dict):
                     path.relative_to(self.root),
                 )
 
-    def _calculate_depends(self, repo):
+    def _calculate_depends(self):
         """Go through each service and try to determine what dependencies it has.
 
         There are four types of dependencies:
-        - service: The base image used for the dockerfile (only for `mozillasecurity/`)
+        - service: Images used by any stage of the Dockerfile (only for
+                   `mozillasecurity/`)
         - paths: Files in the same root that are used by the image.
         - forced: Use `/force-deps=service` in a recipe or "force_deps:[]" in
                   service.yaml to force a dependency on another service.
@@ -395,36 +631,53 @@ class Services(dict):
                 service.yaml to force rebuild of this service if another changes, but
                 not a build dependency.
 
-        Arguments:
-            repo (GitRepo): The git repo to load services and recipe scripts from.
-
         Returns:
             None
         """
+        # find all files to be scanned for references, and scan them up front
+        search_roots = {}
+        for service in self.values():
+            if isinstance(service, ServiceMsys):
+                search_root = [service.root]
+            else:
+                search_root = {service.dockerfile.parent}
+                search_root.update(path.parent for path in service.archs.values())
+                # folders within another search root are already included
+                search_root = [
+                    root
+                    for root in sorted(search_root)
+                    if not any(other in root.parents for other in search_root)
+                ]
+            search_roots[service.name] = [
+                path for root in search_root for path in file_glob(self.files, root)
+            ]
+        scan_paths = [recipe.file for recipe in self.recipes.values()]
+        for entries in search_roots.values():
+            scan_paths.extend(entries)
+        with PROFILER.phase("graph/scan"):
+            scans = dict(zip(scan_paths, self._scan_all(scan_paths)))
+
         for recipe in self.recipes.values():
-            try:
-                recipe_text = recipe.file.read_text()
-            except UnicodeError:
+            scan = scans[recipe.file]
+            if scan is None:
                 continue
 
             # find force-deps in recipe
-            for match in re.finditer(
-                r"/force-(deps|dirty)=([A-Za-z0-9_.,-]+)", recipe_text
-            ):
-                for svc in match.group(2).split(","):
+            for dep_type, svcs in scan["force"]:
+                for svc in svcs.split(","):
                     msg = (
                         "forces unknown dep"
-                        if match.group(1) == "deps"
+                        if dep_type == "deps"
                         else "dirtied by unknown"
                     )
                     assert svc in self, f"Recipe {recipe.name} {msg}: {svc}"
-                    if match.group(1) == "deps":
+                    if dep_type == "deps":
                         recipe.service_deps.add(svc)
                     else:
                         recipe.weak_deps.add(svc)
 
             # search file for references to other files
-            self._find_path_depends(recipe, recipe_text)
+            self._find_path_depends(recipe, scan["refs"])
 
         for service in self.values():
             # check force_deps
@@ -439,26 +692,30 @@ class Services(dict):
                     "Service %s is dirty with service %s (forced)", service.name, dep
                 )
 
-            if isinstance(service, ServiceMsys):
-                search_root = service.root
-            else:
-                # calculate image dependencies
-                parser = DockerfileParser(path=str(service.dockerfile))
-                if parser.baseimage is not None and parser.baseimage.startswith(
-                    "mozillasecurity/"
-                ):
-                    baseimage = parser.baseimage.split("/", 1)[1]
-                    if ":" in baseimage:
-                        baseimage = baseimage.split(":", 1)[0]
-                    assert baseimage in self
-                    service.service_deps.add(baseimage)
-                    LOG.info(
-                        "Service %s depends on Service %s", service.name, baseimage
+            if not isinstance(service, ServiceMsys):
+                # calculate image dependencies (of any architecture)
+                images = []
+                for dockerfile in sorted({service.dockerfile, *service.archs.values()}):
+                    images.extend(
+                        self._cached(
+                            "images",
+                            dockerfile,
+                            lambda path: dockerfile_images(self.read(path)),
+                        )
                     )
-                search_root = service.dockerfile.parent
+                for image in images:
+                    if not image.startswith("mozillasecurity/"):
+                        continue
+                    image = image.split("/", 1)[1].split("@", 1)[0].split(":", 1)[0]
+                    assert image in self, f"Service {service.name} uses unknown {image}"
+                    if image not in service.service_deps:
+                        service.service_deps.add(image)
+                        LOG.info(
+                            "Service %s depends on Service %s", service.name, image
+                        )
 
             # scan service for references to files
-            for entry in file_glob(repo, search_root):
+            for entry in search_roots[service.name]:
                 # add a direct dependency on any file in the service folder
                 if entry not in service.path_deps:
                     service.path_deps.add(entry)
@@ -468,47 +725,246 @@ class Services(dict):
                         entry.relative_to(self.root),
                     )
 
-                try:
-                    entry_text = entry.read_text()
-                except UnicodeError:
+                scan = scans[entry]
+                if scan is None:
                     continue
 
                 # search file for references to other files
-                self._find_path_depends(service, entry_text)
+                self._find_path_depends(service, scan["refs"])
+
+    def _index_depends(self):
+        """Build indices over the dependency graph for ordering and dirty propagation.
 
-        def _adjacent(obj):
+        Each service and recipe is assigned a node id, and sets of nodes are
+        represented as bitsets (int) over those ids.
+
+        Returns:
+            None
+        """
+        self._nodes = list(chain(self.values(), self.recipes.values()))
+        svc_ids = {svc.name: idx for idx, svc in enumerate(self.values())}
+        rec_ids = {
+            rec.name: idx for idx, rec in enumerate(self.recipes.values(), len(self))
+        }
+        # path -> nodes which depend on it
+        self._path_owners = {}
+        # node -> nodes which directly depend on it
+        self._rdeps = [0] * len(self._nodes)
+        # node -> nodes it directly depends on (including service test images)
+        self._deps = []
+        for idx, obj in enumerate(self._nodes):
+            bit = 1 << idx
+            deps = {rec_ids[rec] for rec in obj.recipe_deps}
+            deps |= {svc_ids[svc] for svc in obj.service_deps}
+            if isinstance(obj, Service):
+                deps |= {
+                    svc_ids[test.image]
+                    for test in obj.tests
+                    if hasattr(test, "image") and test.image in self
+                }
+            self._deps.append(sorted(deps))
+            for path in obj.path_deps:
+                self._path_owners[path] = self._path_owners.get(path, 0) | bit
             for rec in obj.recipe_deps:
-                yield self.recipes[rec]
-            for svc in obj.service_deps:
-                yield self[svc]
-            # include service test images
-            if hasattr(obj, "tests"):
-                for test in obj.tests:
-                    if hasattr(test, "image") and test.image in self:
-                        yield self[test.image]
-
-        # check that there are no cycles in the dependency graph
-        for start in chain(self.values(), self.recipes.values()):
-            stk = [_adjacent(start)]
-            bkt = [start]
-            while stk:
-                if stk[-1] is None:
-                    bkt.pop()
-                    stk.pop()
-                    continue
-                here = next(stk[-1], None)
-                if here is None:
-                    stk.pop()
+                self._rdeps[rec_ids[rec]] |= bit
+            for svc in obj.service_deps | obj.weak_deps:
+                self._rdeps[svc_ids[svc]] |= bit
+
+    def _order_depends(self):
+        """Find strongly connected components of the dependency graph (Tarjan).
+
+        This checks that there are no cycles in the dependency graph, and calculates
+        `dependency_order` in the same O(V+E) pass.
+
+        Raises:
+            RuntimeError: The dependency graph contains one or more cycles.
+
+        Returns:
+            None
+        """
+        index = [None] * len(self._nodes)
+        low = [0] * len(self._nodes)
+        on_stk = [False] * len(self._nodes)
+        stk = []
+        order = []
+        cycles = []
+        counter = 0
+        for start in range(len(self._nodes)):
+            if index[start] is not None:
+                continue
+            index[start] = low[start] = counter
+            counter += 1
+            stk.append(start)
+            on_stk[start] = True
+            work = [(start, iter(self._deps[start]))]
+            while work:
+                here, adjacent = work[-1]
+                for dep in adjacent:
+                    if index[dep] is None:
+                        index[dep] = low[dep] = counter
+                        counter += 1
+                        stk.append(dep)
+                        on_stk[dep] = True
+                        work.append((dep, iter(self._deps[dep])))
+                        break
+                    if on_stk[dep]:
+                        low[here] = min(low[here], index[dep])
                 else:
-                    if here in bkt:
-                        bkt.append(here)
-                        fmt_bkt = ", ".join(
-                            f"{type(obj).__name__} {obj.name}" for obj in bkt
-                        )
-                        raise RuntimeError(f"Dependency cycle detected: [{fmt_bkt}]")
-                    bkt.append(here)
-                    stk.append(None)  # sentinel
-                    stk.append(_adjacent(here))
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[here])
+                    if low[here] == index[here]:
+                        # `here` is the root of a strongly connected component
+                        component = []
+                        while True:
+                            member = stk.pop()
+                            on_stk[member] = False
+                            component.append(member)
+                            if member == here:
+                                break
+                        if len(component) > 1 or here in self._deps[here]:
+                            cycles.append(sorted(component))
+                        order.extend(component)
+        if cycles:
+            fmt_cycles = ", ".join(
+                "["
+                + ", ".join(
+                    f"{type(self._nodes[idx]).__name__} {self._nodes[idx].name}"
+                    for idx in cycle
+                )
+                + "]"
+                for cycle in cycles
+            )
+            raise RuntimeError(f"Dependency cycle detected: {fmt_cycles}")
+        # components are found in reverse topological order, which puts dependencies
+        # before the services and recipes depending on them.
+        self.dependency_order = [self._nodes[idx] for idx in order]
+
+    def _calculate_hashes(self):
+        """Calculate `input_hash` for each service and recipe.
+
+        Anything which would make a service dirty when changed is an input, as is
+        anything a Dockerfile copies from the build context: the hash covers the
+        git blob SHA of each of these files and the arguments given to the build,
+        for the service itself and for every service and recipe it depends on
+        (including weak dependencies, transitively). If the same hash was built
+        before, the result can be reused.
+
+        If any blob SHA is unknown, the hash is None for everything depending on it.
+        MSYS services are built in a clone of the whole repo, so their hash is
+        always None.
+
+        Returns:
+            None
+        """
+        svc_ids = {svc.name: idx for idx, svc in enumerate(self.values())}
+        rec_ids = {
+            rec.name: idx for idx, rec in enumerate(self.recipes.values(), len(self))
+        }
+        # hash of each node's own inputs
+        local = []
+        # node -> nodes it directly depends on, including weak deps
+        deps = []
+        for obj in self._nodes:
+            local.append(self._local_hash(obj))
+            deps.append(
+                [rec_ids[rec] for rec in obj.recipe_deps]
+                + [svc_ids[svc] for svc in obj.service_deps | obj.weak_deps]
+            )
+
+        # weak deps can form cycles, so iterate until the closures are stable.
+        # following `dependency_order` means this is usually one or two passes.
+        position = {id(obj): idx for idx, obj in enumerate(self._nodes)}
+        order = [position[id(obj)] for obj in self.dependency_order]
+        closure = [1 << idx for idx in range(len(self._nodes))]
+        changed = True
+        while changed:
+            changed = False
+            for idx in order:
+                result = closure[idx]
+                for dep in deps[idx]:
+                    result |= closure[dep]
+                if result != closure[idx]:
+                    closure[idx] = result
+                    changed = True
+
+        for idx, obj in enumerate(self._nodes):
+            inputs = [local[member] for member in _iter_bits(closure[idx])]
+            if None in inputs:
+                obj.input_hash = None
+                continue
+            inputs.sort()
+            # services in a cycle have the same inputs, so also include which it is
+            inputs[:0] = [f"version {INPUT_HASH_VERSION}", local[idx]]
+            obj.input_hash = sha256("\n".join(inputs).encode("utf-8")).hexdigest()
+
+    def _local_hash(self, obj):
+        """Calculate the hash of the inputs of a service or recipe, excluding
+        its dependencies.
+
+        Arguments:
+            obj (Recipe/Service): Object to hash.
+
+        Returns:
+            str or None: Hash, or None if it could not be calculated.
+        """
+        if isinstance(obj, ServiceMsys):
+            return None
+        paths = set(obj.path_deps)
+        if any(self.files.blob(path) is None for path in paths):
+            return None
+        lines = [f"{type(obj).__name__} {obj.name}"]
+        if isinstance(obj, Service):
+            lines.append(f"dockerfile {obj.dockerfile.relative_to(obj.context)}")
+            if obj.multiarch:
+                lines.extend(
+                    f"arch {arch} {path.relative_to(obj.context)}"
+                    for arch, path in sorted(obj.archs.items())
+                )
+            for dockerfile in sorted({obj.dockerfile, *obj.archs.values()}):
+                sources = self._cached(
+                    "sources",
+                    dockerfile,
+                    lambda path: dockerfile_sources(self.read(path)),
+                )
+                copied = self._copied_files(obj.context, sources)
+                if copied is None:
+                    return None
+                paths |= copied
+        blobs = sorted(
+            (str(path.relative_to(self.root)), self.files.blob(path)) for path in paths
+        )
+        if any(blob is None for _, blob in blobs):
+            return None
+        lines.extend(f"path {path} {blob}" for path, blob in blobs)
+        return sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+    def _copied_files(self, context, sources):
+        """Find the tracked files a Dockerfile may copy from the build context.
+
+        Arguments:
+            context (Path): Build context.
+            sources (list(str)): `COPY`/`ADD` sources (see `dockerfile_sources()`).
+
+        Returns:
+            set(Path) or None: Files matching any source, or None if a source is not
+                               in the build context (eg. a URL).
+        """
+        result = set()
+        for source in sources:
+            if "://" in source:
+                return None
+            source = PurePosixPath(source.lstrip("/"))
+            if GLOB_CHARS.search(str(source)):
+                result.update(self.files.glob(context, str(source)))
+                # a pattern can also match directories
+                result.update(self.files.glob(context, str(source / "**" / "*")))
+            elif context / source in self.files:
+                result.add(context / source)
+            else:
+                result.update(self.files.walk(context / source))
+        return result
 
     def mark_changed_dirty(self, changed_paths):
         """Find changed services and images that depend on them.
@@ -516,42 +972,39 @@ class Services(dict):
         Arguments:
             changed_paths (iterable(Path)): List of paths changed.
         """
+        dirty = 0
+        for idx, obj in enumerate(self._nodes):
+            if obj.dirty:
+                dirty |= 1 << idx
         stk = []
         # find first order dependencies
         for path in changed_paths:
-            for here in chain(self.values(), self.recipes.values()):
-                # shortcut if already marked dirty
-                if here.dirty:
-                    continue
-                # check for path dependencies
-                if path in here.path_deps:
-                    LOG.warning(
-                        "%s %s is dirty because Path %s is changed",
-                        type(here).__name__,
-                        here.name,
-                        path.relative_to(self.root),
-                    )
-                    here.dirty = True
-                    stk.append(here)
-                    continue
+            for idx in _iter_bits(self._path_owners.get(path, 0) & ~dirty):
+                here = self._nodes[idx]
+                LOG.warning(
+                    "%s %s is dirty because Path %s is changed",
+                    type(here).__name__,
+                    here.name,
+                    path.relative_to(self.root),
+                )
+                here.dirty = True
+                dirty |= 1 << idx
+                stk.append(idx)
 
         # propagate dirty bit
         while stk:
-            here = stk.pop()
-            for tgt in chain(self.values(), self.recipes.values()):
-                if not tgt.dirty and (
-                    (isinstance(here, Recipe) and here.name in tgt.recipe_deps)
-                    or (
-                        isinstance(here, Service)
-                        and here.name in tgt.weak_deps | tgt.service_deps
-                    )
-                ):
-                    tgt.dirty = True
-                    LOG.warning(
-                        "%s %s is dirty because %s %s is dirty",
-                        type(tgt).__name__,
-                        tgt.name,
-                        type(here).__name__,
-                        here.name,
-                    )
-                    stk.append(tgt)
+            idx = stk.pop()
+            here = self._nodes[idx]
+            new = self._rdeps[idx] & ~dirty
+            dirty |= new
+            for tgt_idx in _iter_bits(new):
+                tgt = self._nodes[tgt_idx]
+                tgt.dirty = True
+                LOG.warning(
+                    "%s %s is dirty because %s %s is dirty",
+                    type(tgt).__name__,
+                    tgt.name,
+                    type(here).__name__,
+                    here.name,
+                )
+                stk.append(tgt_idx)
@@ -0,0 +1,168 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Phase timing, counters and profiling for decision runs"""
+from contextlib import contextmanager
+from cProfile import Profile
+from json import dumps as json_dump
+from logging import getLogger
+from pstats import Stats
+from threading import Lock
+from time import perf_counter
+
+LOG = getLogger(__name__)
+# number of functions included in the report when cProfile is enabled
+PROFILE_FUNCTIONS = 50
+
+
+class Profiler:
+    """Collect timings and counters over a decision run.
+
+    Phases are named sections of the run. Time spent in each is summed over all
+    calls, so a phase entered repeatedly (or from multiple threads) gives the total
+    time spent in it. Phases can be nested, in which case time is counted in both.
+
+    Attributes:
+        phases (dict(str -> list(float, int))): Total seconds and number of calls for
+                                                each phase.
+        counters (dict(str -> int)): Named counts of events.
+    """
+
+    __slots__ = ("phases", "counters", "_lock", "_profile", "_start", "_total")
+
+    def __init__(self):
+        """Initialize a Profiler instance."""
+        self.phases = {}
+        self.counters = {}
+        self._lock = Lock()
+        self._profile = None
+        self._start = None
+        self._total = None
+
+    def start(self, cprofile=False):
+        """Clear any results and start measuring a run.
+
+        Arguments:
+            cprofile (bool): Also profile function calls using cProfile.
+
+        Returns:
+            None
+        """
+        self.phases = {}
+        self.counters = {}
+        self._total = None
+        self._profile = None
+        if cprofile:
+            self._profile = Profile()
+            self._profile.enable()
+        self._start = perf_counter()
+
+    def stop(self):
+        """Stop measuring the run started by `start()`.
+
+        Returns:
+            None
+        """
+        if self._start is not None:
+            self._total = perf_counter() - self._start
+            self._start = None
+        if self._profile is not None:
+            self._profile.disable()
+
+    def add_time(self, name, seconds):
+        """Add time spent in a phase.
+
+        Arguments:
+            name (str): Phase name.
+            seconds (float): Time spent.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as part of a phase.
+
+        Arguments:
+            name (str): Phase name.
+
+        Yields:
+            None
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def count(self, name, value=1):
+        """Increase a counter.
+
+        Arguments:
+            name (str): Counter name.
+            value (int): Amount to add.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Summarize the results.
+
+        Returns:
+            dict: "total" is the run time in seconds (None if `start()` was not
+                  called), "phases" maps each phase to "seconds" and "calls",
+                  "counters" is a copy of `counters`, and "profile" lists the
+                  functions with the highest cumulative time if cProfile was used.
+        """
+        total = self._total
+        if self._start is not None:
+            total = perf_counter() - self._start
+        with self._lock:
+            result = {
+                "total": total,
+                "phases": {
+                    name: {"seconds": seconds, "calls": calls}
+                    for name, (seconds, calls) in sorted(self.phases.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+        if self._profile is not None:
+            stats = Stats(self._profile).sort_stats("cumulative")
+            result["profile"] = [
+                {
+                    "function": f"{filename}:{line}({func})",
+                    "calls": calls,
+                    "total": total_time,
+                    "cumulative": cumulative,
+                }
+                for (filename, line, func), (_, calls, total_time, cumulative, _) in (
+                    (func, stats.stats[func])
+                    for func in stats.fcn_list[:PROFILE_FUNCTIONS]
+                )
+            ]
+        return result
+
+    def write(self, path):
+        """Write the report as JSON.
+
+        Arguments:
+            path (Path): File to write.
+
+        Returns:
+            None
+        """
+        report = self.report()
+        path.write_text(json_dump(report, indent=2) + "\n")
+        LOG.info("Wrote timing report to %s (%.1fs total)", path, report["total"] or 0)
+
+
+PROFILER = Profiler()
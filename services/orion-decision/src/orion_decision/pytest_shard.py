@@ -0,0 +1,64 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""pytest plugin to run one shard of a sharded CI job (see `ci_shard`).
+
+With orion-decision installed in the test environment, enable it using
+`pytest -p orion_decision.pytest_shard`, or in `conftest.py`:
+
+    pytest_plugins = ["orion_decision.pytest_shard"]
+
+Collected tests not selected for this shard by `select_tests_from_env()` are
+deselected. If `CI_SHARD_TIMINGS` is set, the time taken by each test (setup, call
+and teardown) is written there when the session finishes, so the next run can
+balance shards by duration. Without the `CI_SHARD*` variables, nothing changes.
+"""
+
+from json import dumps as json_dumps
+from os import getenv
+from pathlib import Path
+
+from .ci_shard import select_tests_from_env
+
+
+class ShardTimings:
+    """pytest plugin recording test durations to `CI_SHARD_TIMINGS`.
+
+    Attributes:
+        path (Path): File to write timings to.
+        durations (dict(str -> float)): Seconds taken by each test, by node ID.
+    """
+
+    __slots__ = ("path", "durations")
+
+    def __init__(self, path):
+        """Initialize a ShardTimings instance.
+
+        Arguments:
+            path (Path): File to write timings to.
+        """
+        self.path = path
+        self.durations = {}
+
+    def pytest_runtest_logreport(self, report):
+        self.durations[report.nodeid] = (
+            self.durations.get(report.nodeid, 0.0) + report.duration
+        )
+
+    def pytest_sessionfinish(self):
+        self.path.write_text(json_dumps(self.durations, sort_keys=True))
+
+
+def pytest_configure(config):
+    timings = getenv("CI_SHARD_TIMINGS")
+    if timings:
+        config.pluginmanager.register(ShardTimings(Path(timings)), "ci_shard_timings")
+
+
+def pytest_collection_modifyitems(config, items):
+    selected = set(select_tests_from_env(item.nodeid for item in items))
+    deselected = [item for item in items if item.nodeid not in selected]
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = [item for item in items if item.nodeid in selected]
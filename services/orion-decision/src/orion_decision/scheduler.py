@@ -4,13 +4,18 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Scheduler for Orion tasks"""
 import re
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heapify, heappop, heappush
+from itertools import chain
+from json import dumps as json_dump
 from logging import getLogger
 from pathlib import Path
-from string import Template
+from time import perf_counter
 
-from taskcluster.exceptions import TaskclusterFailure
+from dateutil.parser import isoparse
+from taskcluster.exceptions import TaskclusterFailure, TaskclusterRestFailure
 from taskcluster.utils import slugId, stringDate
-from yaml import safe_load as yaml_load
 
 from . import (
     ARTIFACTS_EXPIRE,
@@ -21,19 +26,41 @@ from . import (
     SCHEDULER_ID,
     SOURCE_URL,
     WORKER_TYPE,
+    WORKER_TYPE_ARM64,
     WORKER_TYPE_MSYS,
     Taskcluster,
 )
+from .cache import GraphCache
 from .git import GithubEvent
-from .orion import Service, ServiceMsys, Services
+from .orion import DEFAULT_ARCH, Service, ServiceMsys, Services
+from .profiling import PROFILER
+from .submit import TaskSubmitter
+from .template import TaskTemplate
 
 LOG = getLogger(__name__)
 TEMPLATES = (Path(__file__).parent / "task_templates").resolve()
-BUILD_TASK = Template((TEMPLATES / "build.yaml").read_text())
-MSYS_TASK = Template((TEMPLATES / "build_msys.yaml").read_text())
-PUSH_TASK = Template((TEMPLATES / "push.yaml").read_text())
-TEST_TASK = Template((TEMPLATES / "test.yaml").read_text())
-RECIPE_TEST_TASK = Template((TEMPLATES / "recipe_test.yaml").read_text())
+BUILD_TASK = TaskTemplate.from_file(TEMPLATES / "build.yaml")
+MSYS_TASK = TaskTemplate.from_file(TEMPLATES / "build_msys.yaml")
+PUSH_TASK = TaskTemplate.from_file(TEMPLATES / "push.yaml")
+TEST_TASK = TaskTemplate.from_file(TEMPLATES / "test.yaml")
+RECIPE_TEST_TASK = TaskTemplate.from_file(TEMPLATES / "recipe_test.yaml")
+MANIFEST_TASK = TaskTemplate.from_file(TEMPLATES / "manifest.yaml")
+# worker type used to build images for each architecture
+ARCH_WORKER_TYPES = {"amd64": WORKER_TYPE, "arm64": WORKER_TYPE_ARM64}
+# task priorities, from tasks nothing waits for to the start of the critical path.
+# these stay low so Orion builds don't take over the pool from other tasks.
+PRIORITIES = ("lowest", "very-low", "low", "medium")
+# estimated run time (in seconds) for tasks with no build history
+DEFAULT_COST = 600
+# services estimated to build faster than this (in seconds) can be batched
+BATCH_MAX_COST = 300
+# maximum number of services built in one batch task
+BATCH_MAX_SIZE = 5
+# task states which can still be cancelled
+UNRESOLVED = frozenset(("unscheduled", "pending", "running"))
+# `tags.kind` of tasks which can be cancelled when superseded. pushes and manifests
+# publish what was already built, and decision tasks are never cancelled.
+SUPERSEDED_KINDS = frozenset(("build", "test"))
 
 
 class Scheduler:
@@ -47,10 +74,33 @@ class Scheduler:
         push_branch (str): The branch name that should trigger a push to Docker Hub.
         services (Services): The services
         dry_run (bool): Perform everything *except* actually queuing tasks in TC.
+        reuse_builds (bool): Reuse an existing build of a dirty service if one was
+                             indexed with the same `input_hash`. Only builds for
+                             `push_branch` are indexed this way, and reused.
+        build_history (bool): Estimate build times from the last build of each
+                              service on `push_branch`, to calculate priorities.
+        cancel_superseded (bool): Cancel unfinished tasks from the previous decision
+                                  for the same pull request or branch.
+        batch_builds (bool): Build chains of quick dependent services in a single
+                             task, to save the overhead of a task for each.
     """
 
     def __init__(
-        self, github_event, now, task_group, docker_secret, push_branch, dry_run=False
+        self,
+        github_event,
+        now,
+        task_group,
+        docker_secret,
+        push_branch,
+        dry_run=False,
+        graph_cache=None,
+        scan_workers=1,
+        checkout=True,
+        submit_concurrency=1,
+        reuse_builds=False,
+        build_history=False,
+        cancel_superseded=False,
+        batch_builds=False,
     ):
         """Initialize a Scheduler instance.
 
@@ -61,6 +111,19 @@ class Scheduler:
             docker_secret (str): The Taskcluster secret name holding Docker Hub creds.
             push_branch (str): The branch name that should trigger a push to Docker Hub.
             dry_run (bool): Don't actually queue tasks in Taskcluster.
+            graph_cache (Path or None): File to cache service graph calculations in.
+            scan_workers (int): Number of processes used to scan service files.
+            checkout (bool): Read service files from the working tree. If False,
+                             they are read from the git object database instead.
+            submit_concurrency (int): Maximum number of tasks to submit at once.
+            reuse_builds (bool): Look up builds of dirty services by `input_hash`,
+                                 and use them instead of building again (only
+                                 for pushes to `push_branch`).
+            build_history (bool): Look up previous build times of dirty services.
+            cancel_superseded (bool): Cancel unfinished tasks from the previous
+                                      decision for the same pull request or branch.
+            batch_builds (bool): Build chains of quick dependent services in a
+                                 single task.
         """
         self.github_event = github_event
         self.now = now
@@ -68,7 +131,35 @@ class Scheduler:
         self.docker_secret = docker_secret
         self.push_branch = push_branch
         self.dry_run = dry_run
-        self.services = Services(self.github_event.repo)
+        self.reuse_builds = reuse_builds
+        self.build_history = build_history
+        self.cancel_superseded = cancel_superseded
+        self.batch_builds = batch_builds
+        # services which must be built, even if the same inputs were built before
+        self._force_rebuild = set()
+        self._submitter = TaskSubmitter(
+            submit_concurrency, lambda: Taskcluster.get_service("queue")
+        )
+        cache = None
+        if graph_cache is not None:
+            cache = GraphCache(graph_cache)
+        with PROFILER.phase("graph"):
+            self.services = Services(
+                self.github_event.repo,
+                cache=cache,
+                workers=scan_workers,
+                revision=None if checkout else self.github_event.commit,
+                hashes=reuse_builds and self._should_push,
+            )
+
+    @property
+    def _should_push(self):
+        """Whether this decision is for `push_branch`, so images are pushed to
+        Docker Hub. Only builds in these decisions are trusted to be reused."""
+        return (
+            self.github_event.event_type == "push"
+            and self.github_event.branch == self.push_branch
+        )
 
     def mark_services_for_rebuild(self):
         """Check for services that need to be rebuilt.
@@ -92,100 +183,563 @@ class Scheduler:
                 LOG.info("/force-rebuild detected, all services will be marked dirty")
                 for service in self.services.values():
                     service.dirty = True
+                self._force_rebuild.update(self.services)
                 return  # short-cut, no point in continuing
         if forced:
             LOG.info(
                 "/force-rebuild detected for service: %s", ", ".join(sorted(forced))
             )
-        self.services.mark_changed_dirty(self.github_event.list_changed_paths())
+            self._force_rebuild.update(forced)
+        with PROFILER.phase("diff"):
+            changed = self.github_event.list_changed_paths()
+        with PROFILER.phase("dirty"):
+            self.services.mark_changed_dirty(changed)
 
-    def _create_build_task(
-        self, service, dirty_dep_tasks, test_tasks, service_build_tasks
-    ):
+    def _group_index(self):
+        """Index namespace for the latest decision on this branch or pull request.
+
+        Returns:
+            str: Namespace (without the `index.` route prefix).
+        """
         if self.github_event.pull_request is not None:
-            build_index = (
-                f"index.project.fuzzing.orion.{service.name}"
+            return (
+                "project.fuzzing.orion.task-group"
                 f".pull_request.{self.github_event.pull_request}"
             )
-        else:
-            build_index = (
-                f"index.project.fuzzing.orion.{service.name}"
-                f".{self.github_event.branch}"
-            )
-        if isinstance(service, ServiceMsys):
-            build_task = yaml_load(
-                MSYS_TASK.substitute(
-                    clone_url=self.github_event.http_url,
-                    commit=self.github_event.commit,
-                    deadline=stringDate(self.now + DEADLINE),
-                    expires=stringDate(self.now + ARTIFACTS_EXPIRE),
-                    max_run_time=int(MAX_RUN_TIME.total_seconds()),
-                    msys_base_url=service.base,
-                    now=stringDate(self.now),
-                    owner_email=OWNER_EMAIL,
-                    provisioner=PROVISIONER_ID,
-                    route=build_index,
-                    scheduler=SCHEDULER_ID,
-                    service_name=service.name,
-                    setup_sh_path=str(
-                        (service.root / "setup.sh").relative_to(service.context)
-                    ),
-                    source_url=SOURCE_URL,
-                    task_group=self.task_group,
-                    worker=WORKER_TYPE_MSYS,
+        return f"project.fuzzing.orion.task-group.{self.github_event.branch}"
+
+    def _iter_group(self, task_group):
+        """List the tasks in a task group.
+
+        Arguments:
+            task_group (str): Task group ID.
+
+        Yields:
+            dict: Task definition (`task`) and status (`status`) for each task in
+                  the group.
+        """
+        queue = Taskcluster.get_service("queue")
+        query = {}
+        while True:
+            result = queue.listTaskGroup(task_group, query=query)
+            for task in result["tasks"]:
+                yield task
+            if not result.get("continuationToken"):
+                break
+            query = {"continuationToken": result["continuationToken"]}
+
+    def cancel_superseded_tasks(self):
+        """Cancel unfinished build and test tasks from the previous decision on this
+        branch or pull request, and record this decision as the latest.
+
+        A pull request event always covers every change in the pull request, so
+        nothing is lost by cancelling the previous decision. A push event only
+        covers the commits pushed, so services which were dirty in the previous
+        decision are marked dirty here if any of its tasks were cancelled.
+
+        Must be called after `mark_services_for_rebuild()`.
+
+        Returns:
+            None
+        """
+        if not self.cancel_superseded or self.github_event.event_type == "release":
+            return
+        namespace = self._group_index()
+        index = Taskcluster.get_service("index")
+        try:
+            previous = index.findTask(namespace)
+        except TaskclusterRestFailure as exc:
+            if exc.status_code != 404:
+                LOG.warning("Error looking up %s: %s", namespace, exc)
+            previous = None
+        except TaskclusterFailure as exc:
+            LOG.warning("Error looking up %s: %s", namespace, exc)
+            previous = None
+
+        if previous is not None and previous["taskId"] != self.task_group:
+            queue = Taskcluster.get_service("queue")
+            cancelled = 0
+            try:
+                for task in self._iter_group(previous["taskId"]):
+                    status = task["status"]
+                    kind = task["task"].get("tags", {}).get("kind")
+                    if status["state"] not in UNRESOLVED:
+                        continue
+                    if kind not in SUPERSEDED_KINDS:
+                        continue
+                    LOG.info(
+                        "%s superseded task %s",
+                        "Would cancel" if self.dry_run else "Cancelling",
+                        status["taskId"],
+                    )
+                    if not self.dry_run:
+                        queue.cancelTask(status["taskId"])
+                    cancelled += 1
+            except TaskclusterFailure as exc:
+                # cancelling is only an optimization, don't fail the decision
+                LOG.warning(
+                    "Error cancelling tasks in group %s: %s", previous["taskId"], exc
                 )
+            if cancelled and self.github_event.pull_request is None:
+                inherited = []
+                for name in previous.get("data", {}).get("dirty", []):
+                    obj = self.services.get(name, self.services.recipes.get(name))
+                    if obj is not None and not obj.dirty:
+                        obj.dirty = True
+                        inherited.append(name)
+                if inherited:
+                    LOG.warning(
+                        "Marked dirty from superseded task group %s: %s",
+                        previous["taskId"],
+                        ", ".join(inherited),
+                    )
+            LOG.info(
+                "%s %d tasks from superseded task group %s",
+                "Would cancel" if self.dry_run else "Cancelled",
+                cancelled,
+                previous["taskId"],
             )
-        else:
-            build_task = yaml_load(
-                BUILD_TASK.substitute(
-                    clone_url=self.github_event.http_url,
-                    commit=self.github_event.commit,
-                    deadline=stringDate(self.now + DEADLINE),
-                    dockerfile=str(service.dockerfile.relative_to(service.context)),
-                    expires=stringDate(self.now + ARTIFACTS_EXPIRE),
-                    load_deps="1" if dirty_dep_tasks else "0",
-                    max_run_time=int(MAX_RUN_TIME.total_seconds()),
-                    now=stringDate(self.now),
-                    owner_email=OWNER_EMAIL,
-                    provisioner=PROVISIONER_ID,
-                    route=build_index,
-                    scheduler=SCHEDULER_ID,
-                    service_name=service.name,
-                    source_url=SOURCE_URL,
-                    task_group=self.task_group,
-                    worker=WORKER_TYPE,
-                )
+
+        dirty = sorted(
+            obj.name
+            for obj in chain(self.services.values(), self.services.recipes.values())
+            if obj.dirty
+        )
+        LOG.info("%s index %s -> %s", self._create_str, namespace, self.task_group)
+        if not self.dry_run:
+            index.insertTask(
+                namespace,
+                {
+                    "taskId": self.task_group,
+                    "rank": 0,
+                    "data": {"dirty": dirty},
+                    "expires": stringDate(self.now + DEADLINE),
+                },
             )
-        build_task["dependencies"].extend(dirty_dep_tasks + test_tasks)
-        task_id = service_build_tasks[service.name]
+
+    def _build_index(self, service, arch=None):
+        """Index namespace for the branch or pull request a build of `service` is for.
+
+        Arguments:
+            service (Service): Service being built.
+            arch (str or None): Architecture of the build, if not `DEFAULT_ARCH` of
+                                a multi-architecture service.
+
+        Returns:
+            str: Namespace (without the `index.` route prefix).
+        """
+        namespace = f"project.fuzzing.orion.{service.name}"
+        if arch is not None:
+            namespace += f".arch.{arch}"
+        if self.github_event.pull_request is not None:
+            return f"{namespace}.pull_request.{self.github_event.pull_request}"
+        return f"{namespace}.{self.github_event.branch}"
+
+    @staticmethod
+    def _image_artifact(service, arch=DEFAULT_ARCH):
+        """Artifact name of the image built for `service`.
+
+        Images for architectures other than `DEFAULT_ARCH` are in a folder, so the
+        file name still gives the image name when loaded as a dependency.
+
+        Arguments:
+            service (Service): Service being built.
+            arch (str): Architecture of the build.
+
+        Returns:
+            str: Artifact name.
+        """
+        if arch == DEFAULT_ARCH:
+            return f"public/{service.name}.tar.zst"
+        return f"public/{arch}/{service.name}.tar.zst"
+
+    def _find_build(self, service):
+        """Find an existing build of `service` with the same inputs.
+
+        Arguments:
+            service (Service): Dirty service to look up.
+
+        Returns:
+            dict or None: Index entry for the build task (`taskId` and `expires`),
+                          or None if the service must be built.
+        """
+        if (
+            not self.reuse_builds
+            or not self._should_push
+            or service.input_hash is None
+            or service.multiarch
+            or service.name in self._force_rebuild
+        ):
+            return None
+        namespace = f"project.fuzzing.orion.{service.name}.hash.{service.input_hash}"
+        try:
+            return Taskcluster.get_service("index").findTask(namespace)
+        except TaskclusterRestFailure as exc:
+            if exc.status_code != 404:
+                LOG.warning("Error looking up %s: %s", namespace, exc)
+        except TaskclusterFailure as exc:
+            LOG.warning("Error looking up %s: %s", namespace, exc)
+        return None
+
+    def _reuse_build_task(self, service, build):
+        """Index an existing build of `service` as if it was built in this decision.
+
+        Arguments:
+            service (Service): Service being reused.
+            build (dict): Index entry for the existing build task.
+
+        Returns:
+            str: The existing build task ID.
+        """
+        task_id = build["taskId"]
         LOG.info(
-            "%s task %s: %s", self._create_str, task_id, build_task["metadata"]["name"]
+            "Service %s was already built with the same inputs in task %s",
+            service.name,
+            task_id,
         )
-        if not self.dry_run:
-            try:
-                Taskcluster.get_service("queue").createTask(task_id, build_task)
-            except TaskclusterFailure as exc:  # pragma: no cover
-                LOG.error("Error creating build task: %s", exc)
-                raise
+        index = None if self.dry_run else Taskcluster.get_service("index")
+        # the same routes as in the build task template
+        for namespace in (
+            f"project.fuzzing.orion.{service.name}.rev.{self.github_event.commit}",
+            self._build_index(service),
+        ):
+            LOG.info("%s index %s -> %s", self._create_str, namespace, task_id)
+            if index is not None:
+                index.insertTask(
+                    namespace,
+                    {
+                        "taskId": task_id,
+                        "rank": 0,
+                        "data": {},
+                        "expires": build["expires"],
+                    },
+                )
         return task_id
 
-    def _create_push_task(self, service, service_build_tasks):
-        push_task = yaml_load(
-            PUSH_TASK.substitute(
+    def _build_duration(self, service):
+        """Find how long the last build of `service` on `push_branch` took.
+
+        Arguments:
+            service (Service): Service to look up.
+
+        Returns:
+            float or None: Run time in seconds, or None if not known.
+        """
+        if not self.build_history:
+            return None
+        namespace = f"project.fuzzing.orion.{service.name}.{self.push_branch}"
+        try:
+            task_id = Taskcluster.get_service("index").findTask(namespace)["taskId"]
+            status = Taskcluster.get_service("queue").status(task_id)["status"]
+        except TaskclusterFailure as exc:
+            LOG.debug("No build history for %s: %s", service.name, exc)
+            return None
+        for run in reversed(status["runs"]):
+            if run["state"] == "completed":
+                started = isoparse(run["started"])
+                return (isoparse(run["resolved"]) - started).total_seconds()
+        return None
+
+    def _lookup(self, func, objs):
+        """Call `func` for each of `objs`, concurrently if submitting concurrently.
+
+        Arguments:
+            func (callable): Function to call with each object.
+            objs (list): Objects to look up.
+
+        Returns:
+            list: Result of `func` for each object, in order.
+        """
+        if self._submitter.max_in_flight == 1 or len(objs) < 2:
+            return [func(obj) for obj in objs]
+        with ThreadPoolExecutor(max_workers=self._submitter.max_in_flight) as pool:
+            return list(pool.map(func, objs))
+
+    def _priorities(self, to_create, dependents, order, costs):
+        """Calculate task priorities from the critical path of each task.
+
+        Each task is prioritized by the estimated time from its start until the
+        last task depending on it finishes, relative to the longest such path.
+        Tasks nothing depends on get the lowest priority.
+
+        Arguments:
+            to_create (list(Service/Recipe)): Dirty services and recipes.
+            dependents (list(list(int))): Indices of the dirty objects depending on
+                                          each of `to_create`.
+            order (list(int)): Indices of `to_create` in topological order.
+            costs (list(float)): Estimated run time of each of `to_create`.
+
+        Returns:
+            list(str): Taskcluster priority for each of `to_create`.
+        """
+        downstream = [0.0] * len(to_create)
+        depth = [0] * len(to_create)
+        for idx in reversed(order):
+            for dependent in dependents[idx]:
+                downstream[idx] = max(downstream[idx], downstream[dependent])
+                depth[idx] = max(depth[idx], depth[dependent])
+            downstream[idx] += costs[idx]
+            depth[idx] += 1
+        longest = max(downstream, default=0.0)
+        if longest:
+            start = downstream.index(longest)
+            LOG.info(
+                "Critical path starts at %s %s: %d tasks, ~%ds",
+                type(to_create[start]).__name__,
+                to_create[start].name,
+                depth[start],
+                longest,
+            )
+        result = []
+        for idx, obj in enumerate(to_create):
+            if not dependents[idx] or not longest:
+                level = 0
+            else:
+                level = int((len(PRIORITIES) - 1) * downstream[idx] / longest)
+            LOG.debug(
+                "%s %s: %d tasks, ~%ds on critical path, priority %s",
+                type(obj).__name__,
+                obj.name,
+                depth[idx],
+                downstream[idx],
+                PRIORITIES[level],
+            )
+            result.append(PRIORITIES[level])
+        return result
+
+    def _batches(self, to_create, dependents, order, costs, reused):
+        """Find chains of quick builds which can be done in a single task.
+
+        A service can be built in the same task as the service it is built from,
+        if that is its only dirty build dependency, nothing else waits for the
+        earlier build, and it has no tests or recipe tests of its own (these run
+        before the build, so would have to wait for the whole batch).
+
+        Arguments:
+            to_create (list(Service/Recipe)): Dirty services and recipes.
+            dependents (list(list(int))): Indices of the dirty objects depending on
+                                          each of `to_create`.
+            order (list(int)): Indices of `to_create` in topological order.
+            costs (list(float)): Estimated run time of each of `to_create`.
+            reused (dict(Service -> dict or None)): Existing builds of services.
+
+        Returns:
+            dict(int -> list(int)): Indices of the services in each batch (in build
+                                    order), by the index of the first service.
+        """
+        if not self.batch_builds:
+            return {}
+        position = {obj: idx for idx, obj in enumerate(to_create)}
+
+        def _batchable(idx):
+            obj = to_create[idx]
+            return (
+                isinstance(obj, Service)
+                and not isinstance(obj, ServiceMsys)
+                and not obj.multiarch
+                and reused.get(obj) is None
+                and costs[idx] <= BATCH_MAX_COST
+            )
+
+        batch_of = {}
+        batches = {}
+        for idx in order:
+            obj = to_create[idx]
+            if not _batchable(idx) or obj.tests:
+                continue
+            if any(self.services.recipes[dep].dirty for dep in obj.recipe_deps):
+                continue
+            deps = [dep for dep in obj.service_deps if self.services[dep].dirty]
+            if len(deps) != 1:
+                continue
+            prev = position[self.services[deps[0]]]
+            if not _batchable(prev) or dependents[prev] != [idx]:
+                continue
+            head = batch_of.get(prev, prev)
+            batch = batches.setdefault(head, [head])
+            if len(batch) == BATCH_MAX_SIZE:
+                continue
+            batch.append(idx)
+            batch_of[idx] = head
+        for batch in batches.values():
+            LOG.info(
+                "Building %s in one task",
+                ", ".join(to_create[idx].name for idx in batch),
+            )
+        return batches
+
+    def _create_build_task(
+        self,
+        service,
+        dirty_dep_tasks,
+        test_tasks,
+        service_build_tasks,
+        priority,
+        batch=(),
+        arch=None,
+        task_id=None,
+    ):
+        """Create a build task for `service`.
+
+        Arguments:
+            service (Service): Service to build.
+            dirty_dep_tasks (list(str)): Build tasks the service depends on.
+            test_tasks (list(str)): Test tasks which must pass before building.
+            service_build_tasks (dict(str -> str)): Build task ID for each service.
+            priority (str): Task priority.
+            batch (iterable(Service)): Services to build in the same task, after
+                                       `service`, each built from the previous one.
+            arch (str or None): Architecture to build a multi-architecture service
+                                for, if not `DEFAULT_ARCH`.
+            task_id (str or None): Task ID, if not from `service_build_tasks`.
+
+        Returns:
+            str: Build task ID.
+        """
+        build_index = f"index.{self._build_index(service, arch)}"
+        if isinstance(service, ServiceMsys):
+            build_task = MSYS_TASK.fill(
                 clone_url=self.github_event.http_url,
                 commit=self.github_event.commit,
                 deadline=stringDate(self.now + DEADLINE),
-                docker_secret=self.docker_secret,
+                expires=stringDate(self.now + ARTIFACTS_EXPIRE),
                 max_run_time=int(MAX_RUN_TIME.total_seconds()),
+                msys_base_url=service.base,
                 now=stringDate(self.now),
                 owner_email=OWNER_EMAIL,
                 provisioner=PROVISIONER_ID,
+                route=build_index,
                 scheduler=SCHEDULER_ID,
                 service_name=service.name,
+                setup_sh_path=str(
+                    (service.root / "setup.sh").relative_to(service.context)
+                ),
                 source_url=SOURCE_URL,
                 task_group=self.task_group,
-                worker=WORKER_TYPE,
+                priority=priority,
+                worker=WORKER_TYPE_MSYS,
+            )
+        else:
+            dockerfile = service.dockerfile
+            if service.multiarch:
+                dockerfile = service.archs[arch or DEFAULT_ARCH]
+            build_task = BUILD_TASK.fill(
+                clone_url=self.github_event.http_url,
+                commit=self.github_event.commit,
+                deadline=stringDate(self.now + DEADLINE),
+                dockerfile=str(dockerfile.relative_to(service.context)),
+                expires=stringDate(self.now + ARTIFACTS_EXPIRE),
+                load_deps="1" if dirty_dep_tasks else "0",
+                max_run_time=int(MAX_RUN_TIME.total_seconds()),
+                now=stringDate(self.now),
+                owner_email=OWNER_EMAIL,
+                priority=priority,
+                provisioner=PROVISIONER_ID,
+                route=build_index,
+                scheduler=SCHEDULER_ID,
+                service_name=service.name,
+                source_url=SOURCE_URL,
+                task_group=self.task_group,
+                worker=ARCH_WORKER_TYPES[arch] if arch else WORKER_TYPE,
+            )
+        build_task["dependencies"].extend(dirty_dep_tasks + test_tasks)
+        if arch is not None:
+            (artifact,) = build_task["payload"]["artifacts"].values()
+            build_task["payload"]["artifacts"] = {
+                self._image_artifact(service, arch): artifact
+            }
+            build_task["routes"][0] = (
+                f"index.project.fuzzing.orion.{service.name}.arch.{arch}"
+                f".rev.{self.github_event.commit}"
+            )
+            build_task["metadata"]["name"] = f"Orion {service.name} {arch} docker build"
+        # only trusted builds can be reused
+        if (
+            self._should_push
+            and service.input_hash is not None
+            and not service.multiarch
+        ):
+            build_task["routes"].append(
+                f"index.project.fuzzing.orion.{service.name}"
+                f".hash.{service.input_hash}"
+            )
+        if batch:
+            self._batch_build_task(build_task, [service, *batch])
+        if task_id is None:
+            task_id = service_build_tasks[service.name]
+        LOG.info(
+            "%s task %s: %s", self._create_str, task_id, build_task["metadata"]["name"]
+        )
+        if not self.dry_run:
+            self._submitter.submit(task_id, build_task)
+        return task_id
+
+    def _batch_build_task(self, build_task, services):
+        """Convert a build task for one service into a build of several.
+
+        Arguments:
+            build_task (dict): Build task for the first of `services`.
+            services (list(Service)): Services to build, in order.
+
+        Returns:
+            None
+        """
+        env = build_task["payload"]["env"]
+        expires = build_task["payload"]["artifacts"].popitem()[1]["expires"]
+        for var in ("ARCHIVE_PATH", "DOCKERFILE", "IMAGE_NAME"):
+            del env[var]
+        env["BATCH"] = json_dump(
+            [
+                {
+                    "dockerfile": str(svc.dockerfile.relative_to(svc.context)),
+                    "image": f"mozillasecurity/{svc.name}",
+                    "output": f"/images/{svc.name}.tar",
+                }
+                for svc in services
+            ]
+        )
+        for svc in services:
+            build_task["payload"]["artifacts"][f"public/{svc.name}.tar.zst"] = {
+                "expires": expires,
+                "path": f"/images/{svc.name}.tar.zst",
+                "type": "file",
+            }
+        # the same routes as in the build task template
+        for svc in services[1:]:
+            build_task["routes"].extend(
+                (
+                    "index.project.fuzzing.orion."
+                    f"{svc.name}.rev.{self.github_event.commit}",
+                    f"index.{self._build_index(svc)}",
+                )
             )
+            if self._should_push and svc.input_hash is not None:
+                build_task["routes"].append(
+                    f"index.project.fuzzing.orion.{svc.name}.hash.{svc.input_hash}"
+                )
+        names = ", ".join(svc.name for svc in services)
+        build_task["metadata"]["name"] = f"Orion {names} docker build"
+        build_task["metadata"][
+            "description"
+        ] = f"Build the docker images for {names} tasks"
+
+    def _create_push_task(self, service, service_build_tasks):
+        push_task = PUSH_TASK.fill(
+            clone_url=self.github_event.http_url,
+            commit=self.github_event.commit,
+            deadline=stringDate(self.now + DEADLINE),
+            docker_secret=self.docker_secret,
+            max_run_time=int(MAX_RUN_TIME.total_seconds()),
+            now=stringDate(self.now),
+            owner_email=OWNER_EMAIL,
+            # nothing depends on pushes
+            priority=PRIORITIES[0],
+            provisioner=PROVISIONER_ID,
+            scheduler=SCHEDULER_ID,
+            service_name=service.name,
+            source_url=SOURCE_URL,
+            task_group=self.task_group,
+            worker=WORKER_TYPE,
         )
         push_task["dependencies"].append(service_build_tasks[service.name])
         task_id = slugId()
@@ -193,14 +747,60 @@ class Scheduler:
             "%s task %s: %s", self._create_str, task_id, push_task["metadata"]["name"]
         )
         if not self.dry_run:
-            try:
-                Taskcluster.get_service("queue").createTask(task_id, push_task)
-            except TaskclusterFailure as exc:  # pragma: no cover
-                LOG.error("Error creating push task: %s", exc)
-                raise
+            self._submitter.submit(task_id, push_task)
         return task_id
 
-    def _create_svc_test_task(self, service, test, service_build_tasks):
+    def _create_manifest_task(self, service, arch_build_tasks, push_task):
+        """Create a task to publish the multi-architecture manifest for `service`.
+
+        Arguments:
+            service (Service): Multi-architecture service.
+            arch_build_tasks (dict(str -> str)): Build task ID for each architecture.
+            push_task (str): Task pushing the `DEFAULT_ARCH` image, which the manifest
+                             replaces as `latest`.
+
+        Returns:
+            str: Manifest task ID.
+        """
+        manifest_task = MANIFEST_TASK.fill(
+            arch_images=" ".join(
+                f"{arch}={task_id}:{self._image_artifact(service, arch)}"
+                for arch, task_id in sorted(arch_build_tasks.items())
+            ),
+            clone_url=self.github_event.http_url,
+            commit=self.github_event.commit,
+            deadline=stringDate(self.now + DEADLINE),
+            docker_secret=self.docker_secret,
+            # shlex.join() needs python 3.8
+            manifest_command=" ".join(
+                shlex.quote(arg) for arg in service.manifest or []
+            ),
+            max_run_time=int(MAX_RUN_TIME.total_seconds()),
+            now=stringDate(self.now),
+            owner_email=OWNER_EMAIL,
+            priority=PRIORITIES[0],
+            provisioner=PROVISIONER_ID,
+            scheduler=SCHEDULER_ID,
+            service_name=service.name,
+            source_url=SOURCE_URL,
+            task_group=self.task_group,
+            worker=WORKER_TYPE,
+        )
+        manifest_task["dependencies"].extend(
+            [task_id for _, task_id in sorted(arch_build_tasks.items())] + [push_task]
+        )
+        task_id = slugId()
+        LOG.info(
+            "%s task %s: %s",
+            self._create_str,
+            task_id,
+            manifest_task["metadata"]["name"],
+        )
+        if not self.dry_run:
+            self._submitter.submit(task_id, manifest_task)
+        return task_id
+
+    def _create_svc_test_task(self, service, test, service_build_tasks, priority):
         image = test.image
         deps = []
         if image in service_build_tasks:
@@ -216,20 +816,19 @@ class Scheduler:
                     "namespace": (f"project.fuzzing.orion.{image}.{self.push_branch}"),
                 }
             image["path"] = f"public/{test.image}.tar.zst"
-        test_task = yaml_load(
-            TEST_TASK.substitute(
-                deadline=stringDate(self.now + DEADLINE),
-                max_run_time=int(MAX_RUN_TIME.total_seconds()),
-                now=stringDate(self.now),
-                owner_email=OWNER_EMAIL,
-                provisioner=PROVISIONER_ID,
-                scheduler=SCHEDULER_ID,
-                service_name=service.name,
-                source_url=SOURCE_URL,
-                task_group=self.task_group,
-                test_name=test.name,
-                worker=WORKER_TYPE,
-            )
+        test_task = TEST_TASK.fill(
+            deadline=stringDate(self.now + DEADLINE),
+            max_run_time=int(MAX_RUN_TIME.total_seconds()),
+            now=stringDate(self.now),
+            owner_email=OWNER_EMAIL,
+            priority=priority,
+            provisioner=PROVISIONER_ID,
+            scheduler=SCHEDULER_ID,
+            service_name=service.name,
+            source_url=SOURCE_URL,
+            task_group=self.task_group,
+            test_name=test.name,
+            worker=WORKER_TYPE,
         )
         test_task["payload"]["image"] = image
         test_task["dependencies"].extend(deps)
@@ -246,34 +845,29 @@ class Scheduler:
             "%s task %s: %s", self._create_str, task_id, test_task["metadata"]["name"]
         )
         if not self.dry_run:
-            try:
-                Taskcluster.get_service("queue").createTask(task_id, test_task)
-            except TaskclusterFailure as exc:  # pragma: no cover
-                LOG.error("Error creating test task: %s", exc)
-                raise
+            self._submitter.submit(task_id, test_task)
         return task_id
 
-    def _create_recipe_test_task(self, recipe, dep_tasks, recipe_test_tasks):
+    def _create_recipe_test_task(self, recipe, dep_tasks, recipe_test_tasks, priority):
         service_path = self.services.root / "services" / "test-recipes"
         dockerfile = service_path / f"Dockerfile-{recipe.file.stem}"
-        if not dockerfile.is_file():
+        if dockerfile not in self.services.files:
             dockerfile = service_path / "Dockerfile"
-        test_task = yaml_load(
-            RECIPE_TEST_TASK.substitute(
-                clone_url=self.github_event.http_url,
-                commit=self.github_event.commit,
-                deadline=stringDate(self.now + DEADLINE),
-                dockerfile=str(dockerfile.relative_to(self.services.root)),
-                max_run_time=int(MAX_RUN_TIME.total_seconds()),
-                now=stringDate(self.now),
-                owner_email=OWNER_EMAIL,
-                provisioner=PROVISIONER_ID,
-                recipe_name=recipe.name,
-                scheduler=SCHEDULER_ID,
-                source_url=SOURCE_URL,
-                task_group=self.task_group,
-                worker=WORKER_TYPE,
-            )
+        test_task = RECIPE_TEST_TASK.fill(
+            clone_url=self.github_event.http_url,
+            commit=self.github_event.commit,
+            deadline=stringDate(self.now + DEADLINE),
+            dockerfile=str(dockerfile.relative_to(self.services.root)),
+            max_run_time=int(MAX_RUN_TIME.total_seconds()),
+            now=stringDate(self.now),
+            owner_email=OWNER_EMAIL,
+            priority=priority,
+            provisioner=PROVISIONER_ID,
+            recipe_name=recipe.name,
+            scheduler=SCHEDULER_ID,
+            source_url=SOURCE_URL,
+            task_group=self.task_group,
+            worker=WORKER_TYPE,
         )
         test_task["dependencies"].extend(dep_tasks)
         task_id = recipe_test_tasks[recipe.name]
@@ -281,11 +875,7 @@ class Scheduler:
             "%s task %s: %s", self._create_str, task_id, test_task["metadata"]["name"]
         )
         if not self.dry_run:
-            try:
-                Taskcluster.get_service("queue").createTask(task_id, test_task)
-            except TaskclusterFailure as exc:  # pragma: no cover
-                LOG.error("Error creating recipe test task: %s", exc)
-                raise
+            self._submitter.submit(task_id, test_task)
         return task_id
 
     @property
@@ -309,15 +899,22 @@ class Scheduler:
         if self.github_event.event_type == "release":
             LOG.warning("Detected release event. Nothing to do!")
             return
-        should_push = (
-            self.github_event.event_type == "push"
-            and self.github_event.branch == self.push_branch
-        )
+        should_push = self._should_push
         service_build_tasks = {service: slugId() for service in self.services}
+        # (service, arch) -> task ID, for architectures other than DEFAULT_ARCH
+        arch_build_tasks = {
+            (service.name, arch): slugId()
+            for service in self.services.values()
+            if service.multiarch
+            for arch in service.archs
+            if arch != DEFAULT_ARCH
+        }
         recipe_test_tasks = {recipe: slugId() for recipe in self.services.recipes}
         test_tasks_created = set()
         build_tasks_created = set()
+        build_tasks_reused = set()
         push_tasks_created = set()
+        manifest_tasks_created = set()
         if not should_push:
             LOG.info(
                 "Not pushing to Docker Hub (event is %s, branch is %s, only push %s)",
@@ -325,89 +922,174 @@ class Scheduler:
                 self.github_event.branch,
                 self.push_branch,
             )
-        to_create = sorted(
+        to_create = []
+        for obj in sorted(
             self.services.recipes.values(), key=lambda x: x.name
-        ) + sorted(self.services.values(), key=lambda x: x.name)
-        while to_create:
-            obj = to_create.pop(0)
-            is_svc = isinstance(obj, Service)
-            is_msys = isinstance(obj, ServiceMsys)
-
-            if not obj.dirty:
-                if is_svc:
-                    LOG.info("Service %s doesn't need to be rebuilt", obj.name)
-                continue
+        ) + sorted(self.services.values(), key=lambda x: x.name):
+            if obj.dirty:
+                to_create.append(obj)
+            elif isinstance(obj, Service):
+                LOG.info("Service %s doesn't need to be rebuilt", obj.name)
+
+        # Kahn's algorithm over the dirty objects: each is created after all the
+        # dirty objects it depends on, and ties are broken by the order above, so
+        # the result is deterministic.
+        position = {obj: idx for idx, obj in enumerate(to_create)}
+        dependents = [[] for _ in to_create]
+        in_degree = [0] * len(to_create)
+        for idx, obj in enumerate(to_create):
+            deps = {self.services[dep] for dep in obj.service_deps}
+            deps.update(self.services.recipes[dep] for dep in obj.recipe_deps)
+            if isinstance(obj, Service):
+                deps.update(
+                    self.services[test.image]
+                    for test in obj.tests
+                    if test.image in self.services
+                )
+            for dep in deps:
+                if dep.dirty:
+                    dependents[position[dep]].append(idx)
+                    in_degree[idx] += 1
+        ready = [idx for idx, degree in enumerate(in_degree) if not degree]
+        heapify(ready)
+        order = []
+        while ready:
+            idx = heappop(ready)
+            order.append(idx)
+            for dependent in dependents[idx]:
+                in_degree[dependent] -= 1
+                if not in_degree[dependent]:
+                    heappush(ready, dependent)
+        # `Services` rejects dependency cycles, so everything is reachable
+        assert not any(in_degree), "dependency cycle in dirty services"
+
+        services = [obj for obj in to_create if isinstance(obj, Service)]
+        with PROFILER.phase("lookup"):
+            reused = dict(zip(services, self._lookup(self._find_build, services)))
+            built = [svc for svc in services if reused[svc] is None]
+            durations = dict(zip(built, self._lookup(self._build_duration, built)))
+        costs = []
+        for obj in to_create:
+            if reused.get(obj) is not None:
+                costs.append(0.0)
+            elif durations.get(obj) is not None:
+                costs.append(durations[obj])
+            else:
+                costs.append(DEFAULT_COST)
+        priorities = self._priorities(to_create, dependents, order, costs)
+        batches = self._batches(to_create, dependents, order, costs, reused)
+        batched = set()
+        for head, batch in batches.items():
+            for idx in batch[1:]:
+                service_build_tasks[to_create[idx].name] = service_build_tasks[
+                    to_create[head].name
+                ]
+                batched.add(idx)
+
+        # rendering tasks, including any `createTask` calls made synchronously
+        # (which are also counted in "submit")
+        start = perf_counter()
+        for idx in order:
+            obj = to_create[idx]
             dirty_dep_tasks = [
                 service_build_tasks[dep]
-                for dep in obj.service_deps
+                for dep in sorted(obj.service_deps)
                 if self.services[dep].dirty
             ]
-            if is_svc:
-                dirty_test_dep_tasks = [
-                    service_build_tasks[test.image]
-                    for test in obj.tests
-                    if test.image in service_build_tasks
-                    and self.services[test.image].dirty
-                ]
-            else:
-                dirty_test_dep_tasks = []
             dirty_recipe_test_tasks = [
                 recipe_test_tasks[recipe]
-                for recipe in obj.recipe_deps
+                for recipe in sorted(obj.recipe_deps)
                 if self.services.recipes[recipe].dirty
             ]
 
-            pending_deps = (
-                set(dirty_dep_tasks) | set(dirty_test_dep_tasks)
-            ) - build_tasks_created
-            pending_deps |= set(dirty_recipe_test_tasks) - test_tasks_created
-            if pending_deps:
-                if is_svc:
-                    task_id = service_build_tasks[obj.name]
-                else:
-                    task_id = recipe_test_tasks[obj.name]
-
-                LOG.debug(
-                    "Can't create %s %s task %s before dependencies: %s",
-                    type(obj).__name__,
-                    obj.name,
-                    task_id,
-                    ", ".join(pending_deps),
-                )
-                to_create.append(obj)
-                continue
+            if isinstance(obj, Service):
+                build = reused[obj]
+                if build is not None:
+                    # dependent tasks will use the existing image
+                    service_build_tasks[obj.name] = self._reuse_build_task(obj, build)
+                    build_tasks_reused.add(obj.name)
+                    if should_push and not isinstance(obj, ServiceMsys):
+                        push_tasks_created.add(
+                            self._create_push_task(obj, service_build_tasks)
+                        )
+                    continue
+
+                if idx in batched:
+                    # built in the task for the first service in the batch
+                    if should_push:
+                        push_tasks_created.add(
+                            self._create_push_task(obj, service_build_tasks)
+                        )
+                    continue
 
-            if is_svc:
                 test_tasks = []
                 for test in obj.tests:
-                    task_id = self._create_svc_test_task(obj, test, service_build_tasks)
+                    task_id = self._create_svc_test_task(
+                        obj, test, service_build_tasks, priorities[idx]
+                    )
                     test_tasks_created.add(task_id)
                     test_tasks.append(task_id)
                 test_tasks.extend(dirty_recipe_test_tasks)
 
                 build_tasks_created.add(
                     self._create_build_task(
-                        obj, dirty_dep_tasks, test_tasks, service_build_tasks
+                        obj,
+                        dirty_dep_tasks,
+                        test_tasks,
+                        service_build_tasks,
+                        priorities[idx],
+                        [to_create[member] for member in batches.get(idx, [])[1:]],
                     )
                 )
-                if should_push and not is_msys:
-                    push_tasks_created.add(
-                        self._create_push_task(obj, service_build_tasks)
+                # other architectures are built in parallel, from the same
+                # architecture of each dependency built here. a dependency not
+                # built for that architecture is only published for DEFAULT_ARCH,
+                # so that build is used (as it would be when pulled).
+                obj_arch_tasks = {DEFAULT_ARCH: service_build_tasks[obj.name]}
+                for arch in sorted(obj.archs):
+                    if not obj.multiarch or arch == DEFAULT_ARCH:
+                        continue
+                    obj_arch_tasks[arch] = self._create_build_task(
+                        obj,
+                        [
+                            arch_build_tasks.get((dep, arch), service_build_tasks[dep])
+                            for dep in sorted(obj.service_deps)
+                            if self.services[dep].dirty
+                        ],
+                        test_tasks,
+                        service_build_tasks,
+                        priorities[idx],
+                        arch=arch,
+                        task_id=arch_build_tasks[(obj.name, arch)],
                     )
+                    build_tasks_created.add(obj_arch_tasks[arch])
+                if should_push and not isinstance(obj, ServiceMsys):
+                    push_task = self._create_push_task(obj, service_build_tasks)
+                    push_tasks_created.add(push_task)
+                    if obj.multiarch:
+                        manifest_tasks_created.add(
+                            self._create_manifest_task(obj, obj_arch_tasks, push_task)
+                        )
             else:
                 test_tasks_created.add(
                     self._create_recipe_test_task(
                         obj,
                         dirty_dep_tasks + dirty_recipe_test_tasks,
                         recipe_test_tasks,
+                        priorities[idx],
                     )
                 )
+        PROFILER.add_time("create", perf_counter() - start)
+        self._submitter.wait()
         LOG.info(
-            "%s %d test tasks, %d build tasks and %d push tasks",
+            "%s %d test tasks, %d build tasks, %d push tasks and %d manifest tasks "
+            "(%d builds reused)",
             self._created_str,
             len(test_tasks_created),
             len(build_tasks_created),
             len(push_tasks_created),
+            len(manifest_tasks_created),
+            len(build_tasks_reused),
         )
 
     @classmethod
@@ -420,8 +1102,26 @@ class Scheduler:
         Returns:
             int: Shell return code.
         """
+        PROFILER.start(cprofile=args.cprofile)
+        try:
+            cls._main(args)
+        finally:
+            PROFILER.stop()
+            if args.profile_output is not None:
+                PROFILER.write(args.profile_output)
+        return 0
+
+    @classmethod
+    def _main(cls, args):
         # get the github event & repo
-        evt = GithubEvent.from_taskcluster(args.github_action, args.github_event)
+        with PROFILER.phase("clone"):
+            evt = GithubEvent.from_taskcluster(
+                args.github_action,
+                args.github_event,
+                checkout=args.checkout,
+                depth=args.clone_depth,
+                blob_filter=args.clone_filter,
+            )
         try:
 
             # create the scheduler
@@ -432,13 +1132,22 @@ class Scheduler:
                 args.docker_hub_secret,
                 args.push_branch,
                 args.dry_run,
+                args.graph_cache,
+                args.scan_workers,
+                args.checkout,
+                args.submit_concurrency,
+                args.reuse_builds,
+                args.build_history,
+                args.cancel_superseded,
+                args.batch_builds,
             )
 
             sched.mark_services_for_rebuild()
 
+            with PROFILER.phase("cancel"):
+                sched.cancel_superseded_tasks()
+
             # schedule tasks
             sched.create_tasks()
         finally:
             evt.cleanup()
-
-        return 0
@@ -0,0 +1,206 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Concurrent task submission to the Taskcluster queue"""
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Condition, local
+from time import sleep
+
+from taskcluster.exceptions import (
+    TaskclusterConnectionError,
+    TaskclusterFailure,
+    TaskclusterRestFailure,
+)
+
+from . import Taskcluster
+from .profiling import PROFILER
+
+LOG = getLogger(__name__)
+RETRIES = 5
+RETRY_SLEEP = 1.0
+
+
+def _is_transient(exc):
+    """Check whether a failed queue call is worth retrying.
+
+    Arguments:
+        exc (TaskclusterFailure): The error raised by the client.
+
+    Returns:
+        bool: True for connection errors, throttling and server errors.
+    """
+    if isinstance(exc, TaskclusterConnectionError):
+        return True
+    if isinstance(exc, TaskclusterRestFailure):
+        status = exc.status_code
+        return status is None or status == 429 or status >= 500
+    return False
+
+
+class TaskSubmitter:
+    """Submit tasks to the Taskcluster queue, keeping dependency order.
+
+    Tasks are submitted in the background, with at most `max_in_flight` calls to
+    `createTask` at a time. A task which lists another task from the same
+    submitter in its `dependencies` is held until that task has been created,
+    and is never created if that task fails. Each worker thread keeps its own
+    queue client, so connections are reused between calls.
+
+    If `max_in_flight` is 1, tasks are created synchronously in `submit()`. The
+    caller must then submit tasks in dependency order.
+
+    Worker threads are started by `submit()` and stopped by `wait()`.
+
+    Attributes:
+        max_in_flight (int): Maximum number of concurrent `createTask` calls.
+        created (list(str)): Task IDs which have been created, in order.
+    """
+
+    def __init__(self, max_in_flight=1, queue_factory=None):
+        """Initialize a TaskSubmitter instance.
+
+        Arguments:
+            max_in_flight (int): Maximum number of concurrent `createTask` calls.
+            queue_factory (callable or None): Called with no arguments to create a
+                                              queue client for each worker thread.
+                                              Defaults to the Taskcluster queue.
+        """
+        assert max_in_flight >= 1
+        self.max_in_flight = max_in_flight
+        self.created = []
+        if queue_factory is None:
+            queue_factory = self._default_queue
+        self._queue_factory = queue_factory
+        self._local = local()
+        self._cond = Condition()
+        # task_id -> task, for every task submitted and not yet finished
+        self._pending = {}
+        # task_id -> set(task_id) of dependencies not yet created
+        self._blocked = {}
+        self._failed = set()
+        self._errors = []
+        self._executor = None
+
+    @staticmethod
+    def _default_queue():
+        return Taskcluster.get_service("queue")
+
+    def _queue(self):
+        queue = getattr(self._local, "queue", None)
+        if queue is None:
+            queue = self._local.queue = self._queue_factory()
+        return queue
+
+    def _create(self, task_id, task):
+        """Call `createTask`, retrying transient failures with exponential backoff.
+
+        Arguments:
+            task_id (str): Task ID to create.
+            task (dict): Task definition.
+
+        Returns:
+            None
+        """
+        for attempt in range(RETRIES):
+            try:
+                with PROFILER.phase("submit"):
+                    self._queue().createTask(task_id, task)
+                PROFILER.count("tasks_created")
+                return
+            except TaskclusterFailure as exc:
+                if attempt == RETRIES - 1 or not _is_transient(exc):
+                    LOG.error("Error creating task %s: %s", task_id, exc)
+                    raise
+                PROFILER.count("submit_retries")
+                delay = RETRY_SLEEP * 2**attempt
+                LOG.warning(
+                    "Error creating task %s: %s, retrying in %.1fs", task_id, exc, delay
+                )
+                sleep(delay)
+
+    def submit(self, task_id, task):
+        """Submit a task to be created.
+
+        Arguments:
+            task_id (str): Task ID to create.
+            task (dict): Task definition.
+
+        Returns:
+            None
+        """
+        if self.max_in_flight == 1:
+            self._create(task_id, task)
+            self.created.append(task_id)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight, thread_name_prefix="submit"
+            )
+        with self._cond:
+            self._pending[task_id] = task
+            failed = self._failed.intersection(task["dependencies"])
+            if failed:
+                self._fail(task_id)
+                return
+            blocked = {dep for dep in task["dependencies"] if dep in self._pending}
+            if blocked:
+                self._blocked[task_id] = blocked
+                return
+        self._start(task_id, task)
+
+    def _start(self, task_id, task):
+        future = self._executor.submit(self._create, task_id, task)
+        future.add_done_callback(lambda fut: self._finished(task_id, fut))
+
+    def _fail(self, task_id):
+        # must hold self._cond
+        self._failed.add(task_id)
+        del self._pending[task_id]
+        for other in list(self._blocked):
+            if task_id in self._blocked[other]:
+                LOG.error("Not creating task %s, dependency %s failed", other, task_id)
+                del self._blocked[other]
+                self._fail(other)
+        self._cond.notify_all()
+
+    def _finished(self, task_id, future):
+        ready = []
+        with self._cond:
+            exc = future.exception()
+            if exc is not None:
+                self._errors.append(exc)
+                self._fail(task_id)
+                return
+            self.created.append(task_id)
+            del self._pending[task_id]
+            for other, deps in list(self._blocked.items()):
+                deps.discard(task_id)
+                if not deps:
+                    del self._blocked[other]
+                    ready.append(other)
+            self._cond.notify_all()
+            ready = [(other, self._pending[other]) for other in ready]
+        for other, task in ready:
+            self._start(other, task)
+
+    def wait(self):
+        """Wait for all submitted tasks to be created.
+
+        Raises:
+            TaskclusterFailure: A task could not be created.
+
+        Returns:
+            None
+        """
+        if self._executor is None:
+            return
+        with PROFILER.phase("submit_wait"), self._cond:
+            self._cond.wait_for(lambda: not self._pending)
+        self._executor.shutdown()
+        self._executor = None
+        if self._errors:
+            errors, self._errors = self._errors, []
+            self._failed.clear()
+            raise errors[0]
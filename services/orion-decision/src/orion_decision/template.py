@@ -0,0 +1,232 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Pre-compiled YAML task templates"""
+import re
+from json import loads as json_loads
+from string import Template
+
+from yaml import MappingNode, SafeLoader, ScalarNode, SequenceNode
+from yaml import safe_load as yaml_load
+
+# placeholders are replaced by these before parsing, private use codepoints are
+# valid anywhere in YAML and won't appear in a template
+MARKER = "\ue000{}\ue001"
+MARKER_RE = re.compile("\ue000([^\ue001]*)\ue001")
+# values which can be inserted in a quoted scalar without changing meaning
+SAFE_QUOTED = {
+    '"': re.compile(r'[^\s\\"](?:[^\\"\n\r]*[^\s\\"])?'),
+    "'": re.compile(r"[^\s'](?:[^'\n\r]*[^\s'])?"),
+}
+# values which are a single line plain scalar, if YAML resolves them as a string.
+# flow indicators are excluded, since the scalar may be in a flow collection.
+SAFE_PLAIN = re.compile(
+    r"[^\s\-?:,\[\]{}#&*!|>'\"%@`.](?:[^\s:#,\[\]{}]|:(?=[^\s,\[\]{}])| (?=[^\s#]))*"
+)
+DECIMAL = re.compile(r"[-+]?(?:0|[1-9][0-9]*)")
+TAG_INT = "tag:yaml.org,2002:int"
+TAG_STR = "tag:yaml.org,2002:str"
+
+
+class _Slot:
+    """A scalar in a template which contains placeholders.
+
+    Attributes:
+        parts (list(str)): Literal text and placeholder names, alternating.
+        raw (str): Source text of the scalar (with placeholders marked).
+        kind (str): How the value is calculated. One of:
+                    "plain": placeholders are replaced, and the result is kept if
+                             YAML would resolve it as a string (or decimal int),
+                             otherwise passed to "yaml",
+                    "quoted": placeholders are replaced, unless values have
+                              characters that YAML would process in a quoted
+                              scalar, then passed to "yaml",
+                    "int": as "quoted", then converted to int (or "yaml" if
+                           needed),
+                    "yaml": the scalar is substituted and parsed.
+        style (str or None): YAML scalar style.
+    """
+
+    __slots__ = ("parts", "raw", "kind", "style")
+
+    def __init__(self, value, raw, kind, style):
+        self.parts = MARKER_RE.split(value)
+        self.raw = raw
+        self.kind = kind
+        self.style = style
+
+    def _parse(self, values):
+        return yaml_load(MARKER_RE.sub(lambda match: values[match.group(1)], self.raw))
+
+    def _render_plain(self, values, result):
+        parts = self.parts
+        if len(parts) == 3 and not parts[0] and not parts[2] and result[:1] == '"':
+            # a JSON string is also a YAML double-quoted scalar, with the same value
+            try:
+                value = json_loads(result)
+            except ValueError:
+                return self._parse(values)
+            if isinstance(value, str):
+                return value
+            return self._parse(values)
+        if SAFE_PLAIN.fullmatch(result) is None:
+            return self._parse(values)
+        tag = _implicit_tag(result)
+        if tag == TAG_STR:
+            return result
+        if tag == TAG_INT and DECIMAL.fullmatch(result) is not None:
+            return int(result)
+        return self._parse(values)
+
+    def render(self, values):
+        """Calculate the value of this scalar.
+
+        Arguments:
+            values (dict(str -> str)): Placeholder values.
+
+        Returns:
+            object: The value YAML would give the substituted scalar.
+        """
+        if self.kind == "yaml":
+            return self._parse(values)
+        parts = self.parts
+        if self.kind == "quoted":
+            safe = SAFE_QUOTED[self.style]
+            if not all(safe.fullmatch(values[name]) for name in parts[1::2]):
+                return self._parse(values)
+        result = parts[0]
+        for idx in range(1, len(parts), 2):
+            result += values[parts[idx]] + parts[idx + 1]
+        if self.kind == "plain":
+            return self._render_plain(values, result)
+        if self.kind == "int":
+            if DECIMAL.fullmatch(result) is None:
+                return self._parse(values)
+            return int(result)
+        return result
+
+
+def _implicit_tag(value):
+    """Get the tag YAML would resolve for a plain scalar.
+
+    Arguments:
+        value (str): Plain scalar text (not empty).
+
+    Returns:
+        str: Resolved tag.
+    """
+    for tag, regexp in SafeLoader.yaml_implicit_resolvers.get(value[0], ()):
+        if regexp.match(value):
+            return tag
+    return TAG_STR
+
+
+def _fill(node, values):
+    node_type = type(node)
+    if node_type is dict:
+        return {_fill(key, values): _fill(value, values) for key, value in node.items()}
+    if node_type is list:
+        return [_fill(value, values) for value in node]
+    if node_type is _Slot:
+        return node.render(values)
+    return node
+
+
+class TaskTemplate:
+    """A YAML document with `string.Template` placeholders, parsed once.
+
+    `fill()` gives the same result as substituting the template text and parsing it
+    with `yaml.safe_load()`, but without parsing YAML for each call. Each scalar
+    containing placeholders is compiled into a slot, typed by the scalar's style and
+    tag. Slots are filled directly where the value can't change how YAML reads
+    the scalar, otherwise only that scalar is substituted and parsed.
+
+    As with substitution, a value YAML can't insert in the template without
+    breaking its structure (eg. a newline in a block scalar) is not supported.
+
+    Attributes:
+        text (str): The template source.
+        names (frozenset(str)): Placeholder names used in the template.
+    """
+
+    __slots__ = ("text", "names", "_root")
+
+    def __init__(self, text):
+        """Initialize a TaskTemplate instance.
+
+        Arguments:
+            text (str): YAML template using `string.Template` placeholders.
+        """
+        self.text = text
+        names = set()
+
+        def _mark(match):
+            if match.group("escaped") is not None:
+                return "$"
+            name = match.group("named") or match.group("braced")
+            if name is None:
+                raise ValueError(f"Invalid placeholder in template: {match.group(0)}")
+            names.add(name)
+            return MARKER.format(name)
+
+        marked = Template.pattern.sub(_mark, text)
+        self.names = frozenset(names)
+        loader = SafeLoader(marked)
+        try:
+            self._root = self._compile(loader, marked, loader.get_single_node())
+        finally:
+            loader.dispose()
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a TaskTemplate from a file.
+
+        Arguments:
+            path (Path): YAML template file.
+
+        Returns:
+            TaskTemplate: The parsed template.
+        """
+        return cls(path.read_text())
+
+    def _compile(self, loader, marked, node):
+        if isinstance(node, MappingNode):
+            return {
+                self._compile(loader, marked, key): self._compile(loader, marked, value)
+                for key, value in node.value
+            }
+        if isinstance(node, SequenceNode):
+            return [self._compile(loader, marked, value) for value in node.value]
+        assert isinstance(node, ScalarNode)
+        if MARKER_RE.search(node.value) is None:
+            return loader.construct_object(node, deep=True)
+        raw = marked[node.start_mark.index : node.end_mark.index]
+        if "\n" in raw or node.style not in (None, *SAFE_QUOTED):
+            kind = "yaml"
+        elif node.tag == TAG_STR and node.style is None:
+            kind = "plain"
+        elif node.tag == TAG_STR and node.style in SAFE_QUOTED:
+            kind = "quoted"
+        elif node.tag == TAG_INT and (node.style is None or node.style in SAFE_QUOTED):
+            kind = "int"
+        else:
+            kind = "yaml"
+        return _Slot(node.value, raw, kind, node.style)
+
+    def fill(self, **values):
+        """Create a new object from the template.
+
+        Arguments:
+            **values (object): Placeholder values (converted using `str()`).
+
+        Raises:
+            KeyError: A placeholder value was not given.
+
+        Returns:
+            object: The template contents, with placeholders replaced.
+        """
+        missing = self.names - values.keys()
+        if missing:
+            raise KeyError(min(missing))
+        return _fill(self._root, {name: str(values[name]) for name in self.names})
@@ -0,0 +1,156 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for Orion service graph cache"""
+
+from json import loads as json_loads
+from pathlib import Path
+from shutil import copytree, rmtree
+from subprocess import run
+
+import pytest
+
+from orion_decision.cache import CACHE_VERSION, GraphCache
+from orion_decision.git import GitRepo
+from orion_decision.orion import Services
+
+FIXTURES = (Path(__file__).parent / "fixtures").resolve()
+
+
+@pytest.fixture
+def services_repo(tmp_path):
+    """Create a git repo from the services03 fixture"""
+    root = tmp_path / "repo"
+    copytree(FIXTURES / "services03", root)
+    run(["git", "init", "-q"], cwd=root, check=True)
+    run(["git", "add", "."], cwd=root, check=True)
+    run(
+        ["git", "-c", "user.name=x", "-c", "user.email=x@x", "commit", "-qm", "init"],
+        cwd=root,
+        check=True,
+    )
+    return GitRepo.from_existing(root)
+
+
+def _graph(svcs):
+    return {
+        (type(obj).__name__, obj.name): (
+            obj.service_deps,
+            obj.path_deps,
+            obj.recipe_deps,
+            obj.weak_deps,
+        )
+        for obj in list(svcs.values()) + list(svcs.recipes.values())
+    }
+
+
+def test_cache_01(services_repo, tmp_path):
+    """test that a warm cache gives the same graph without reading files"""
+    cache_path = tmp_path / "cache.json"
+    expected = _graph(Services(services_repo))
+
+    cold = GraphCache(cache_path)
+    assert _graph(Services(services_repo, cache=cold)) == expected
+    assert cold.misses > 0
+    assert cache_path.is_file()
+    assert json_loads(cache_path.read_text())["version"] == CACHE_VERSION
+
+    warm = GraphCache(cache_path)
+    assert _graph(Services(services_repo, cache=warm)) == expected
+    assert warm.misses == 0
+    assert warm.hits == cold.misses + cold.hits
+
+
+def test_cache_02(services_repo, tmp_path):
+    """test that only changed blobs are recalculated"""
+    cache_path = tmp_path / "cache.json"
+    Services(services_repo, cache=GraphCache(cache_path))
+
+    dockerfile = services_repo.path / "test3" / "Dockerfile"
+    dockerfile.write_text(
+        "FROM mozillasecurity/test1:latest\nRUN /src/recipes/install.sh\n"
+    )
+    services_repo.git("add", ".")
+    cache = GraphCache(cache_path)
+    svcs = Services(services_repo, cache=cache)
+    # images, sources and file scan of the new Dockerfile
+    assert cache.misses == 3
+    assert svcs["test3"].service_deps == {"test1"}
+    assert svcs["test3"].recipe_deps == {"install.sh"}
+    assert _graph(svcs) == _graph(Services(services_repo))
+
+
+def test_cache_03(services_repo, tmp_path):
+    """test that file scans are discarded when the set of paths changes"""
+    cache_path = tmp_path / "cache.json"
+    Services(services_repo, cache=GraphCache(cache_path))
+
+    (services_repo.path / "test3" / "new").write_text("")
+    services_repo.git("add", ".")
+    cold = GraphCache(tmp_path / "cold.json")
+    Services(services_repo, cache=cold)
+    cache = GraphCache(cache_path)
+    svcs = Services(services_repo, cache=cache)
+    assert svcs["test3"].path_deps == {
+        services_repo.path / "test3" / "Dockerfile",
+        services_repo.path / "test3" / "new",
+        services_repo.path / "test3" / "service.yaml",
+    }
+    # metadata and images are reused, but every file is scanned again
+    assert 0 < cache.misses < cold.misses
+    assert _graph(svcs) == _graph(Services(services_repo))
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "{",
+        '{"version": 0}',
+        f'{{"version": {CACHE_VERSION}, "scan": []}}',
+        "[]",
+    ],
+)
+def test_cache_04(services_repo, tmp_path, data):
+    """test that an invalid cache is ignored"""
+    cache_path = tmp_path / "cache.json"
+    cache_path.write_text(data)
+    cold = GraphCache(tmp_path / "cold.json")
+    Services(services_repo, cache=cold)
+    cache = GraphCache(cache_path)
+    svcs = Services(services_repo, cache=cache)
+    assert cache.misses == cold.misses
+    assert _graph(svcs) == _graph(Services(services_repo))
+    assert json_loads(cache_path.read_text())["version"] == CACHE_VERSION
+
+
+def test_cache_05(services_repo, tmp_path):
+    """test that unstaged changes in the working tree aren't hidden by the cache"""
+    cache_path = tmp_path / "cache.json"
+    Services(services_repo, cache=GraphCache(cache_path))
+
+    dockerfile = services_repo.path / "test3" / "Dockerfile"
+    dockerfile.write_text(
+        "FROM mozillasecurity/test1:latest\nRUN /src/recipes/install.sh\n"
+    )
+    cache = GraphCache(cache_path)
+    svcs = Services(services_repo, cache=cache)
+    assert cache.misses > 0
+    assert svcs["test3"].service_deps == {"test1"}
+    assert svcs["test3"].recipe_deps == {"install.sh"}
+    assert _graph(svcs) == _graph(Services(services_repo))
+    # the working tree SHA is the same as `git add` would give
+    blob = svcs.files.blob(dockerfile)
+    services_repo.git("add", ".")
+    assert Services(services_repo, hashes=True).files.blob(dockerfile) == blob
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_revision(services_repo, workers):
+    """test that the graph can be read from a revision instead of the working tree"""
+    expected = _graph(Services(services_repo))
+    for path in services_repo.path.iterdir():
+        if path.name != ".git":
+            rmtree(path) if path.is_dir() else path.unlink()
+    svcs = Services(services_repo, workers=workers, revision="HEAD")
+    assert _graph(svcs) == expected
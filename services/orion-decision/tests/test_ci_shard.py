@@ -0,0 +1,126 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for CI test sharding"""
+
+from json import dumps as json_dump
+from json import loads as json_loads
+
+import pytest
+from taskcluster.exceptions import TaskclusterRestFailure
+
+from orion_decision.ci_matrix import MatrixJob
+from orion_decision.ci_shard import (
+    TIMINGS_ARTIFACT,
+    balance,
+    history_namespace,
+    load_history,
+    select_tests,
+    select_tests_from_env,
+)
+
+pytest_plugins = ["pytester"]
+TESTS = [f"test_{idx}" for idx in range(10)]
+
+
+def test_shard_balance():
+    """test that tests are balanced by duration"""
+    durations = {"a": 10.0, "b": 6.0, "c": 5.0, "d": 4.0, "e": 1.0}
+    # greedy, so not always optimal (13/13 is possible here)
+    assert balance(durations, 2) == [["a", "d"], ["b", "c", "e"]]
+    assert balance(durations, 5) == [["a"], ["b"], ["c"], ["d"], ["e"]]
+    assert balance({}, 3) == [[], [], []]
+
+
+@pytest.mark.parametrize("shards", [1, 3, 4])
+def test_shard_select_01(shards):
+    """test that tests are split evenly without history"""
+    result = [select_tests(TESTS, shard, shards) for shard in range(1, shards + 1)]
+    assert sorted(sum(result, [])) == sorted(TESTS)
+    assert max(map(len, result)) - min(map(len, result)) <= 1
+    # order is kept
+    assert all(shard == sorted(shard, key=TESTS.index) for shard in result)
+
+
+def test_shard_select_02():
+    """test that history is used, and unknown tests take the average"""
+    history = {test: 1.0 for test in TESTS[1:8]}
+    history.update({"test_0": 18.0, "removed": 100.0})
+    result = [select_tests(TESTS, shard, 2, history) for shard in (1, 2)]
+    assert sorted(sum(result, [])) == sorted(TESTS)
+    # the slow test runs alone, even with unknown tests taking the average (3.125s)
+    assert ["test_0"] in result
+    assert not any(test == "removed" for shard in result for test in shard)
+
+
+def test_shard_select_env(monkeypatch, tmp_path):
+    """test selecting tests using the environment set by ci-launch"""
+    monkeypatch.delenv("CI_SHARD", raising=False)
+    monkeypatch.delenv("CI_SHARD_COUNT", raising=False)
+    monkeypatch.delenv("CI_SHARD_HISTORY", raising=False)
+    assert select_tests_from_env(TESTS) == TESTS
+    history = tmp_path / "history.json"
+    history.write_text(
+        json_dump({test: 1000.0 if test == "test_9" else 1.0 for test in TESTS})
+    )
+    monkeypatch.setenv("CI_SHARD", "1")
+    monkeypatch.setenv("CI_SHARD_COUNT", "2")
+    monkeypatch.setenv("CI_SHARD_HISTORY", str(history))
+    assert select_tests_from_env(TESTS) == ["test_9"]
+
+
+def test_shard_history(mocker):
+    """test that timings from previous runs are merged"""
+    queue = mocker.Mock()
+    queue.getLatestArtifact.side_effect = [
+        {"a": 1.0, "b": 2.0},
+        TaskclusterRestFailure("not found", None, 404),
+        {"response": None},
+        {"b": 3, "c": 0.5},
+    ]
+    assert load_history(["t1", "t2", "t3", "t4"], queue=queue) == {
+        "a": 1.0,
+        "b": 3,
+        "c": 0.5,
+    }
+    assert queue.getLatestArtifact.call_args[0] == ("t4", TIMINGS_ARTIFACT)
+
+
+def test_shard_namespace():
+    """test that the history namespace depends on the job, not the shard count"""
+    job = MatrixJob(None, "python", "3.9", "linux", {}, ["test"], shards=2)
+    other = MatrixJob(None, "python", "3.9", "linux", {}, ["test"], shards=3)
+    namespace = history_namespace("owner/repo", job, 1)
+    assert namespace.startswith("project.fuzzing.orion.ci.owner.repo.")
+    assert namespace.endswith(".shard1")
+    assert namespace == history_namespace("owner/repo", other, 1)
+    other.env["A"] = "1"
+    assert namespace != history_namespace("owner/repo", other, 1)
+
+
+def test_shard_pytest_plugin(monkeypatch, pytester, tmp_path):
+    """test that the pytest plugin runs one shard and writes timings"""
+    for var in ("CI_SHARD", "CI_SHARD_COUNT", "CI_SHARD_HISTORY", "CI_SHARD_TIMINGS"):
+        monkeypatch.delenv(var, raising=False)
+    pytester.makepyfile(
+        test_a="".join(f"def test_{idx}():\n    pass\n\n\n" for idx in range(4))
+    )
+    result = pytester.runpytest("-p", "orion_decision.pytest_shard")
+    result.stdout.fnmatch_lines(["*4 passed*"])
+
+    history = tmp_path / "history.json"
+    history.write_text(
+        json_dump({f"test_a.py::test_{idx}": 10.0 if idx else 1.0 for idx in range(4)})
+    )
+    timings = tmp_path / "timings.json"
+    monkeypatch.setenv("CI_SHARD", "2")
+    monkeypatch.setenv("CI_SHARD_COUNT", "2")
+    monkeypatch.setenv("CI_SHARD_HISTORY", str(history))
+    monkeypatch.setenv("CI_SHARD_TIMINGS", str(timings))
+    result = pytester.runpytest("-p", "orion_decision.pytest_shard")
+    result.stdout.fnmatch_lines(["*2 passed, 2 deselected*"])
+    assert set(json_loads(timings.read_text())) == {
+        "test_a.py::test_0",
+        "test_a.py::test_2",
+    }
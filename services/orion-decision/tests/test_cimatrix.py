@@ -4,17 +4,23 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Tests for Orion CI matrix loading"""
 
+from itertools import islice, product
 from pathlib import Path
 
 import pytest
+from jsonschema.exceptions import ValidationError
+from jsonschema.validators import validator_for
 from yaml import safe_load as yaml_load
 
 from orion_decision.ci_matrix import (
+    VALIDATORS,
     CIMatrix,
     CISecret,
     CISecretEnv,
     CISecretFile,
     CISecretKey,
+    JobIndex,
+    JobMatcher,
     MatrixJob,
 )
 
@@ -130,3 +136,215 @@ def test_matrix_secret_serialize(secret):
     """test that CISecret serialize/deserialize is lossless"""
     secret2 = CISecret.from_json(str(secret))
     assert secret == secret2
+
+
+def test_matrix_schema_registry(mocker):
+    """test that each schema is checked once, and invalid input is rejected"""
+    mocker.patch.dict(VALIDATORS, clear=True)
+    check = mocker.patch("orion_decision.ci_matrix.validator_for", wraps=validator_for)
+    job = MatrixJob("name", "python", "3.9", "linux", {}, ["test"])
+    job.secrets.append(CISecretEnv("project/secret", "A"))
+    for _ in range(3):
+        MatrixJob.from_json(str(job))
+    # MatrixJob and CISecret
+    assert check.call_count == 2
+    assert set(VALIDATORS) == {"MatrixJob", "CISecret"}
+    obj = job.serialize()
+    obj["stage"] = "2"
+    with pytest.raises(ValidationError):
+        MatrixJob.from_json(obj)
+
+
+def _job_product():
+    for version, platform, env, script in product(
+        ["3.6", "3.7"],
+        ["linux", "windows"],
+        [{}, {"A": "1"}, {"A": "2"}, {"A": "1", "B": "1"}],
+        [["test"], ["test2"]],
+    ):
+        yield MatrixJob(None, "python", version, platform, env, script)
+
+
+@pytest.mark.parametrize(
+    "criteria",
+    [
+        [],
+        [{}],
+        [{"env": {}}],
+        [{"version": "3.6"}],
+        [{"env": {"A": "1"}}, {"env": {"B": "1"}}],
+        [{"platform": "windows", "version": "3.6"}, {"script": ["test2"]}],
+        [{"env": {"A": "1", "B": "1"}, "platform": "linux"}, {"env": {"C": "1"}}],
+        [{"language": "node"}, {"version": "3.7", "env": {"A": "2"}}],
+    ],
+)
+def test_matrix_job_matcher(criteria):
+    """test that JobMatcher is equivalent to MatrixJob.matches"""
+    matcher = JobMatcher(criteria)
+    for job in _job_product():
+        expected = any(job.matches(**crit) for crit in criteria)
+        assert matcher.matches(job) == expected, str(job)
+
+
+def test_matrix_job_index():
+    """test that JobIndex is equivalent to MatrixJob.matches"""
+    jobs = list(_job_product())
+    existing = jobs[::3]
+    index = JobIndex(existing)
+    for job in jobs:
+        expected = any(
+            exist.matches(
+                language=job.language,
+                version=job.version,
+                platform=job.platform,
+                env=job.env,
+                script=job.script,
+            )
+            for exist in existing
+        )
+        assert (job in index) == expected, str(job)
+
+
+def test_matrix_lazy(mocker):
+    """test that the matrix is expanded lazily, checking only what is needed"""
+    check = mocker.patch.object(MatrixJob, "check", autospec=True)
+    obj = {
+        "language": "python",
+        "version": ["3.6", "3.7"],
+        "platform": ["linux", "windows"],
+        "env": [{"N": str(idx)} for idx in range(1000)],
+        "script": [["test"]],
+        "jobs": {
+            "exclude": [{"platform": "windows", "version": "3.6"}],
+            "include": [{"name": "extra", "version": "3.8", "platform": "linux"}],
+        },
+    }
+    mtx = CIMatrix(obj, "master", "push")
+    # the product is valid by schema and IMAGES, only includes are checked
+    assert check.call_count == 1
+    assert mtx.images() == {
+        ("linux", "py36"),
+        ("linux", "py37"),
+        ("linux", "py38"),
+        ("windows", "py37-win"),
+    }
+    first = list(islice(mtx.iter_jobs(), 3))
+    assert [job.env for job in first] == [{"N": "0"}, {"N": "1"}, {"N": "2"}]
+    jobs = list(mtx.iter_jobs())
+    assert len(jobs) == 3001
+    assert not any(job.matches(platform="windows", version="3.6") for job in jobs)
+    assert jobs[-1].name == "extra"
+    assert check.call_count == 1
+    assert mtx.jobs == jobs
+    assert mtx.jobs is mtx.jobs
+
+
+def test_matrix_lazy_invalid():
+    """test that invalid jobs are reported when parsed, before any are expanded"""
+    obj = {"language": "python", "version": ["3.6", "2.7"], "script": ["test"]}
+    with pytest.raises(AssertionError, match="unknown version '2.7'"):
+        CIMatrix(obj, "master", "push")
+    # fine if excluded
+    obj["jobs"] = {"exclude": [{"version": "2.7"}]}
+    mtx = CIMatrix(obj, "master", "push")
+    assert [job.version for job in mtx.iter_jobs()] == ["3.6"]
+
+
+def test_matrix_needs():
+    """test parsing job `needs`"""
+    obj = {
+        "language": "python",
+        "version": ["3.7"],
+        "script": ["test"],
+        "jobs": {
+            "include": [
+                {"name": "a", "script": ["a"], "needs": ["python/linux/3.7"]},
+                {
+                    "name": "b",
+                    "script": ["b"],
+                    "needs": [{"platform": "linux", "script": ["test"]}],
+                    "when": {"all_passed": False},
+                },
+            ]
+        },
+    }
+    mtx = CIMatrix(obj, "master", "push")
+    product_job, job_a, job_b = mtx.jobs
+    assert not product_job.needs
+    assert job_a.needs == [{"name": "python/linux/3.7"}]
+    assert job_a.require_previous_stage_pass
+    assert job_b.needs == [{"platform": "linux", "script": ["test"]}]
+    assert not job_b.require_previous_stage_pass
+    # `all_passed` doesn't put jobs with `needs` in a stage
+    assert job_a.stage == job_b.stage == 1
+    assert mtx.needed.matches(product_job)
+    assert not mtx.needed.matches(job_a)
+    # needs survive serialization
+    assert MatrixJob.from_json(str(job_b)) == job_b
+    job_b.stage = 2
+    with pytest.raises(AssertionError, match=r"jobs with `needs` have no `stage`"):
+        job_b.check()
+
+
+@pytest.mark.parametrize(
+    "needs",
+    [
+        [{"version": "3.7"}],
+        [{"env": {"A": "1"}}],
+        # a job can't need itself
+        ["a"],
+    ],
+)
+def test_matrix_needs_unmatched(needs):
+    """test that `needs` matching no other job is rejected"""
+    obj = {
+        "language": "python",
+        "version": ["3.7"],
+        "script": ["test"],
+        "jobs": {
+            "exclude": [{"version": "3.7"}],
+            "include": [{"name": "a", "script": ["a"], "needs": needs}],
+        },
+    }
+    with pytest.raises(
+        AssertionError, match=r"`needs` for job a does not match any jobs"
+    ):
+        CIMatrix(obj, "master", "push")
+
+
+def test_matrix_shard():
+    """test parsing job `shard`"""
+    obj = {
+        "language": "python",
+        "version": ["3.6", "3.7"],
+        "script": ["test"],
+        "shard": 4,
+        "jobs": {
+            "include": [
+                {"name": "a", "version": "3.7", "script": ["a"], "shard": 2},
+                {"name": "b", "version": "3.7", "script": ["b"]},
+                # differs from a product job only by shards
+                {"version": "3.7", "shard": 2},
+            ]
+        },
+    }
+    with pytest.raises(AssertionError, match=r"included job #2 already exists"):
+        list(CIMatrix(obj, "master", "push").iter_jobs())
+    del obj["jobs"]["include"][2]
+    mtx = CIMatrix(obj, "master", "push")
+    assert [(job.name, job.shards) for job in mtx.jobs] == [
+        ("python/linux/3.6", 4),
+        ("python/linux/3.7", 4),
+        ("a", 2),
+        ("b", 1),
+    ]
+    job = mtx.jobs[2]
+    job.shard = 2
+    job.shard_history = ["task"]
+    assert MatrixJob.from_json(str(job)) == job
+    job.shard = 3
+    with pytest.raises(AssertionError, match=r"`shard` must be between"):
+        job.check()
+    obj["shard"] = 0
+    with pytest.raises(ValidationError):
+        CIMatrix(obj, "master", "push")
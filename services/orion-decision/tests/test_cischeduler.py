@@ -6,21 +6,66 @@
 
 from datetime import datetime
 from json import dumps as json_dump
+from json import loads as json_loads
 from pathlib import Path
+from string import Template
 
 import pytest
+from taskcluster.exceptions import TaskclusterRestFailure
 from taskcluster.utils import stringDate
 from yaml import safe_load as yaml_load
 
-from orion_decision import DEADLINE, MAX_RUN_TIME, PROVISIONER_ID, SCHEDULER_ID
-from orion_decision.ci_matrix import CISecretEnv, CISecretFile, CISecretKey, MatrixJob
-from orion_decision.ci_scheduler import TEMPLATES, WORKER_TYPES, CIScheduler
+from orion_decision import (
+    DEADLINE,
+    MAX_RUN_TIME,
+    PROVISIONER_ID,
+    SCHEDULER_ID,
+    TASKCLUSTER_ROOT_URL,
+)
+from orion_decision.ci_matrix import (
+    CIMatrix,
+    CISecretEnv,
+    CISecretFile,
+    CISecretKey,
+    MatrixJob,
+)
+from orion_decision.ci_scheduler import (
+    TEMPLATES,
+    TIMINGS_PATHS,
+    WORKER_TYPES,
+    CIScheduler,
+)
+from orion_decision.ci_shard import TIMINGS_ARTIFACT
 from orion_decision.git import GithubEvent
 
 FIXTURES = (Path(__file__).parent / "fixtures").resolve()
 pytestmark = pytest.mark.usefixtures("mock_ci_languages")
 
 
+def _render(platform, kwds):
+    # render the expected task the slow way, to check the compiled templates
+    return yaml_load(Template(TEMPLATES[platform].text).substitute(**kwds))
+
+
+def _ci_job(job, evt, task_id, task_group="group"):
+    # the job as serialized into the task, with the CI vars added by the scheduler
+    job_ser = job.serialize()
+    job_ser["env"].update(
+        {
+            "CI": "true",
+            "CI_BUILD_ID": task_group,
+            "CI_BUILD_URL": f"{TASKCLUSTER_ROOT_URL}/tasks/{task_id}",
+            "CI_JOB_ID": task_id,
+            "VCS_BRANCH_NAME": evt.branch,
+            "VCS_COMMIT_ID": evt.commit,
+            "VCS_PULL_REQUEST": str(evt.pull_request or "false"),
+            "VCS_SLUG": evt.repo_slug,
+            "VCS_TAG": evt.tag or "",
+        }
+    )
+    return json_dump(json_dump(job_ser))
+
+
 @pytest.mark.parametrize("commit_message", [None, "[skip ci]", "[skip tc]"])
 def test_ci_main(mocker, commit_message):
     """test CI scheduler main"""
@@ -29,7 +74,13 @@ def test_ci_main(mocker, commit_message):
     create = mocker.patch.object(CIScheduler, "create_tasks", autospec=True)
     if commit_message is not None:
         evt.from_taskcluster.return_value.commit_message = commit_message
-    args = mocker.Mock(dry_run=False)
+    args = mocker.Mock(
+        dry_run=False,
+        submit_concurrency=1,
+        profile_output=None,
+        cprofile=False,
+        index_cache=None,
+    )
     assert CIScheduler.main(args) == 0
     assert evt.from_taskcluster.call_count == 1
     assert evt.from_taskcluster.return_value.cleanup.call_count == 1
@@ -57,6 +108,42 @@ def test_ci_create_01(mocker):
     assert queue.createTask.call_count == 0
 
 
+@pytest.mark.parametrize(
+    "include",
+    [
+        # duplicates a job from the product
+        {"name": "dup", "version": "3.7"},
+        {"name": "bad", "version": "2.7"},
+    ],
+)
+def test_ci_create_invalid(mocker, include):
+    """test that no CI tasks are created for an invalid matrix"""
+    taskcluster = mocker.patch("orion_decision.ci_scheduler.Taskcluster", autospec=True)
+    queue = taskcluster.get_service.return_value
+    now = datetime.utcnow()
+    evt = mocker.Mock(
+        branch="dev",
+        event_type="push",
+        http_url="test://repo",
+        fetch_ref="fetchref",
+        commit="commit",
+        user="testuser",
+        repo_slug="project/test",
+        pull_request=None,
+        tag=None,
+        spec=GithubEvent(),
+    )
+    matrix = {
+        "language": "python",
+        "version": ["3.6", "3.7"],
+        "script": ["test"],
+        "jobs": {"include": [{"name": "extra", "version": "3.8"}, include]},
+    }
+    with pytest.raises(AssertionError):
+        CIScheduler("test", evt, now, "group", matrix).create_tasks()
+    assert queue.createTask.call_count == 0
+
+
 @pytest.mark.parametrize(
     "platform, matrix_secret, job_secret",
     [
@@ -98,7 +185,8 @@ def test_ci_create_02(mocker, platform, matrix_secret, job_secret):
         env={},
         script=["test"],
     )
-    mtx.return_value.jobs = [job]
+    mtx.return_value.iter_jobs.return_value = [job]
+    mtx.return_value.images.return_value = {(job.platform, job.image)}
     secrets = []
     scopes = []
     clone_repo = evt.http_url
@@ -129,12 +217,12 @@ def test_ci_create_02(mocker, platform, matrix_secret, job_secret):
     sched = CIScheduler("test", evt, now, "group", "matrix")
     sched.create_tasks()
     assert queue.createTask.call_count == 1
-    _, task = queue.createTask.call_args[0]
+    task_id, task = queue.createTask.call_args[0]
     # add matrix secrets to `job`. this is different than how it's done in the
     # scheduler, but will have the same effect (and the scheduler is done with `job`)
     job.secrets.extend(secrets)
     kwds = {
-        "ci_job": json_dump(str(job)),
+        "ci_job": _ci_job(job, evt, task_id),
         "clone_repo": clone_repo,
         "deadline": stringDate(now + DEADLINE),
         "fetch_ref": evt.fetch_ref,
@@ -156,7 +244,7 @@ def test_ci_create_02(mocker, platform, matrix_secret, job_secret):
         assert index.findTask.call_count == 1
         assert job.image in index.findTask.call_args[0][0]
         kwds["msys_task"] = "msys-task"
-    expected = yaml_load(TEMPLATES[platform].substitute(**kwds))
+    expected = _render(platform, kwds)
     expected["requires"] = "all-resolved"
     expected["scopes"].extend(scopes)
     if matrix_secret is not None or job_secret is not None:
@@ -205,14 +293,14 @@ def test_ci_create_03(mocker, previous_pass):
         stage=2,
         previous_pass=previous_pass,
     )
-    mtx.return_value.jobs = [job1, job2]
+    mtx.return_value.iter_jobs.return_value = [job1, job2]
     mtx.return_value.secrets = []
     sched = CIScheduler("test", evt, now, "group", "matrix")
     sched.create_tasks()
     assert queue.createTask.call_count == 2
     task1_id, task1 = queue.createTask.call_args_list[0][0]
     kwds = {
-        "ci_job": json_dump(str(job1)),
+        "ci_job": _ci_job(job1, evt, task1_id),
         "clone_repo": evt.http_url,
         "deadline": stringDate(now + DEADLINE),
         "fetch_ref": evt.fetch_ref,
@@ -229,17 +317,229 @@ def test_ci_create_03(mocker, previous_pass):
         "worker": WORKER_TYPES[job1.platform],
     }
     kwds["image"] = job1.image
-    expected = yaml_load(TEMPLATES[job1.platform].substitute(**kwds))
+    expected = _render(job1.platform, kwds)
     expected["requires"] = "all-resolved"
     assert task1 == expected
 
-    _, task2 = queue.createTask.call_args_list[1][0]
-    kwds["ci_job"] = json_dump(str(job2))
+    task2_id, task2 = queue.createTask.call_args_list[1][0]
+    kwds["ci_job"] = _ci_job(job2, evt, task2_id)
     kwds["image"] = job2.image
     kwds["name"] = job2.name
     kwds["worker"] = WORKER_TYPES[job2.platform]
-    expected = yaml_load(TEMPLATES[job2.platform].substitute(**kwds))
+    expected = _render(job2.platform, kwds)
     if not previous_pass:
         expected["requires"] = "all-resolved"
     expected["dependencies"].append(task1_id)
     assert task2 == expected
+
+
+def test_ci_create_04(mocker, tmp_path):
+    """test that windows jobs share cached index lookups"""
+    taskcluster = mocker.patch("orion_decision.ci_scheduler.Taskcluster", autospec=True)
+    queue = mocker.Mock()
+    index = mocker.Mock()
+    index.findTask.return_value = {"taskId": "msys-task"}
+    taskcluster.get_service.side_effect = lambda x: {"index": index, "queue": queue}[x]
+    now = datetime.utcnow()
+    evt = mocker.Mock(
+        branch="dev",
+        event_type="push",
+        http_url="test://repo",
+        fetch_ref="fetchref",
+        commit="commit",
+        user="testuser",
+        repo_slug="project/test",
+        tag=None,
+        pull_request=None,
+        spec=GithubEvent(),
+    )
+    mtx = mocker.patch("orion_decision.ci_scheduler.CIMatrix", autospec=True)
+    mtx.return_value.iter_jobs.return_value = [
+        MatrixJob(
+            name=f"testjob{idx}",
+            language="python",
+            version="3.7",
+            platform="windows",
+            env={},
+            script=["test"],
+        )
+        for idx in range(5)
+    ]
+    mtx.return_value.images.return_value = {("windows", "py37-win")}
+    mtx.return_value.secrets = []
+    cache = tmp_path / "index.json"
+    sched = CIScheduler(
+        "test", evt, now, "group", "matrix", submit_concurrency=4, index_cache=cache
+    )
+    sched.create_tasks()
+    assert queue.createTask.call_count == 5
+    assert index.findTask.call_count == 1
+    for call in queue.createTask.call_args_list:
+        assert "msys-task" in call[0][1]["dependencies"]
+    assert cache.is_file()
+
+    # a second run is answered from the cache file
+    index.reset_mock()
+    sched = CIScheduler("test", evt, now, "group", "matrix", index_cache=cache)
+    sched.create_tasks()
+    assert index.findTask.call_count == 0
+
+
+def test_ci_create_05(mocker):
+    """test that jobs with `needs` depend only on the jobs they select"""
+    taskcluster = mocker.patch("orion_decision.ci_scheduler.Taskcluster", autospec=True)
+    queue = taskcluster.get_service.return_value
+    now = datetime.utcnow()
+    evt = mocker.Mock(
+        branch="dev",
+        event_type="push",
+        http_url="test://repo",
+        fetch_ref="fetchref",
+        commit="commit",
+        user="testuser",
+        repo_slug="project/test",
+        tag=None,
+        pull_request=None,
+        spec=GithubEvent(),
+    )
+    matrix = CIMatrix(
+        {
+            "language": "python",
+            "version": ["3.7"],
+            "env": [{"N": "1"}, {"N": "2"}],
+            "script": [["test"]],
+            "jobs": {
+                "include": [
+                    # deploy is listed first, but needs jobs after it
+                    {"name": "deploy", "script": ["deploy"], "needs": ["coverage"]},
+                    {"name": "lint", "script": ["lint"]},
+                    {
+                        "name": "coverage",
+                        "script": ["cov"],
+                        "needs": [{"env": {"N": "1"}}, "lint"],
+                    },
+                    {
+                        "name": "report",
+                        "script": ["report"],
+                        "when": {"all_passed": False},
+                    },
+                ]
+            },
+        },
+        "dev",
+        "push",
+    )
+    mocker.patch("orion_decision.ci_scheduler.CIMatrix", return_value=matrix)
+    sched = CIScheduler("test", evt, now, "group", "matrix")
+    sched.create_tasks()
+    tasks = {}
+    for task_id, task in (call[0] for call in queue.createTask.call_args_list):
+        job = json_loads(task["payload"]["env"]["CI_JOB"])
+        name = job["name"] if job["name"] != "python/linux/3.7" else job["env"]["N"]
+        tasks[name] = (task_id, task)
+    assert list(tasks) == ["1", "2", "lint", "report", "coverage", "deploy"]
+
+    def _deps(name):
+        return set(tasks[name][1]["dependencies"])
+
+    assert _deps("report") == {tasks[name][0] for name in ("1", "2", "lint")}
+    assert tasks["report"][1]["requires"] == "all-resolved"
+    assert _deps("coverage") == {tasks["1"][0], tasks["lint"][0]}
+    assert "requires" not in tasks["coverage"][1]
+    assert _deps("deploy") == {tasks["coverage"][0]}
+
+
+@pytest.mark.parametrize("event_type", ["push", "pull_request"])
+def test_ci_create_06(mocker, event_type):
+    """test that sharded jobs are split into one task per shard"""
+    taskcluster = mocker.patch("orion_decision.ci_scheduler.Taskcluster", autospec=True)
+    # the same mock serves as queue and index
+    queue = index = taskcluster.get_service.return_value
+
+    def _find(namespace):
+        if namespace.startswith("project.fuzzing.orion.ci.") and not namespace.endswith(
+            ".shard1"
+        ):
+            raise TaskclusterRestFailure("not found", None, 404)
+        return {"taskId": f"task-{namespace.rsplit('.', 1)[-1]}"}
+
+    index.findTask.side_effect = _find
+    now = datetime.utcnow()
+    evt = mocker.Mock(
+        branch="dev",
+        event_type=event_type,
+        http_url="test://repo",
+        fetch_ref="fetchref",
+        commit="commit",
+        user="testuser",
+        repo_slug="project/test",
+        tag=None,
+        pull_request=None,
+        spec=GithubEvent(),
+    )
+    matrix = CIMatrix(
+        {
+            "language": "python",
+            "version": ["3.7"],
+            "script": ["test"],
+            "shard": 2,
+            "jobs": {
+                "include": [
+                    {"name": "win", "platform": "windows", "shard": 3},
+                    {
+                        "name": "deploy",
+                        "script": ["deploy"],
+                        "needs": [{"platform": "linux", "script": ["test"]}],
+                    },
+                ]
+            },
+        },
+        "dev",
+        event_type,
+    )
+    mocker.patch("orion_decision.ci_scheduler.CIMatrix", return_value=matrix)
+    sched = CIScheduler("test", evt, now, "group", "matrix")
+    sched.create_tasks()
+    tasks = {}
+    for task_id, task in (call[0] for call in queue.createTask.call_args_list):
+        tasks[task["metadata"]["name"]] = (task_id, task)
+    assert set(tasks) == {
+        "test python/linux/3.7 (1/2)",
+        "test python/linux/3.7 (2/2)",
+        "test win (1/3)",
+        "test win (2/3)",
+        "test win (3/3)",
+        "test deploy",
+    }
+    linux = [tasks[f"test python/linux/3.7 ({shard}/2)"] for shard in (1, 2)]
+    looked_up = {call[0][0] for call in index.findTask.call_args_list}
+    for shard, (_, task) in enumerate(linux, start=1):
+        job = json_loads(task["payload"]["env"]["CI_JOB"])
+        assert (job["shard"], job["shards"]) == (shard, 2)
+        # only the first shard has history
+        assert job["shard_history"] == ["task-shard1"]
+        assert job["env"]["CI_SHARD_TIMINGS"] == TIMINGS_PATHS["linux"]
+        artifact = task["payload"]["artifacts"][TIMINGS_ARTIFACT]
+        assert artifact["path"] == TIMINGS_PATHS["linux"]
+        if event_type == "push":
+            (route,) = task["routes"]
+            assert route.startswith("index.project.fuzzing.orion.ci.project.test.")
+            assert route.endswith(f".shard{shard}")
+            # the next run looks up the same namespace
+            assert route[len("index.") :] in looked_up
+        else:
+            assert task["routes"] == []
+    _, task = tasks["test win (2/3)"]
+    job = json_loads(task["payload"]["env"]["CI_JOB"])
+    assert (job["shard"], job["shards"]) == (2, 3)
+    (artifact,) = task["payload"]["artifacts"]
+    assert artifact["name"] == TIMINGS_ARTIFACT
+    assert artifact["path"] == TIMINGS_PATHS["windows"]
+    _, deploy = tasks["test deploy"]
+    job = json_loads(deploy["payload"]["env"]["CI_JOB"])
+    assert job["shards"] == 1
+    assert "CI_SHARD_TIMINGS" not in job["env"]
+    assert "artifacts" not in deploy["payload"]
+    assert set(deploy["dependencies"]) == {task_id for task_id, _ in linux}
+    # creating tasks doesn't change the jobs
+    assert not any("CI_JOB_ID" in job.env for job in matrix.jobs)
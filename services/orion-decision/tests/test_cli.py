@@ -5,12 +5,14 @@
 """Tests for Orion decision CLI"""
 
 from json import dumps as json_dump
+from json import loads as json_loads
 from logging import DEBUG
 from pathlib import Path
 from unittest.mock import call
 
 import pytest
 
+from orion_decision.ci_matrix import MatrixJob
 from orion_decision.cli import (
     CISecretEnv,
     check,
@@ -212,6 +214,7 @@ def test_ci_launch_01(mocker, platform, secret):
     mocker.patch.object(CISecretEnv, "get_secret_data", return_value="secret")
     copy = {}
     environ.copy.return_value = copy
+    parser.return_value.job.shards = 1
 
     if platform == "windows":
         parser.return_value.job.platform = "windows"
@@ -269,6 +272,7 @@ def test_ci_launch_02(mocker):
     mocker.patch.object(CISecretEnv, "get_secret_data", return_value={"key": "secret"})
     copy = {}
     environ.copy.return_value = copy
+    parser.return_value.job.shards = 1
 
     sec = CISecretEnv("secret", "name")
     parser.return_value.job.secrets = [sec]
@@ -279,12 +283,63 @@ def test_ci_launch_02(mocker):
     assert "missing `key`" in str(exc)
 
 
+@pytest.mark.parametrize("written", [True, False])
+def test_ci_launch_03(mocker, tmp_path, written):
+    """test CLI entrypoint for CI launch of a sharded job"""
+    mocker.patch("orion_decision.cli.configure_logging", autospec=True)
+    parser = mocker.patch("orion_decision.cli.parse_ci_launch_args", autospec=True)
+    mocker.patch("orion_decision.cli.chdir", autospec=True)
+    environ = mocker.patch("orion_decision.cli.os_environ", autospec=True)
+    run = mocker.patch("orion_decision.cli.run", autospec=True)
+    mocker.patch("orion_decision.cli.GitRepo", autospec=True)
+    mocker.patch("orion_decision.cli.gettempdir", return_value=str(tmp_path))
+    load = mocker.patch("orion_decision.cli.load_history", return_value={"test_a": 1.5})
+    copy = {}
+    environ.copy.return_value = copy
+    timings = tmp_path / "timings.json"
+    job = MatrixJob(
+        "name",
+        "python",
+        "3.9",
+        "linux",
+        {"CI_SHARD_TIMINGS": str(timings)},
+        ["test"],
+        shards=3,
+    )
+    job.shard = 2
+    job.shard_history = ["task1", "task2"]
+    parser.return_value.job = job
+
+    def _run(*_args, **_kwds):
+        if written:
+            timings.write_text('{"test_b": 2.0}')
+        return mocker.DEFAULT
+
+    run.side_effect = _run
+
+    with pytest.raises(SystemExit):
+        ci_launch()
+
+    assert load.call_args == call(["task1", "task2"])
+    assert copy["CI_SHARD"] == "2"
+    assert copy["CI_SHARD_COUNT"] == "3"
+    assert copy["CI_SHARD_TIMINGS"] == str(timings)
+    assert json_loads(Path(copy["CI_SHARD_HISTORY"]).read_text()) == {"test_a": 1.5}
+    if written:
+        assert json_loads(timings.read_text()) == {"test_b": 2.0}
+    else:
+        assert json_loads(timings.read_text()) == {}
+
+
 def test_check(mocker):
     """test CLI check entrypoint"""
     log_init = mocker.patch("orion_decision.cli.configure_logging", autospec=True)
     parser = mocker.patch("orion_decision.cli.parse_check_args", autospec=True)
     repo = mocker.patch("orion_decision.cli.GitRepo", autospec=True)
     svcs = mocker.patch("orion_decision.cli.Services", autospec=True)
+    parser.return_value.graph_cache = None
+    parser.return_value.scan_workers = 1
+    parser.return_value.revision = None
     with pytest.raises(SystemExit) as exc:
         check()
     assert log_init.call_count == 1
@@ -293,5 +348,7 @@ def test_check(mocker):
     assert repo.from_existing.call_count == 1
     assert repo.from_existing.call_args == call(parser.return_value.repo)
     assert svcs.call_count == 1
-    assert svcs.call_args == call(repo.from_existing.return_value)
+    assert svcs.call_args == call(
+        repo.from_existing.return_value, cache=None, workers=1, revision=None
+    )
     assert exc.value.code == 0
@@ -0,0 +1,92 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for Dockerfile parsing"""
+
+import pytest
+
+from orion_decision.dockerfile import (
+    dockerfile_images,
+    dockerfile_sources,
+    instructions,
+)
+
+
+def test_instructions():
+    """test that Dockerfiles are split into instructions"""
+    text = (
+        "# escape=`\n"
+        "# comment\n"
+        "from debian:buster\n"
+        "\n"
+        "RUN apt-get update `\n"
+        "# comment in continuation\n"
+        "    && apt-get install -y git\n"
+        "CMD\n"
+    )
+    assert list(instructions(text)) == [
+        ("FROM", "debian:buster"),
+        ("RUN", "apt-get update  && apt-get install -y git"),
+        ("CMD", ""),
+    ]
+
+
+@pytest.mark.parametrize(
+    "text, images",
+    [
+        # single stage
+        ("FROM mozillasecurity/test1:latest\n", ["mozillasecurity/test1:latest"]),
+        # no FROM
+        ("", []),
+        # multi-stage, reference to earlier stage by name and index
+        (
+            "FROM --platform=linux/amd64 mozillasecurity/a:latest AS Build\n"
+            "RUN make\n"
+            "FROM build AS test\n"
+            "FROM debian:buster\n"
+            "COPY --from=0 /a /a\n"
+            "COPY --from=TEST /b /b\n"
+            "COPY --chown=1:1 --from=mozillasecurity/b /c /c\n"
+            "COPY --from=mozillasecurity/a:latest /d /d\n"
+            "COPY a --from=mozillasecurity/c /e\n",
+            ["mozillasecurity/a:latest", "debian:buster", "mozillasecurity/b"],
+        ),
+        # ARG expansion (only global ARGs apply)
+        (
+            "ARG BASE=mozillasecurity/a\n"
+            "ARG TAG\n"
+            'ARG OS="ubuntu" VER=20.04\n'
+            "FROM ${BASE}:${TAG:-latest}\n"
+            "ARG VER=18.04\n"
+            "FROM $OS:${VER}\n"
+            "FROM ${TAG:+mozillasecurity/}scratch\n",
+            ["mozillasecurity/a:latest", "ubuntu:20.04"],
+        ),
+    ],
+)
+def test_dockerfile_images(text, images):
+    """test that images used by a Dockerfile are found"""
+    assert dockerfile_images(text.encode("utf-8")) == images
+
+
+def test_dockerfile_sources():
+    """test that paths copied from the build context are found"""
+    text = (
+        "FROM debian:buster\n"
+        "COPY recipes/linux /src/recipes\n"
+        "COPY --chown=1:1 a b /dst/\n"
+        'COPY ["d", "e f", "/dst/"]\n'
+        "COPY --from=build /out /out\n"
+        "add https://example.com/g.tgz services/*.sh /dst/\n"
+        "COPY a /again\n"
+    )
+    assert dockerfile_sources(text.encode("utf-8")) == [
+        "recipes/linux",
+        "a",
+        "b",
+        "d",
+        "e f",
+        "https://example.com/g.tgz",
+        "services/*.sh",
+    ]
@@ -5,13 +5,13 @@
 """Tests for GitRepo"""
 
 from pathlib import Path
-from subprocess import CalledProcessError
+from subprocess import PIPE, CalledProcessError, run
 from tempfile import gettempdir
 from unittest.mock import call
 
 import pytest
 
-from orion_decision.git import GithubEvent, GitRepo
+from orion_decision.git import GithubEvent, GitRepo, TrackedFiles
 
 FIXTURES = (Path(__file__).parent / "fixtures").resolve()
 
@@ -99,7 +99,14 @@ def test_retry(mocker):
                 "repo_slug": "allizom/test",
                 "tag": None,
             },
-            call("https://github.com/allizom/test", "post", "post"),
+            call(
+                "https://github.com/allizom/test",
+                ["post", "pre"],
+                "post",
+                checkout=True,
+                depth=None,
+                blob_filter=None,
+            ),
         ),
         # github push to new branch
         (
@@ -129,7 +136,14 @@ def test_retry(mocker):
                 "repo_slug": "allizom/test",
                 "tag": None,
             },
-            call("https://github.com/allizom/test", "post", "post"),
+            call(
+                "https://github.com/allizom/test",
+                ["post"],
+                "post",
+                checkout=True,
+                depth=None,
+                blob_filter=None,
+            ),
         ),
         # github new/update PR
         (
@@ -166,7 +180,14 @@ def test_retry(mocker):
                 "repo_slug": "allizom/test",
                 "tag": None,
             },
-            call("https://github.com/allizom/test", "post", "post"),
+            call(
+                "https://github.com/allizom/test",
+                ["post", "pre"],
+                "post",
+                checkout=True,
+                depth=None,
+                blob_filter=None,
+            ),
         ),
         (
             "github-release",
@@ -191,8 +212,11 @@ def test_retry(mocker):
             },
             call(
                 "https://github.com/allizom/test",
-                "refs/tags/1.0:refs/tags/1.0",
+                ["refs/tags/1.0:refs/tags/1.0"],
                 "1.0",
+                checkout=True,
+                depth=None,
+                blob_filter=None,
             ),
         ),
     ],
@@ -223,3 +247,189 @@ def test_github_changed(mocker):
         assert changed_paths == {repo.path / "a.txt"}
     finally:
         repo.cleanup()
+
+
+def test_tracked_files_01():
+    """test that tracked files index supports membership and subtree queries"""
+    root = Path("/repo")
+    files = TrackedFiles(
+        root,
+        [
+            "setup.py",
+            "recipes/linux/install.sh",
+            "svc/Dockerfile",
+            "svc/service.yaml",
+            "svc/data/file",
+            "svc2/service.yaml",
+        ],
+    )
+    assert len(files) == 6
+    assert root / "svc" / "Dockerfile" in files
+    assert root / "svc" not in files
+    assert list(files.walk(root / "svc")) == [
+        root / "svc" / "Dockerfile",
+        root / "svc" / "data" / "file",
+        root / "svc" / "service.yaml",
+    ]
+    assert list(files.walk(root / "missing")) == []
+    assert list(files.walk(root / "setup.py")) == []
+    assert list(files) == sorted(files, key=lambda p: p.parts)
+    assert list(files.glob(root, "**/service.yaml")) == [
+        root / "svc" / "service.yaml",
+        root / "svc2" / "service.yaml",
+    ]
+    assert list(files.glob(root, "*.py")) == [root / "setup.py"]
+    assert list(files.glob(root / "svc", "*")) == [
+        root / "svc" / "Dockerfile",
+        root / "svc" / "service.yaml",
+    ]
+    assert list(files.glob(root, "recipes/**/*.sh")) == [
+        root / "recipes" / "linux" / "install.sh"
+    ]
+
+
+def test_tracked_files_02():
+    """test that tracked files index is built from a repo"""
+    repo = GitRepo(FIXTURES / "git02", "main", "FETCH_HEAD")
+    try:
+        files = TrackedFiles.from_repo(repo)
+        assert set(files) == set(
+            repo.path / line for line in repo.git("ls-files").splitlines()
+        )
+        assert repo.path / "a.txt" in files
+    finally:
+        repo.cleanup()
+
+
+def test_no_checkout():
+    """test that files can be read from the object database without a checkout"""
+    repo = GitRepo(FIXTURES / "git02", "main", "FETCH_HEAD", checkout=False)
+    try:
+        assert not (repo.path / "a.txt").exists()
+        files = TrackedFiles.from_tree(repo)
+        assert repo.path / "a.txt" in files
+        blob = files.blob(repo.path / "a.txt")
+        assert repo.read_blob(blob) == repo.git("show", "HEAD:a.txt").encode()
+        # the batch process is reused
+        assert repo.read_blob(blob) == repo.read_blob(blob)
+        with pytest.raises(KeyError):
+            repo.read_blob("0" * 40)
+    finally:
+        repo.cleanup()
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    """Create an upstream repo with a linear history of 10 commits"""
+    root = tmp_path / "upstream"
+    root.mkdir()
+
+    def _git(*args):
+        return run(
+            ("git", "-c", "user.name=x", "-c", "user.email=x@x") + args,
+            cwd=root,
+            check=True,
+            stdout=PIPE,
+            universal_newlines=True,
+        ).stdout.strip()
+
+    _git("init", "-q", "-b", "main")
+    _git("config", "uploadpack.allowFilter", "true")
+    _git("config", "uploadpack.allowAnySHA1InWant", "true")
+    commits = []
+    for idx in range(10):
+        (root / f"file{idx}.txt").write_text(f"{idx}\n")
+        _git("add", ".")
+        _git("commit", "-qm", f"commit {idx}")
+        commits.append(_git("rev-parse", "HEAD"))
+    return root.as_uri(), commits
+
+
+def test_shallow_clone(upstream):
+    """test that a shallow clone is deepened until the merge base is found"""
+    url, commits = upstream
+    repo = GitRepo(url, [commits[-1], commits[2]], commits[-1], depth=1)
+    try:
+        assert repo.is_shallow()
+        assert repo.git("rev-list", "--count", "HEAD").strip() == "1"
+        assert repo.deepen_to_merge_base(commits[2], commits[-1]) == commits[2]
+        assert repo.is_shallow()
+        assert int(repo.git("rev-list", "--count", "HEAD")) < len(commits)
+        assert repo.git("rev-list", f"{commits[2]}..HEAD").split() == list(
+            reversed(commits[3:])
+        )
+    finally:
+        repo.cleanup()
+
+
+@pytest.mark.parametrize("checkout", [True, False])
+def test_partial_clone(upstream, checkout):
+    """test that a partial clone only fetches blobs for the commit"""
+    url, commits = upstream
+    repo = GitRepo(url, "main", commits[5], checkout=checkout, blob_filter="blob:none")
+    try:
+        missing = repo.git("rev-list", "--objects", "--missing=print", "FETCH_HEAD")
+        assert "?" in missing
+        assert "?" not in repo.git(
+            "rev-list", "--objects", "--missing=print", commits[5]
+        )
+        files = TrackedFiles.from_tree(repo)
+        assert len(files) == 6
+        blob = files.blob(repo.path / "file5.txt")
+        assert repo.read_blob(blob) == b"5\n"
+    finally:
+        repo.cleanup()
+
+
+def test_partial_clone_history(upstream, tmp_path):
+    """test that a partial clone doesn't fetch blobs only found in history"""
+    url, commits = upstream
+    root = tmp_path / "upstream"
+    old = run(
+        ("git", "rev-parse", "HEAD:file0.txt"),
+        cwd=root,
+        check=True,
+        stdout=PIPE,
+        universal_newlines=True,
+    ).stdout.strip()
+    (root / "file0.txt").write_text("changed\n")
+    run(
+        ("git", "-c", "user.name=x", "-c", "user.email=x@x", "commit", "-qam", "edit"),
+        cwd=root,
+        check=True,
+    )
+    repo = GitRepo(url, "main", "FETCH_HEAD", checkout=False, blob_filter="blob:none")
+    try:
+        assert "?" not in repo.git(
+            "rev-list", "--objects", "--missing=print", "--no-walk", "HEAD"
+        )
+        objects = repo.git("rev-list", "--objects", "--missing=print", "HEAD")
+        # the old version of file0.txt is only in history, so it stays missing
+        assert [obj for obj in objects.split() if obj.startswith("?")] == [f"?{old}"]
+        files = TrackedFiles.from_tree(repo)
+        assert repo.read_blob(files.blob(repo.path / "file0.txt")) == b"changed\n"
+    finally:
+        repo.cleanup()
+
+
+def test_github_tc_shallow(mocker):
+    """test that the commit range is deepened in a shallow clone"""
+    repo = mocker.patch("orion_decision.git.GitRepo")
+    event = {
+        "repository": {"full_name": "allizom/test"},
+        "ref": "refs/heads/main",
+        "after": "post",
+        "before": "pre",
+        "sender": {"login": "me"},
+    }
+    GithubEvent.from_taskcluster("github-push", event, depth=5, blob_filter="blob:none")
+    assert repo.call_args == call(
+        "https://github.com/allizom/test",
+        ["post", "pre"],
+        "post",
+        checkout=True,
+        depth=5,
+        blob_filter="blob:none",
+    )
+    assert repo.return_value.deepen_to_merge_base.call_args == call("pre", "post")
+    assert repo.return_value.git.call_count == 0
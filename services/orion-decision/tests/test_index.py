@@ -0,0 +1,96 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for memoized index lookups"""
+
+from json import dumps as json_dump
+from threading import Event
+
+import pytest
+from taskcluster.exceptions import TaskclusterRestFailure
+
+from orion_decision.index import INDEX_CACHE_VERSION, IndexResolver
+
+
+def test_index_01(mocker):
+    """test that lookups are deduplicated and resolved concurrently"""
+    started = Event()
+    calls = []
+
+    def _find(namespace):
+        calls.append(namespace)
+        if len(set(calls)) == 3:
+            started.set()
+        # every distinct namespace must be in flight at once to get past this
+        assert started.wait(10)
+        return {"taskId": f"task-{namespace}"}
+
+    index = mocker.Mock()
+    index.findTask.side_effect = _find
+    factory = mocker.Mock(return_value=index)
+    resolver = IndexResolver(max_workers=4, index_factory=factory)
+    resolver.prefetch(["a", "b", "a", "c", "b"])
+    assert sorted(calls) == ["a", "b", "c"]
+    assert factory.call_count == 3
+    assert resolver.lookup("b") == "task-b"
+    assert resolver.lookup("a") == "task-a"
+    assert index.findTask.call_count == 3
+    assert resolver.misses == 3
+    assert resolver.hits == 0
+    # no path, nothing to save
+    resolver.save()
+
+
+def test_index_02(mocker):
+    """test that failed lookups are remembered and raised on lookup"""
+    index = mocker.Mock()
+    index.findTask.side_effect = TaskclusterRestFailure("not found", None, 404)
+    resolver = IndexResolver(index_factory=lambda: index)
+    resolver.prefetch(["missing"])
+    with pytest.raises(TaskclusterRestFailure):
+        resolver.lookup("missing")
+    assert index.findTask.call_count == 1
+
+
+@pytest.mark.parametrize("age, expect_hit", [(60, True), (3600, False)])
+def test_index_03(mocker, tmp_path, age, expect_hit):
+    """test the on-disk cache expires entries"""
+    now = 1_000_000.0
+    mocker.patch("orion_decision.index.time", return_value=now)
+    cache = tmp_path / "index.json"
+    cache.write_text(
+        json_dump(
+            {
+                "version": INDEX_CACHE_VERSION,
+                "entries": {"a": ["cached-a", now - age], "bad": "x"},
+            }
+        )
+    )
+    index = mocker.Mock()
+    index.findTask.return_value = {"taskId": "fresh-a"}
+    resolver = IndexResolver(cache, ttl=600, index_factory=lambda: index)
+    result = resolver.lookup("a")
+    if expect_hit:
+        assert result == "cached-a"
+        assert index.findTask.call_count == 0
+    else:
+        assert result == "fresh-a"
+        assert index.findTask.call_count == 1
+    resolver.save()
+    resolver = IndexResolver(cache, ttl=600, index_factory=lambda: index)
+    index.reset_mock()
+    assert resolver.lookup("a") == result
+    assert index.findTask.call_count == 0
+
+
+def test_index_04(mocker, tmp_path):
+    """test that an invalid cache file is ignored"""
+    cache = tmp_path / "index.json"
+    cache.write_text("{")
+    index = mocker.Mock()
+    index.findTask.return_value = {"taskId": "task-a"}
+    resolver = IndexResolver(cache, index_factory=lambda: index)
+    assert resolver.lookup("a") == "task-a"
+    resolver.save()
+    assert IndexResolver(cache).lookup("a") == "task-a"
@@ -0,0 +1,55 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for multi-string matcher"""
+
+import re
+from random import Random
+
+import pytest
+
+from orion_decision.matcher import MultiStringMatcher
+
+
+@pytest.mark.parametrize(
+    "strings, text, expected",
+    [
+        # leftmost match wins
+        (["b.sh", "a.sh"], "x a.sh b.sh", ["a.sh", "b.sh"]),
+        # first given string wins at the same position
+        (["common.sh", "common.sh.orig"], "common.sh.orig", ["common.sh"]),
+        (["common.sh.orig", "common.sh"], "common.sh.orig", ["common.sh.orig"]),
+        # matches don't overlap
+        (
+            ["recipes/linux/install.sh", "install.sh"],
+            "recipes/linux/install.sh",
+            ["recipes/linux/install.sh"],
+        ),
+        (["aba"], "ababa", ["aba"]),
+        # suffix matches are found through failure links
+        (["abcd", "bc"], "abce", ["bc"]),
+        ([], "text", []),
+    ],
+)
+def test_matcher_01(strings, text, expected):
+    """test that matches follow regex alternation semantics"""
+    regex = re.compile("|".join(re.escape(string) for string in strings))
+    if strings:
+        assert [m.group(0) for m in regex.finditer(text)] == expected
+    assert list(MultiStringMatcher(strings).matches(text)) == expected
+
+
+def test_matcher_02():
+    """test that matches are identical to regex on random paths"""
+    rng = Random(1234)
+    names = ["a", "b", "ab", "setup", "install", "common"]
+    strings = []
+    for _ in range(500):
+        parts = [rng.choice(names) for _ in range(rng.randint(1, 4))]
+        strings.append("/".join(parts) + rng.choice(["", ".sh", ".py"]))
+    text = " ".join(rng.choice(strings + names) for _ in range(2000))
+    regex = re.compile("|".join(re.escape(string) for string in strings))
+    assert list(MultiStringMatcher(strings).matches(text)) == [
+        m.group(0) for m in regex.finditer(text)
+    ]
@@ -4,12 +4,19 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Tests for Orion service classes"""
 
+from hashlib import sha1
 from pathlib import Path
 
 import pytest
 from yaml import safe_load as yaml_load
 
-from orion_decision.orion import Service, Services, ServiceTest, ToxServiceTest
+from orion_decision.orion import (
+    Recipe,
+    Service,
+    Services,
+    ServiceTest,
+    ToxServiceTest,
+)
 
 FIXTURES = (Path(__file__).parent / "fixtures").resolve()
 
@@ -124,7 +131,9 @@ def test_service_deps(mocker, dirty_paths, expect_services, expect_recipes):
     root = FIXTURES / "services03"
     repo = mocker.Mock(spec="orion_decision.git.GitRepo")
     repo.path = root
-    repo.git = mocker.Mock(return_value="\n".join(str(p) for p in root.glob("**/*")))
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
     svcs = Services(repo)
     assert set(svcs) == {"test1", "test2", "test3", "test4", "test5", "test6", "test7"}
     assert set(svcs.recipes) == {"recipe_data", "install.sh", "withdep.sh"}
@@ -219,7 +228,9 @@ def test_services_force_dirty(mocker):
     root = FIXTURES / "services10"
     repo = mocker.Mock(spec="orion_decision.git.GitRepo")
     repo.path = root
-    repo.git = mocker.Mock(return_value="\n".join(str(p) for p in root.glob("**/*")))
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
     svcs = Services(repo)
     assert set(svcs) == {"test1"}
     assert set(svcs.recipes) == {"setup.sh"}
@@ -244,8 +255,8 @@ def test_services_repo(mocker):
     repo = mocker.Mock(spec="orion_decision.git.GitRepo")
     repo.path = root
     repo.git = mocker.Mock(
-        return_value="\n".join(
-            str(p) for p in root.glob("**/*") if "test3" not in str(p)
+        return_value="\0".join(
+            str(p) for p in root.glob("**/*") if p.is_file() and "test3" not in str(p)
         )
     )
     svcs = Services(repo)
@@ -259,19 +270,232 @@ def test_service_circular_deps(mocker, fixture):
     root = FIXTURES / fixture
     repo = mocker.Mock(spec="orion_decision.git.GitRepo")
     repo.path = root
-    repo.git = mocker.Mock(return_value="\n".join(str(p) for p in root.glob("**/*")))
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
     with pytest.raises(RuntimeError) as exc:
         Services(repo)
     assert "cycle" in str(exc)
 
 
+def test_service_circular_deps_all(mocker):
+    """test that every dependency cycle is reported"""
+    root = FIXTURES / "services11"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    with pytest.raises(RuntimeError) as exc:
+        Services(repo)
+    assert "[Service test1, Service test2]" in str(exc.value)
+    assert "[Service test3]" in str(exc.value)
+    assert "test4" not in str(exc.value)
+
+
+def test_service_dependency_order(mocker):
+    """test that services and recipes are ordered after their dependencies"""
+    root = FIXTURES / "services03"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    svcs = Services(repo)
+    order = svcs.dependency_order
+    assert len(order) == len(svcs) + len(svcs.recipes)
+    for pos, obj in enumerate(order):
+        before = {(type(dep), dep.name) for dep in order[:pos]}
+        for rec in obj.recipe_deps:
+            assert (Recipe, rec) in before
+        for svc in obj.service_deps:
+            assert (Service, svc) in before
+
+
 def test_service_path_dep_top_level(mocker):
     """test that similarly named files at top-level don't affect service deps"""
     root = FIXTURES / "services08"
     repo = mocker.Mock(spec="orion_decision.git.GitRepo")
     repo.path = root
-    repo.git = mocker.Mock(return_value="\n".join(str(p) for p in root.glob("**/*")))
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
     svcs = Services(repo)
     assert set(svcs) == {"test1"}
     svcs.mark_changed_dirty([root / "setup.py"])
     assert not svcs["test1"].dirty
+
+
+def test_service_deps_multiple(mocker):
+    """test that dirty propagation is the union of each changed path"""
+    root = FIXTURES / "services03"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    svcs = Services(repo)
+    svcs["test3"].dirty = True
+    svcs.mark_changed_dirty(
+        [
+            root / "recipes" / "linux" / "install.sh",
+            root / "test5" / "Dockerfile",
+            root / "test1" / "service.yaml",
+            root / "unknown",
+        ]
+    )
+    assert {svc for svc in svcs if svcs[svc].dirty} == {
+        "test1",
+        "test2",
+        "test3",
+        "test4",
+        "test5",
+        "test6",
+        "test7",
+    }
+    assert {rec for rec in svcs.recipes if svcs.recipes[rec].dirty} == {
+        "install.sh",
+        "withdep.sh",
+    }
+
+
+def test_service_deps_parallel(caplog, mocker):
+    """test that scanning in parallel gives the same result as serial"""
+    root = FIXTURES / "services03"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    results = []
+    for workers in (1, 3):
+        caplog.clear()
+        svcs = Services(repo, workers=workers)
+        results.append(
+            (
+                [
+                    (obj.name, obj.service_deps, obj.path_deps, obj.recipe_deps)
+                    for obj in svcs.dependency_order
+                ],
+                [
+                    rec.getMessage()
+                    for rec in caplog.records
+                    if rec.name == "orion_decision.orion" and rec.levelname == "INFO"
+                ],
+            )
+        )
+    assert results[0] == results[1]
+
+
+def test_service_deps_multistage(mocker):
+    """test that images used by any Dockerfile stage are dependencies"""
+    root = FIXTURES / "services12"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    svcs = Services(repo)
+    assert svcs["test1"].service_deps == set()
+    assert svcs["test2"].service_deps == set()
+    assert svcs["test3"].service_deps == {"test1", "test2"}
+
+
+def test_service_multiarch(mocker):
+    """test that services are built for each architecture listed"""
+    root = FIXTURES / "services14"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    svcs = Services(repo)
+    assert svcs["base"].archs == {
+        "amd64": root / "base" / "Dockerfile",
+        "arm64": root / "base" / "arm64" / "Dockerfile",
+    }
+    assert svcs["base"].multiarch
+    assert svcs["base"].manifest == [
+        "./scripts/docker-manifest.sh",
+        "mozillasecurity",
+        "base",
+    ]
+    assert svcs["child"].archs == {
+        "amd64": root / "child" / "Dockerfile",
+        "arm64": root / "child" / "Dockerfile",
+    }
+    assert svcs["child"].service_deps == {"base"}
+    assert not svcs["solo"].multiarch
+    assert svcs["solo"].manifest is None
+    # a change to the Dockerfile of any architecture rebuilds everything using it
+    svcs.mark_changed_dirty([root / "base" / "arm64" / "Dockerfile"])
+    assert {name for name, svc in svcs.items() if svc.dirty} == {
+        "base",
+        "child",
+        "solo",
+    }
+
+
+def _ls_files_stage(root, changed=()):
+    # `git ls-files -s -z` output, with a different blob SHA for `changed` paths
+    entries = []
+    for path in sorted(root.glob("**/*")):
+        if path.is_file():
+            blob = sha1(path.read_bytes() + (b"x" if path in changed else b""))
+            entries.append(f"100644 {blob.hexdigest()} 0\t{path}")
+    return "\0".join(entries)
+
+
+@pytest.mark.parametrize("fixture", ["services03", "services13", "services14"])
+def test_service_input_hash(mocker, fixture):
+    """test that input hashes change when services would be dirty"""
+    root = FIXTURES / fixture
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(return_value=_ls_files_stage(root))
+    svcs = Services(repo, hashes=True)
+    before = {(type(obj), obj.name): obj.input_hash for obj in svcs.dependency_order}
+    assert None not in before.values()
+    assert len(set(before.values())) == len(before)
+    # the same inputs give the same hashes
+    again = Services(repo, hashes=True)
+    assert {
+        (type(obj), obj.name): obj.input_hash for obj in again.dependency_order
+    } == before
+
+    for path in sorted(svcs.files):
+        repo.git.return_value = _ls_files_stage(root, changed={path})
+        changed = Services(repo, hashes=True)
+        changed.mark_changed_dirty([path])
+        for obj in changed.dependency_order:
+            if obj.dirty:
+                assert obj.input_hash != before[(type(obj), obj.name)]
+
+
+def test_service_input_hash_copied(mocker):
+    """test that input hashes cover files copied from the build context"""
+    root = FIXTURES / "services03"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(return_value=_ls_files_stage(root))
+    before = Services(repo, hashes=True)
+    # test4 copies all of recipes/linux, not only the recipes it uses
+    path = root / "recipes" / "linux" / "tests" / "script.sh"
+    repo.git.return_value = _ls_files_stage(root, changed={path})
+    changed = Services(repo, hashes=True)
+    changed.mark_changed_dirty([path])
+    assert not changed["test4"].dirty
+    assert changed["test4"].input_hash != before["test4"].input_hash
+    assert changed["test1"].input_hash == before["test1"].input_hash
+
+
+def test_service_input_hash_unknown(mocker):
+    """test that input hashes are not calculated without blob SHAs"""
+    root = FIXTURES / "services03"
+    repo = mocker.Mock(spec="orion_decision.git.GitRepo")
+    repo.path = root
+    repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    svcs = Services(repo)
+    assert all(obj.input_hash is None for obj in svcs.dependency_order)
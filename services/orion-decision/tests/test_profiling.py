@@ -0,0 +1,72 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for decision run profiling"""
+
+from json import loads as json_loads
+from threading import Thread
+
+import pytest
+
+from orion_decision.profiling import Profiler
+
+
+def test_profiler_01():
+    """test phase timing and counters"""
+    prof = Profiler()
+    prof.start()
+    with prof.phase("a"):
+        with prof.phase("b"):
+            pass
+    with prof.phase("a"):
+        prof.count("x")
+        prof.count("x", 4)
+    with pytest.raises(ValueError):
+        with prof.phase("c"):
+            raise ValueError()
+    prof.stop()
+    report = prof.report()
+    assert report["phases"].keys() == {"a", "b", "c"}
+    assert report["phases"]["a"]["calls"] == 2
+    assert report["phases"]["b"]["calls"] == 1
+    assert report["phases"]["a"]["seconds"] >= report["phases"]["b"]["seconds"]
+    assert report["total"] >= report["phases"]["a"]["seconds"]
+    assert report["counters"] == {"x": 5}
+    assert "profile" not in report
+    # start() resets the results
+    prof.start()
+    assert prof.report()["phases"] == {}
+
+
+def test_profiler_02():
+    """test that counters are thread-safe"""
+    prof = Profiler()
+    prof.start()
+
+    def _work():
+        for _ in range(1000):
+            with prof.phase("work"):
+                prof.count("n")
+
+    threads = [Thread(target=_work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    prof.stop()
+    report = prof.report()
+    assert report["counters"]["n"] == 4000
+    assert report["phases"]["work"]["calls"] == 4000
+
+
+def test_profiler_03(tmp_path):
+    """test cProfile summary and writing the report"""
+    prof = Profiler()
+    prof.start(cprofile=True)
+    sorted(range(1000), key=str)
+    prof.stop()
+    prof.write(tmp_path / "profile.json")
+    report = json_loads((tmp_path / "profile.json").read_text())
+    assert report["profile"]
+    assert {"function", "calls", "total", "cumulative"} == set(report["profile"][0])
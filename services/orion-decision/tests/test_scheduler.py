@@ -4,10 +4,14 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 """Tests for Orion scheduler"""
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha1
+from json import loads as json_loads
 from pathlib import Path
+from string import Template
 
 import pytest
+from taskcluster.exceptions import TaskclusterRestFailure
 from taskcluster.utils import stringDate
 from yaml import safe_load as yaml_load
 
@@ -22,30 +26,39 @@ from orion_decision import (
     WORKER_TYPE,
 )
 from orion_decision.git import GithubEvent
-from orion_decision.scheduler import (
-    BUILD_TASK,
-    PUSH_TASK,
-    RECIPE_TEST_TASK,
-    TEST_TASK,
-    Scheduler,
-)
+from orion_decision.scheduler import TEMPLATES, Scheduler
 
 FIXTURES = (Path(__file__).parent / "fixtures").resolve()
+# expected tasks are rendered the slow way, to check the compiled templates
+BUILD_TASK = Template((TEMPLATES / "build.yaml").read_text())
+PUSH_TASK = Template((TEMPLATES / "push.yaml").read_text())
+RECIPE_TEST_TASK = Template((TEMPLATES / "recipe_test.yaml").read_text())
+TEST_TASK = Template((TEMPLATES / "test.yaml").read_text())
 
 
-def test_main(mocker):
+def test_main(mocker, tmp_path):
     """test scheduler main"""
     evt = mocker.patch("orion_decision.scheduler.GithubEvent", autospec=True)
     svcs = mocker.patch("orion_decision.scheduler.Services", autospec=True)
     mark = mocker.patch.object(Scheduler, "mark_services_for_rebuild", autospec=True)
+    cancel = mocker.patch.object(Scheduler, "cancel_superseded_tasks", autospec=True)
     create = mocker.patch.object(Scheduler, "create_tasks", autospec=True)
-    args = mocker.Mock()
+    args = mocker.Mock(
+        graph_cache=None,
+        submit_concurrency=1,
+        profile_output=tmp_path / "profile.json",
+        cprofile=False,
+    )
     assert Scheduler.main(args) == 0
     assert svcs.call_count == 1
     assert evt.from_taskcluster.call_count == 1
     assert evt.from_taskcluster.return_value.cleanup.call_count == 1
     assert mark.call_count == 1
+    assert cancel.call_count == 1
     assert create.call_count == 1
+    report = json_loads(args.profile_output.read_text())
+    assert set(report["phases"]) == {"cancel", "clone", "graph"}
+    assert report["total"] >= report["phases"]["graph"]["seconds"]
 
 
 def test_mark_rebuild_01(mocker):
@@ -54,7 +67,7 @@ def test_mark_rebuild_01(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit_message = "/force-rebuild"
     sched = Scheduler(evt, None, "group", "secret", "branch")
@@ -70,7 +83,7 @@ def test_mark_rebuild_02(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit_message = ""
     evt.list_changed_paths.return_value = [root / "recipes" / "linux" / "install.sh"]
@@ -92,7 +105,7 @@ def test_mark_rebuild_03(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit_message = "/force-rebuild=test3,test6"
     evt.list_changed_paths.return_value = [root / "recipes" / "linux" / "install.sh"]
@@ -117,7 +130,7 @@ def test_create_01(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     sched = Scheduler(evt, now, "group", "secret", "push")
     sched.create_tasks()
@@ -133,7 +146,7 @@ def test_create_02(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit = "commit"
     evt.branch = "main"
@@ -155,6 +168,7 @@ def test_create_02(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test1.main",
             scheduler=SCHEDULER_ID,
@@ -175,7 +189,7 @@ def test_create_03(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit = "commit"
     evt.branch = "push"
@@ -198,6 +212,7 @@ def test_create_03(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test1.push",
             scheduler=SCHEDULER_ID,
@@ -217,6 +232,7 @@ def test_create_03(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             scheduler=SCHEDULER_ID,
             service_name="test1",
@@ -238,7 +254,7 @@ def test_create_04(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit = "commit"
     evt.branch = "main"
@@ -261,6 +277,7 @@ def test_create_04(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="medium",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test1.main",
             scheduler=SCHEDULER_ID,
@@ -282,6 +299,7 @@ def test_create_04(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test2.main",
             scheduler=SCHEDULER_ID,
@@ -304,7 +322,7 @@ def test_create_05(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.event_type = "release"
     sched = Scheduler(evt, now, "group", "secret", "push")
@@ -322,7 +340,7 @@ def test_create_06(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.event_type = "push"
     evt.commit = "commit"
@@ -344,7 +362,7 @@ def test_create_07(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit = "commit"
     evt.branch = "push"
@@ -366,6 +384,7 @@ def test_create_07(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test1.pull_request.1",
             scheduler=SCHEDULER_ID,
@@ -403,7 +422,7 @@ def test_create_08(mocker, ci1_dirty, svc1_dirty, svc2_dirty, expected_image):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit = "commit"
     evt.branch = "main"
@@ -431,6 +450,7 @@ def test_create_08(mocker, ci1_dirty, svc1_dirty, svc2_dirty, expected_image):
                 max_run_time=int(MAX_RUN_TIME.total_seconds()),
                 now=stringDate(now),
                 owner_email=OWNER_EMAIL,
+                priority="medium",
                 provisioner=PROVISIONER_ID,
                 route="index.project.fuzzing.orion.testci1.main",
                 scheduler=SCHEDULER_ID,
@@ -451,6 +471,7 @@ def test_create_08(mocker, ci1_dirty, svc1_dirty, svc2_dirty, expected_image):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route=f"index.project.fuzzing.orion.{svc}.main",
             scheduler=SCHEDULER_ID,
@@ -484,6 +505,7 @@ def test_create_08(mocker, ci1_dirty, svc1_dirty, svc2_dirty, expected_image):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route=f"index.project.fuzzing.orion.{svc}.main",
             scheduler=SCHEDULER_ID,
@@ -506,7 +528,7 @@ def test_create_09(mocker):
     evt = mocker.Mock(spec=GithubEvent())
     evt.repo.path = root
     evt.repo.git = mocker.Mock(
-        return_value="\n".join(str(p) for p in root.glob("**/*"))
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
     )
     evt.commit = "commit"
     evt.branch = "main"
@@ -530,6 +552,7 @@ def test_create_09(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="medium",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test5.main",
             scheduler=SCHEDULER_ID,
@@ -549,6 +572,7 @@ def test_create_09(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="low",
             provisioner=PROVISIONER_ID,
             recipe_name="withdep.sh",
             scheduler=SCHEDULER_ID,
@@ -571,6 +595,7 @@ def test_create_09(mocker):
             max_run_time=int(MAX_RUN_TIME.total_seconds()),
             now=stringDate(now),
             owner_email=OWNER_EMAIL,
+            priority="lowest",
             provisioner=PROVISIONER_ID,
             route="index.project.fuzzing.orion.test6.main",
             scheduler=SCHEDULER_ID,
@@ -582,3 +607,515 @@ def test_create_09(mocker):
     )
     expected3["dependencies"].append(task2_id)
     assert task3 == expected3
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_create_10(mocker, concurrency):
+    """test that every task is created once, after the tasks it depends on"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = taskcluster.get_service.return_value
+    root = FIXTURES / "services03"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "push"
+    evt.event_type = "push"
+    evt.http_url = "https://example.com"
+    evt.pull_request = None
+    evt.commit_message = "/force-rebuild"
+    names = []
+    for _ in range(2):
+        queue.reset_mock()
+        sched = Scheduler(
+            evt,
+            datetime.utcnow(),
+            "group",
+            "secret",
+            "push",
+            submit_concurrency=concurrency,
+        )
+        sched.mark_services_for_rebuild()
+        for recipe in sched.services.recipes.values():
+            recipe.dirty = True
+        sched.create_tasks()
+        created = set()
+        for task_id, task in (args[0] for args in queue.createTask.call_args_list):
+            assert task_id not in created
+            assert set(task["dependencies"]) - {"group"} <= created
+            created.add(task_id)
+        names.append(
+            [args[0][1]["metadata"]["name"] for args in queue.createTask.call_args_list]
+        )
+    # one build and push per service, and one test per recipe
+    assert len(created) == 2 * len(sched.services) + len(sched.services.recipes)
+    if concurrency == 1:
+        assert names[0] == names[1]
+
+
+@pytest.mark.parametrize("forced", [False, True])
+def test_create_11(mocker, forced):
+    """test that builds with the same inputs are reused"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = index = taskcluster.get_service.return_value
+    root = FIXTURES / "services03"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    # `git ls-files -s` output, so blob SHAs are known
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(
+            f"100644 {sha1(p.read_bytes()).hexdigest()} 0\t{p}"
+            for p in root.glob("**/*")
+            if p.is_file()
+        )
+    )
+    evt.commit = "commit"
+    evt.branch = "push"
+    evt.event_type = "push"
+    evt.http_url = "https://example.com"
+    evt.pull_request = None
+    evt.commit_message = "/force-rebuild=test1" if forced else ""
+    evt.list_changed_paths.return_value = []
+    sched = Scheduler(
+        evt, datetime.utcnow(), "group", "secret", "push", reuse_builds=True
+    )
+    sched.mark_services_for_rebuild()
+    sched.services["test1"].dirty = True
+    sched.services["test2"].dirty = True
+    hashes = {name: svc.input_hash for name, svc in sched.services.items()}
+
+    def _find_task(namespace):
+        if namespace == f"project.fuzzing.orion.test1.hash.{hashes['test1']}":
+            return {"taskId": "old-build", "expires": "2100-01-01T00:00:00.000Z"}
+        raise TaskclusterRestFailure("not found", None, 404)
+
+    index.findTask.side_effect = _find_task
+    sched.create_tasks()
+    tasks = dict(args[0] for args in queue.createTask.call_args_list)
+    builds = {
+        task["payload"]["env"]["IMAGE_NAME"].split("/")[1]: (task_id, task)
+        for task_id, task in tasks.items()
+        if "build" in task["metadata"]["name"]
+    }
+    pushes = [task for task in tasks.values() if "push" in task["metadata"]["name"]]
+    assert len(pushes) == 2
+    if forced:
+        assert set(builds) == {"test1", "test2"}
+        assert index.findTask.call_count == 1
+        assert index.insertTask.call_count == 0
+        test1_build = builds["test1"][0]
+    else:
+        assert set(builds) == {"test2"}
+        assert index.findTask.call_count == 2
+        assert sorted(args[0][0] for args in index.insertTask.call_args_list) == [
+            "project.fuzzing.orion.test1.push",
+            "project.fuzzing.orion.test1.rev.commit",
+        ]
+        assert {args[0][1]["taskId"] for args in index.insertTask.call_args_list} == {
+            "old-build"
+        }
+        test1_build = "old-build"
+    # test2 is built from test1, whether it is reused or not
+    assert test1_build in builds["test2"][1]["dependencies"]
+    assert builds["test2"][1]["payload"]["env"]["LOAD_DEPS"] == "1"
+    assert (
+        f"index.project.fuzzing.orion.test2.hash.{hashes['test2']}"
+        in builds["test2"][1]["routes"]
+    )
+    assert any(test1_build in push["dependencies"] for push in pushes)
+
+
+def test_create_11_untrusted(mocker):
+    """test that builds are neither reused nor indexed for reuse outside of
+    `push_branch`"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = index = taskcluster.get_service.return_value
+    root = FIXTURES / "services03"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "push"
+    evt.event_type = "pull_request"
+    evt.http_url = "https://example.com"
+    evt.pull_request = 1
+    evt.commit_message = ""
+    evt.list_changed_paths.return_value = []
+    sched = Scheduler(
+        evt, datetime.utcnow(), "group", "secret", "push", reuse_builds=True
+    )
+    sched.mark_services_for_rebuild()
+    sched.services["test1"].dirty = True
+    sched.services["test2"].dirty = True
+    index.findTask.return_value = {"taskId": "old-build", "expires": "2100-01-01"}
+    sched.create_tasks()
+    assert index.findTask.call_count == 0
+    assert index.insertTask.call_count == 0
+    tasks = [args[0][1] for args in queue.createTask.call_args_list]
+    builds = [task for task in tasks if "build" in task["metadata"]["name"]]
+    assert len(builds) == 2
+    assert not any(".hash." in route for task in tasks for route in task["routes"])
+
+
+@pytest.mark.parametrize("history", [False, True])
+def test_create_12(mocker, history):
+    """test that tasks on the critical path are prioritized"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = index = taskcluster.get_service.return_value
+    root = FIXTURES / "services03"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "main"
+    evt.http_url = "https://example.com"
+    evt.pull_request = None
+    # test2 is built from test1, and test7 from test5
+    durations = {"test1": 100, "test2": 100, "test3": 100, "test5": 1000, "test7": 100}
+    index.findTask.side_effect = lambda ns: {"taskId": ns.split(".")[3]}
+    queue.status.side_effect = lambda task_id: {
+        "status": {
+            "runs": [
+                {"state": "exception"},
+                {
+                    "state": "completed",
+                    "started": "2021-01-01T00:00:00.000Z",
+                    "resolved": stringDate(
+                        datetime(2021, 1, 1) + timedelta(seconds=durations[task_id])
+                    ),
+                },
+            ]
+        }
+    }
+    sched = Scheduler(
+        evt, datetime.utcnow(), "group", "secret", "push", build_history=history
+    )
+    for svc in durations:
+        sched.services[svc].dirty = True
+    sched.create_tasks()
+    priorities = {
+        task["metadata"]["name"].split()[1]: task["priority"]
+        for task in (args[0][1] for args in queue.createTask.call_args_list)
+    }
+    if history:
+        assert index.findTask.call_count == len(durations)
+        # test5 -> test7 is the critical path
+        assert priorities == {
+            "test1": "lowest",
+            "test2": "lowest",
+            "test3": "lowest",
+            "test5": "medium",
+            "test7": "lowest",
+        }
+    else:
+        assert index.findTask.call_count == 0
+        assert priorities == {
+            "test1": "medium",
+            "test2": "lowest",
+            "test3": "lowest",
+            "test5": "medium",
+            "test7": "lowest",
+        }
+
+
+@pytest.mark.parametrize("event", ["pull_request", "push", "dry_run", "first"])
+def test_cancel_superseded(mocker, event):
+    """test that unfinished tasks from the previous decision are cancelled"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = index = taskcluster.get_service.return_value
+    root = FIXTURES / "services03"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "main"
+    evt.event_type = "pull_request" if event == "pull_request" else "push"
+    evt.pull_request = 1 if event == "pull_request" else None
+    evt.commit_message = ""
+    evt.list_changed_paths.return_value = [root / "test3" / "Dockerfile"]
+    namespace = (
+        "project.fuzzing.orion.task-group.pull_request.1"
+        if event == "pull_request"
+        else "project.fuzzing.orion.task-group.main"
+    )
+    if event == "first":
+        index.findTask.side_effect = TaskclusterRestFailure("not found", None, 404)
+    else:
+        index.findTask.return_value = {
+            "taskId": "old-group",
+            "data": {"dirty": ["test1", "test2"]},
+        }
+
+    def _task(task_id, state, kind=None):
+        task = {"metadata": {"name": task_id}}
+        if kind is not None:
+            task["tags"] = {"kind": kind}
+        return {"status": {"taskId": task_id, "state": state}, "task": task}
+
+    pages = [
+        {
+            "tasks": [
+                _task("decision", "running"),
+                _task("done", "completed", "build"),
+                _task("build", "running", "build"),
+            ],
+            "continuationToken": "next",
+        },
+        {
+            "tasks": [
+                _task("test", "pending", "test"),
+                _task("push", "unscheduled", "push"),
+                _task("manifest", "unscheduled", "manifest"),
+                _task("failed", "failed", "test"),
+            ],
+        },
+    ]
+    queue.listTaskGroup.side_effect = pages
+    sched = Scheduler(
+        evt,
+        datetime.utcnow(),
+        "group",
+        "secret",
+        "push",
+        dry_run=event == "dry_run",
+        cancel_superseded=True,
+    )
+    sched.mark_services_for_rebuild()
+    sched.cancel_superseded_tasks()
+    index.findTask.assert_called_once_with(namespace)
+    dirty = {name for name, svc in sched.services.items() if svc.dirty}
+    if event == "first":
+        assert queue.listTaskGroup.call_count == 0
+        assert dirty == {"test3"}
+    else:
+        assert queue.listTaskGroup.call_count == 2
+        assert queue.listTaskGroup.call_args_list[1][1] == {
+            "query": {"continuationToken": "next"}
+        }
+    if event in {"pull_request", "push"}:
+        # only builds and tests are cancelled
+        assert [args[0][0] for args in queue.cancelTask.call_args_list] == [
+            "build",
+            "test",
+        ]
+    else:
+        assert queue.cancelTask.call_count == 0
+    if event in {"push", "dry_run"}:
+        # services dirty in the cancelled decision are rebuilt here
+        assert dirty == {"test1", "test2", "test3"}
+    elif event == "pull_request":
+        assert dirty == {"test3"}
+    if event == "dry_run":
+        assert index.insertTask.call_count == 0
+    else:
+        index.insertTask.assert_called_once()
+        ns, entry = index.insertTask.call_args[0]
+        assert ns == namespace
+        assert entry["taskId"] == "group"
+        assert entry["data"] == {"dirty": sorted(dirty)}
+
+
+def test_create_13(mocker):
+    """test that chains of quick builds are batched into one task"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = index = taskcluster.get_service.return_value
+    root = FIXTURES / "services03"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "push"
+    evt.event_type = "push"
+    evt.http_url = "https://example.com"
+    evt.pull_request = None
+    # test2 is built from test1, and test7 from test5 (which is too slow to batch)
+    durations = {"test1": 100, "test2": 100, "test3": 100, "test5": 1000, "test7": 100}
+    index.findTask.side_effect = lambda ns: {"taskId": ns.split(".")[3]}
+    queue.status.side_effect = lambda task_id: {
+        "status": {
+            "runs": [
+                {
+                    "state": "completed",
+                    "started": "2021-01-01T00:00:00.000Z",
+                    "resolved": stringDate(
+                        datetime(2021, 1, 1) + timedelta(seconds=durations[task_id])
+                    ),
+                },
+            ]
+        }
+    }
+    sched = Scheduler(
+        evt,
+        datetime.utcnow(),
+        "group",
+        "secret",
+        "push",
+        build_history=True,
+        batch_builds=True,
+    )
+    for svc in durations:
+        sched.services[svc].dirty = True
+    sched.create_tasks()
+    tasks = dict(args[0] for args in queue.createTask.call_args_list)
+    builds = {
+        task["metadata"]["name"]: (task_id, task)
+        for task_id, task in tasks.items()
+        if task["metadata"]["name"].endswith("docker build")
+    }
+    pushes = {
+        task["payload"]["env"]["ARTIFACT_FILTER"]: task
+        for task in tasks.values()
+        if task["metadata"]["name"].endswith("docker push")
+    }
+    assert set(builds) == {
+        "Orion test1, test2 docker build",
+        "Orion test3 docker build",
+        "Orion test5 docker build",
+        "Orion test7 docker build",
+    }
+    batch_id, batch = builds["Orion test1, test2 docker build"]
+    assert batch["dependencies"] == []
+    assert set(batch["payload"]["artifacts"]) == {
+        "public/test1.tar.zst",
+        "public/test2.tar.zst",
+    }
+    assert "IMAGE_NAME" not in batch["payload"]["env"]
+    assert json_loads(batch["payload"]["env"]["BATCH"]) == [
+        {
+            "dockerfile": "test1/Dockerfile",
+            "image": "mozillasecurity/test1",
+            "output": "/images/test1.tar",
+        },
+        {
+            "dockerfile": "test2/Dockerfile",
+            "image": "mozillasecurity/test2",
+            "output": "/images/test2.tar",
+        },
+    ]
+    assert {
+        "index.project.fuzzing.orion.test1.rev.commit",
+        "index.project.fuzzing.orion.test1.push",
+        "index.project.fuzzing.orion.test2.rev.commit",
+        "index.project.fuzzing.orion.test2.push",
+    } <= set(batch["routes"])
+    # each image is pushed from the batch task separately
+    assert len(pushes) == len(durations)
+    for svc in ("test1", "test2"):
+        assert pushes[f"public/{svc}.tar.zst"]["dependencies"] == [batch_id]
+    test5_id = builds["Orion test5 docker build"][0]
+    assert builds["Orion test7 docker build"][1]["dependencies"] == [test5_id]
+
+
+def test_create_14(mocker):
+    """test that multi-architecture services are built for each architecture"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = taskcluster.get_service.return_value
+    root = FIXTURES / "services14"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "push"
+    evt.event_type = "push"
+    evt.http_url = "https://example.com"
+    evt.pull_request = None
+    sched = Scheduler(evt, datetime.utcnow(), "group", "secret", "push")
+    for svc in sched.services.values():
+        svc.dirty = True
+    sched.create_tasks()
+    tasks = {
+        task["metadata"]["name"]: (task_id, task)
+        for task_id, task in (args[0] for args in queue.createTask.call_args_list)
+    }
+    assert set(tasks) == {
+        "Orion base docker build",
+        "Orion base arm64 docker build",
+        "Orion base docker push",
+        "Orion base docker manifest",
+        "Orion child docker build",
+        "Orion child arm64 docker build",
+        "Orion child docker push",
+        "Orion child docker manifest",
+        "Orion solo docker build",
+        "Orion solo docker push",
+    }
+    base_id, base = tasks["Orion base docker build"]
+    base_arm_id, base_arm = tasks["Orion base arm64 docker build"]
+    child_arm_id, child_arm = tasks["Orion child arm64 docker build"]
+    assert base["workerType"] == "ci"
+    assert base["payload"]["env"]["DOCKERFILE"] == "base/Dockerfile"
+    # superseded builds can be cancelled, pushes and manifests can't
+    assert base["tags"] == base_arm["tags"] == {"kind": "build"}
+    assert tasks["Orion base docker push"][1]["tags"] == {"kind": "push"}
+    assert tasks["Orion base docker manifest"][1]["tags"] == {"kind": "manifest"}
+    assert base_arm["workerType"] == "ci-arm64"
+    assert base_arm["payload"]["env"]["DOCKERFILE"] == "base/arm64/Dockerfile"
+    assert set(base_arm["payload"]["artifacts"]) == {"public/arm64/base.tar.zst"}
+    assert base_arm["routes"] == [
+        "index.project.fuzzing.orion.base.arch.arm64.rev.commit",
+        "index.project.fuzzing.orion.base.arch.arm64.push",
+    ]
+    # each architecture is built from the same architecture of its dependencies
+    assert tasks["Orion child docker build"][1]["dependencies"] == [base_id]
+    assert child_arm["dependencies"] == [base_arm_id]
+    assert child_arm["payload"]["env"]["LOAD_DEPS"] == "1"
+    assert tasks["Orion solo docker build"][1]["dependencies"] == [base_id]
+    # the manifest is published after every architecture is built
+    manifest = tasks["Orion base docker manifest"][1]
+    push_id = tasks["Orion base docker push"][0]
+    assert manifest["dependencies"] == [base_id, base_arm_id, push_id]
+    assert manifest["payload"]["env"]["ARCH_IMAGES"] == (
+        f"amd64={base_id}:public/base.tar.zst "
+        f"arm64={base_arm_id}:public/arm64/base.tar.zst"
+    )
+    assert manifest["payload"]["env"]["MANIFEST_COMMAND"] == (
+        "./scripts/docker-manifest.sh mozillasecurity base"
+    )
+    child_manifest = tasks["Orion child docker manifest"][1]
+    assert child_manifest["payload"]["env"]["MANIFEST_COMMAND"] == ""
+    assert child_arm_id in child_manifest["dependencies"]
+
+
+def test_create_14_single_arch_dep(mocker):
+    """test that a multi-architecture service depending on a single architecture
+    service is built from that build for every architecture"""
+    taskcluster = mocker.patch("orion_decision.scheduler.Taskcluster", autospec=True)
+    queue = taskcluster.get_service.return_value
+    root = FIXTURES / "services14"
+    evt = mocker.Mock(spec=GithubEvent())
+    evt.repo.path = root
+    evt.repo.git = mocker.Mock(
+        return_value="\0".join(str(p) for p in root.glob("**/*") if p.is_file())
+    )
+    evt.commit = "commit"
+    evt.branch = "push"
+    evt.event_type = "push"
+    evt.http_url = "https://example.com"
+    evt.pull_request = None
+    sched = Scheduler(evt, datetime.utcnow(), "group", "secret", "push")
+    # as if child was also built from solo, which is only built for amd64
+    sched.services["child"].service_deps.add("solo")
+    sched.services["solo"].dirty = True
+    sched.services["child"].dirty = True
+    sched.create_tasks()
+    tasks = {
+        task["metadata"]["name"]: (task_id, task)
+        for task_id, task in (args[0] for args in queue.createTask.call_args_list)
+    }
+    solo_id = tasks["Orion solo docker build"][0]
+    assert tasks["Orion child docker build"][1]["dependencies"] == [solo_id]
+    child_arm = tasks["Orion child arm64 docker build"][1]
+    assert child_arm["dependencies"] == [solo_id]
+    assert child_arm["payload"]["env"]["LOAD_DEPS"] == "1"
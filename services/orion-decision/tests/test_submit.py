@@ -0,0 +1,127 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for concurrent task submission"""
+
+from threading import Lock
+from time import sleep
+
+import pytest
+from taskcluster.exceptions import TaskclusterConnectionError, TaskclusterRestFailure
+
+from orion_decision.submit import RETRIES, TaskSubmitter
+
+
+class FakeQueue:
+    """Local stand-in for the Taskcluster queue that checks dependencies"""
+
+    def __init__(self, delay=0.01, failures=None):
+        self.created = []
+        self.clients = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = delay
+        # task_id -> list of exceptions to raise before succeeding
+        self.failures = failures or {}
+        self.lock = Lock()
+
+    def client(self):
+        with self.lock:
+            self.clients += 1
+        return self
+
+    def createTask(self, task_id, task):
+        with self.lock:
+            missing = [dep for dep in task["dependencies"] if dep not in self.created]
+            assert not missing, f"{task_id} created before {missing}"
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            sleep(self.delay)
+            with self.lock:
+                if self.failures.get(task_id):
+                    raise self.failures[task_id].pop(0)
+                self.created.append(task_id)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def _tasks():
+    # a diamond, plus independent tasks
+    tasks = {
+        "a": [],
+        "b": ["a"],
+        "c": ["a"],
+        "d": ["b", "c", "external"],
+    }
+    tasks.update({f"x{idx}": [] for idx in range(10)})
+    return [(task_id, {"dependencies": deps}) for task_id, deps in tasks.items()]
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_submit_01(max_in_flight):
+    """test that tasks are created once each, after their dependencies"""
+    queue = FakeQueue()
+    queue.created.append("external")
+    submitter = TaskSubmitter(max_in_flight, queue.client)
+    for task_id, task in _tasks():
+        submitter.submit(task_id, task)
+    submitter.wait()
+    assert sorted(queue.created) == sorted(["external"] + [t for t, _ in _tasks()])
+    # completion callbacks can run in a different order than the queue saw,
+    # but never before a dependency
+    assert sorted(submitter.created) == sorted(queue.created[1:])
+    for task_id, task in _tasks():
+        for dep in task["dependencies"]:
+            if dep != "external":
+                assert submitter.created.index(dep) < submitter.created.index(task_id)
+    assert queue.max_in_flight <= max_in_flight
+    if max_in_flight > 1:
+        # independent tasks were in flight together
+        assert queue.max_in_flight > 1
+    # one client per worker thread
+    assert queue.clients <= max_in_flight
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_submit_02(mocker, max_in_flight):
+    """test that transient failures are retried"""
+    sleep_ = mocker.patch("orion_decision.submit.sleep", autospec=True)
+    queue = FakeQueue(
+        delay=0,
+        failures={
+            "a": [TaskclusterConnectionError("timeout", None)],
+            "x0": [TaskclusterRestFailure("busy", None, 503)] * 2,
+        },
+    )
+    queue.created.append("external")
+    submitter = TaskSubmitter(max_in_flight, queue.client)
+    for task_id, task in _tasks():
+        submitter.submit(task_id, task)
+    submitter.wait()
+    assert len(queue.created) == len(_tasks()) + 1
+    assert sleep_.call_count == 3
+
+
+def test_submit_03(mocker):
+    """test that failed tasks are raised, and dependent tasks are not created"""
+    mocker.patch("orion_decision.submit.sleep", autospec=True)
+    queue = FakeQueue(
+        delay=0,
+        failures={
+            "b": [TaskclusterRestFailure("bad request", None, 400)],
+            "x0": [TaskclusterConnectionError("timeout", None)] * RETRIES,
+        },
+    )
+    queue.created.append("external")
+    submitter = TaskSubmitter(4, queue.client)
+    for task_id, task in _tasks():
+        submitter.submit(task_id, task)
+    with pytest.raises((TaskclusterConnectionError, TaskclusterRestFailure)):
+        submitter.wait()
+    assert "b" not in queue.created
+    assert "d" not in queue.created
+    assert "x0" not in queue.created
+    assert {"a", "c", "x1"} <= set(queue.created)
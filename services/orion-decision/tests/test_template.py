@@ -0,0 +1,106 @@
+# coding: utf-8
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""Tests for pre-compiled task templates"""
+
+from json import dumps as json_dump
+from pathlib import Path
+from string import Template
+
+import pytest
+from yaml import YAMLError
+from yaml import safe_load as yaml_load
+
+from orion_decision.template import TaskTemplate
+
+# task templates of every service using TaskTemplate
+SERVICES = Path(__file__).resolve().parents[2]
+TEMPLATES = sorted(SERVICES.glob("*/src/*/**/task_templates/*.yaml"))
+VALUES = [
+    "simple",
+    "with space",
+    "a.b/c-1.0",
+    "0a1b2c3d",
+    "line\\nbreak",
+    "123",
+    "0x10",
+    "1.5",
+    "true",
+    "null",
+    "~",
+    "2021-01-01",
+    "https://example.com/a#b",
+    "{b: c}",
+    "[1, 2]",
+    json_dump("a: b"),
+    json_dump(json_dump({"a": [1, "b"]})),
+]
+
+
+@pytest.mark.parametrize(
+    "path", TEMPLATES, ids=lambda path: str(path.relative_to(SERVICES))
+)
+@pytest.mark.parametrize("value", VALUES)
+def test_template_01(path, value):
+    """test that filling a template matches substitute + yaml_load"""
+    text = path.read_text()
+    tmpl = TaskTemplate(text)
+    # some slots are tagged !!int
+    defaults = {name: "1" for name in tmpl.names}
+    compared = 0
+    for name in sorted(tmpl.names):
+        values = dict(defaults, **{name: value})
+        try:
+            expected = yaml_load(Template(text).substitute(**values))
+        except (ValueError, YAMLError):
+            # the value can't be used in this slot (with either method)
+            continue
+        assert tmpl.fill(**values) == expected, name
+        compared += 1
+    assert compared or value[:1] in '"{['
+    values = defaults
+    # each call gives a new object
+    assert tmpl.fill(**values) is not tmpl.fill(**values)
+
+
+def test_template_02():
+    """test template slot kinds"""
+    tmpl = TaskTemplate(
+        "plain: ${a}\n"
+        "quoted: 'x-${a}'\n"
+        'dquoted: "${a}"\n'
+        "int: ${n}\n"
+        "list: [$a, ${a}-$n]\n"
+        "cost: $$5\n"
+        "${a}: key\n"
+    )
+    assert tmpl.names == {"a", "n"}
+    assert tmpl.fill(a="b c", n=5) == {
+        "plain": "b c",
+        "quoted": "x-b c",
+        "dquoted": "b c",
+        "int": 5,
+        "list": ["b c", "b c-5"],
+        "cost": "$5",
+        "b c": "key",
+    }
+    # plain scalars are resolved as YAML would
+    assert tmpl.fill(a="123", n="true") == {
+        "plain": 123,
+        "quoted": "x-123",
+        "dquoted": "123",
+        "int": True,
+        "list": [123, "123-true"],
+        "cost": "$5",
+        123: "key",
+    }
+    assert TaskTemplate("plain: ${a}\n").fill(a='"x: y"') == {"plain": "x: y"}
+    assert tmpl.fill(a="a\\tb", n=1)["dquoted"] == "a\tb"
+    tmpl = TaskTemplate('int: !!int ${n}\nesc: "a\\t${n}"\n')
+    assert tmpl.fill(n="12") == {"int": 12, "esc": "a\t12"}
+    assert tmpl.fill(n="0x10")["int"] == 16
+    with pytest.raises(KeyError):
+        tmpl.fill()
+    with pytest.raises(ValueError):
+        TaskTemplate("bad: ${a b}\n")